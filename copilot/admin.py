@@ -2,7 +2,15 @@
 
 from django.contrib import admin
 
-from copilot.models import Chat, Transaction, TransactionSummary, User
+from copilot.models import (
+    Chat,
+    ChatMessage,
+    MessageJob,
+    OutboundMessage,
+    Transaction,
+    TransactionSummary,
+    User,
+)
 
 
 class UserAdmin(admin.ModelAdmin):
@@ -24,7 +32,25 @@ class TransactionSummaryAdmin(admin.ModelAdmin):
     exclude = ("data",)
 
 
+class MessageJobAdmin(admin.ModelAdmin):
+    list_display = ("message_sid", "sender", "status", "attempts", "available_at")
+    list_filter = ("status",)
+
+
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ("to", "part", "parts", "status", "delivery_status", "sent_at")
+    list_filter = ("status", "delivery_status")
+
+
+class ChatMessageAdmin(admin.ModelAdmin):
+    list_display = ("userId", "timestamp", "sender", "message")
+    list_filter = ("sender",)
+
+
 admin.site.register(User, UserAdmin)
 admin.site.register(Transaction)
 admin.site.register(TransactionSummary, TransactionSummaryAdmin)
 admin.site.register(Chat)
+admin.site.register(ChatMessage, ChatMessageAdmin)
+admin.site.register(MessageJob, MessageJobAdmin)
+admin.site.register(OutboundMessage, OutboundMessageAdmin)
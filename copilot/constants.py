@@ -8,6 +8,26 @@ INTENTS = [
     "OTHER",
 ]
 
+# Sent when Gemini is saturated and a message is shed (see LLMScheduler)
+REPLY_BUSY = "We're handling a lot of messages right now, please try again in a minute."
+# Sent when a handler could not act on a message (e.g. nothing to update)
+REPLY_NOT_PROCESSED = "Sorry, I couldn't process your message. Could you rephrase it?"
+# Sent to senders without an account who ask for anything but registering
+REPLY_ASK_NAME = (
+    "Welcome! Before I can keep track of your finances, please tell me your "
+    'name, e.g. "My name is Sam".'
+)
+# Sent once a sender has registered (see views.create_user)
+REPLY_WELCOME = (
+    "Nice to meet you, {name}! Tell me about your spending and income, e.g. "
+    '"spent $12 on coffee", or ask me how you are doing this month.'
+)
+# Sent when extracted transaction details can't be recorded (see InvalidTransaction)
+REPLY_INVALID_TRANSACTION_TYPE = (
+    "Sorry, I couldn't tell whether {description} is an income or an expense. "
+    "Could you say which?"
+)
+
 PROMPT_CLASSIFY_MESSAGE = """
     Read the below message/attached media and classify the intent of the message. Except for the case when intent is "OTHER", only reply with the exact intent category as it is.
     By default, if there is some transaction related detail, then it might be CREATE_TRANSACTION, but validate that it doesn't fall into any other category first.
@@ -17,3 +37,44 @@ PROMPT_CLASSIFY_MESSAGE = """
 """.replace(
     "$intents", ", ".join(INTENTS)
 )
+
+TRANSACTION_TYPES = ["income", "expense"]
+
+TRANSACTION_CATEGORIES = [
+    "shopping",
+    "dining",
+    "bills",
+    "transport",
+    "health",
+    "misc",
+    "salary",
+    "gift",
+    "rewards",
+]
+
+PROMPT_CLASSIFY_AND_EXTRACT = """
+    Read the below message/attached media, classify the intent of the message and extract the details required for that intent.
+    By default, if there is some transaction related detail, then it might be CREATE_TRANSACTION, but validate that it doesn't fall into any other category first.
+    Intents: $intents
+
+    Return a strict JSON object (starting with { and ending with }) in this format:
+    {"intent": <intent>, "payload": <payload>}
+
+    The payload depends on the intent:
+    INPUT_NAME: {"name": <full name of the user>}
+    CREATE_TRANSACTION: {"type": <$types>, "category": <$categories>, "amount": <amount in $>, "day": <day (0-31)>, "month":<1-12>, "year":<year>, "description": <description>}.
+        Use today's date ($date in mm-dd-yyyy) as default for day, month and year if not specified in the message
+    UPDATE_TRANSACTION and DELETE_TRANSACTION: {"search": {<fields identifying the transaction>}, "updates": {<only fields being updated>}}
+        Search and update fields are any of type, category, amount, day, month, year, description. Only include fields that are identified and not others.
+        If you find that "description" is the key field, it should always be a fuzzy match. All other fields are an exact match.
+        If date related information is not given then DO NOT ASSUME ANYTHING.
+        If amount is not given, then for description field output multiple one word possibilities for the search.
+    MULTIPLE_TRANSACTIONS: {"transactions": [<one CREATE_TRANSACTION payload per transaction>]}
+    Any other intent: {}
+""".replace(
+    "$intents", ", ".join(INTENTS)
+).replace(
+    "$types", "|".join(TRANSACTION_TYPES)
+).replace(
+    "$categories", "|".join(TRANSACTION_CATEGORIES)
+)
@@ -1,4 +1,6 @@
 # models/fields.py
+import json
+
 from django.db.models import JSONField
 from .summary import YearlySummary
 
@@ -8,6 +10,9 @@ class YearlySummaryField(JSONField):
     def from_db_value(self, value, expression, connection):
         if value is None:
             return YearlySummary()
+        # SQL backends hand back the encoded JSON, MongoDB the document itself
+        if isinstance(value, str):
+            value = json.loads(value)
         return YearlySummary.from_dict(value)
 
     def to_python(self, value):
@@ -0,0 +1,103 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+from copilot.constants import INTENTS, TRANSACTION_CATEGORIES, TRANSACTION_TYPES
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IntentResult:
+    intent: str
+    # Intent-specific details, None when they still have to be extracted
+    payload: Optional[dict] = field(default=None)
+    # How sure the classifier is, Gemini results are trusted as is
+    confidence: float = 1.0
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an IntentResult from the classify-and-extract JSON response.
+        Raises ValueError if the response doesn't match the expected schema.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("response must be a JSON object")
+
+        intent = str(data.get("intent", "")).strip().upper()
+        if intent not in INTENTS:
+            raise ValueError(f"unknown intent: {intent!r}")
+
+        payload = data.get("payload") or {}
+        if not isinstance(payload, dict):
+            raise ValueError("payload must be a JSON object")
+
+        validator = PAYLOAD_VALIDATORS.get(intent)
+        return cls(intent=intent, payload=validator(payload) if validator else payload)
+
+
+def validate_user_name(payload: dict) -> dict:
+    name = str(payload.get("name", "")).strip()
+    if not name:
+        raise ValueError("INPUT_NAME payload requires a name")
+    return {"name": name}
+
+
+def validate_transaction(payload: dict) -> dict:
+    """Check a CREATE_TRANSACTION payload and coerce its field types"""
+    try:
+        transaction = {
+            "type": payload.get("type", "expense"),
+            "category": payload.get("category", "misc"),
+            "amount": float(payload["amount"]),
+            "day": int(payload["day"]),
+            "month": int(payload["month"]),
+            "year": int(payload["year"]),
+            "description": str(payload.get("description", "")),
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"invalid transaction payload: {e}")
+    if transaction["type"] not in TRANSACTION_TYPES:
+        raise ValueError(f"invalid transaction type: {transaction['type']!r}")
+    if transaction["category"] not in TRANSACTION_CATEGORIES:
+        transaction["category"] = "misc"
+    if not 1 <= transaction["month"] <= 12 or not 1 <= transaction["day"] <= 31:
+        raise ValueError("invalid transaction date")
+    return transaction
+
+
+def validate_transactions(payload: dict) -> dict:
+    """
+    Check a MULTIPLE_TRANSACTIONS payload ({"transactions": [...]}).
+    Invalid entries are dropped; at least one must be valid.
+    """
+    transactions = payload.get("transactions")
+    if not isinstance(transactions, list):
+        raise ValueError("payload requires a 'transactions' list")
+    valid = []
+    for transaction in transactions:
+        try:
+            valid.append(validate_transaction(transaction))
+        except (AttributeError, ValueError) as e:
+            logger.debug("Skipping invalid transaction %s: %s", transaction, e)
+    if not valid:
+        raise ValueError("no valid transaction in payload")
+    return {"transactions": valid}
+
+
+def validate_transaction_update(payload: dict) -> dict:
+    """Check an UPDATE/DELETE_TRANSACTION payload ({"search": {}, "updates": {}})"""
+    search = payload.get("search")
+    updates = payload.get("updates", {})
+    if not isinstance(search, dict) or not isinstance(updates, dict):
+        raise ValueError("update payload requires 'search' and 'updates' objects")
+    return {"search": search, "updates": updates}
+
+
+PAYLOAD_VALIDATORS = {
+    "INPUT_NAME": validate_user_name,
+    "CREATE_TRANSACTION": validate_transaction,
+    "UPDATE_TRANSACTION": validate_transaction_update,
+    "DELETE_TRANSACTION": validate_transaction_update,
+    "MULTIPLE_TRANSACTIONS": validate_transactions,
+}
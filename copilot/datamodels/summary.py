@@ -1,29 +1,61 @@
 # models/summary.py
 
 class MonthlySummary:
-    def __init__(self, income=0, expense=0):
+    def __init__(self, income=0, expense=0, categories=None):
         self.income = income
         self.expense = expense
+        self.categories = categories or {}  # {category: {'income': x, 'expense': y}}
+
+    def apply(self, type, category, amount):
+        """Add amount (negative to remove) to the month and category totals"""
+        setattr(self, type, round(getattr(self, type) + amount, 2))
+        totals = self.categories.setdefault(category, {'income': 0, 'expense': 0})
+        totals[type] = round(totals[type] + amount, 2)
+        if not totals['income'] and not totals['expense']:
+            del self.categories[category]
 
     def to_dict(self):
         return {
             'income': self.income,
-            'expense': self.expense
+            'expense': self.expense,
+            'categories': self.categories
         }
 
     @classmethod
     def from_dict(cls, data):
-        return cls(income=data.get('income', 0), expense=data.get('expense', 0))
+        return cls(
+            income=data.get('income', 0),
+            expense=data.get('expense', 0),
+            categories=data.get('categories', {})
+        )
 
 
 class YearlySummary:
     def __init__(self):
         self.years = {}  # {year: {month: MonthlySummary}}
 
-    def add_monthly_summary(self, year, month, income=0, expense=0):
+    def add_monthly_summary(self, year, month, income=0, expense=0, categories=None):
         if year not in self.years:
             self.years[year] = {}
-        self.years[year][month] = MonthlySummary(income, expense)
+        self.years[year][month] = MonthlySummary(income, expense, categories)
+
+    def get_monthly_summary(self, year, month):
+        """Totals of a month, an empty MonthlySummary if nothing was recorded"""
+        return self.years.get(str(year), {}).get(str(month), MonthlySummary())
+
+    def apply_delta(self, year, month, type, category, amount):
+        """
+        Add a transaction's amount (negative to remove it) to the totals.
+        Keys are strings, as they come back from the JSON field.
+        """
+        year, month = str(year), str(month)
+        months = self.years.setdefault(year, {})
+        summary = months.setdefault(month, MonthlySummary())
+        summary.apply(type, category, amount)
+        if not summary.income and not summary.expense and not summary.categories:
+            del months[month]
+            if not months:
+                del self.years[year]
 
     def to_dict(self):
         """Convert to a JSON-serializable dictionary."""
@@ -38,5 +70,11 @@ class YearlySummary:
         instance = cls()
         for year, months in data.items():
             for month, summary in months.items():
-                instance.add_monthly_summary(year, month, summary.get('income', 0), summary.get('expense', 0))
+                instance.add_monthly_summary(
+                    year,
+                    month,
+                    summary.get('income', 0),
+                    summary.get('expense', 0),
+                    summary.get('categories', {})
+                )
         return instance
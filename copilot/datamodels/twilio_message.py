@@ -1,5 +1,6 @@
-from dataclasses import dataclass
-from typing import List, Optional
+import threading
+from dataclasses import dataclass, field, fields
+from typing import Any, List, Optional
 
 
 @dataclass
@@ -7,6 +8,34 @@ class TwilioMedia:
     url: str  # Twilio media URL
     content_type: str
     local_path: Optional[str] = None  # Path where media is saved locally
+    # Decoded artifacts, computed once per message (see GeminiService.media_content)
+    digest: Optional[str] = None  # SHA-256 of the media file
+    transcript: Optional[str] = None  # Speech-to-text of audio media
+    image: Any = field(default=None, repr=False, compare=False)  # Decoded PIL image
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def to_dict(self):
+        """Convert the TwilioMedia to a JSON-serializable dictionary (without the decoded image)."""
+        return {
+            "url": self.url,
+            "content_type": self.content_type,
+            "local_path": self.local_path,
+            "digest": self.digest,
+            "transcript": self.transcript,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a TwilioMedia instance from a dictionary."""
+        return cls(
+            url=data["url"],
+            content_type=data["content_type"],
+            local_path=data.get("local_path"),
+            digest=data.get("digest"),
+            transcript=data.get("transcript"),
+        )
 
 
 @dataclass
@@ -20,7 +49,32 @@ class TwilioMessage:
     direction: str  # 'inbound' or 'outbound'
     timestamp: str
     status: str = "received"
+    # Conversational context of the sender (see ChatContextBuilder)
+    context: Optional[str] = None
+    # MessageSids of later messages coalesced into this one
+    merged_sids: List[str] = field(default_factory=list)
 
     @property
     def has_media(self) -> bool:
         return len(self.media) > 0
+
+    def merge(self, other: "TwilioMessage"):
+        """Fold a later message of the same sender into this one (combined body and media)."""
+        self.body = "\n".join(
+            part for part in (self.body, other.body) if part and part.strip()
+        )
+        self.media.extend(other.media)
+        self.merged_sids.append(other.message_sid)
+
+    def to_dict(self):
+        """Convert the TwilioMessage to a JSON-serializable dictionary."""
+        data = {f.name: getattr(self, f.name) for f in fields(self)}
+        data["media"] = [media.to_dict() for media in self.media]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a TwilioMessage instance from a dictionary."""
+        values = dict(data)
+        values["media"] = [TwilioMedia.from_dict(m) for m in data.get("media", [])]
+        return cls(**values)
@@ -0,0 +1,6 @@
+"""
+Offline load testing of the WhatsApp pipeline (manage.py loadtest): a fake
+Gemini client, a fake Twilio REST/media server and a load generator
+replaying webhook payloads, so throughput and latency can be measured on
+one machine without Twilio or Gemini accounts.
+"""
@@ -0,0 +1,207 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from django.conf import settings
+
+from copilot.loadtest.latency import LatencyDistribution
+
+# GeminiService.send_message sends the chat context as a separate part
+# starting with this; rules never match on it (see FakeModels.match)
+CONTEXT_PREFIX = "Conversation so far"
+
+# Answers of prompts no recorded or scenario rule matches
+FALLBACK_RULES = [
+    {"contains": ['{"intent": <intent>'], "text": '{"intent": "OTHER", "payload": {}}'},
+    {"contains": ["classify the intent of the message"], "text": "OTHER"},
+    {
+        "contains": ["Update the summary of a conversation"],
+        "text": "The user has been logging expenses.",
+    },
+    {"contains": ['{"transactions": ['], "text": '{"transactions": []}'},
+    {"contains": [], "text": "Sorry, I couldn't process your query"},
+]
+
+
+class FakeAPIError(Exception):
+    """Injected Gemini error, carrying an HTTP status code like genai's APIError"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+@dataclass
+class FakeUsage:
+    prompt_token_count: int
+    candidates_token_count: int
+    total_token_count: int
+
+
+@dataclass
+class FakeResponse:
+    text: str
+    usage_metadata: FakeUsage
+
+
+@dataclass
+class FakeStats:
+    calls: int = 0
+    errors: int = 0
+    by_rule: dict = field(default_factory=dict)
+
+
+class FakeModels:
+    """
+    Stand-in for genai.Client.models. generate_content answers with the
+    text of the first rule whose "contains" strings all appear in the
+    prompt and message parts, after sleeping for a sample of `latency` (or
+    the rule's own "latency" spec); a share of calls fails with a 503 as
+    configured by error_rate.
+    """
+
+    def __init__(
+        self,
+        rules: List[dict],
+        latency: LatencyDistribution,
+        error_rate: float = 0.0,
+        rng: Optional[random.Random] = None,
+    ):
+        self.rng = rng or random.Random()
+        self.rules = [
+            dict(
+                rule,
+                latency=(
+                    LatencyDistribution(rule["latency"], self.rng)
+                    if rule.get("latency") is not None
+                    else None
+                ),
+            )
+            for rule in rules + FALLBACK_RULES
+        ]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = FakeStats()
+        self._lock = threading.Lock()
+
+    def match(self, contents) -> dict:
+        parts = [
+            part
+            for part in (contents if isinstance(contents, list) else [contents])
+            if isinstance(part, str) and not part.startswith(CONTEXT_PREFIX)
+        ]
+        text = "\n".join(parts)
+        for index, rule in enumerate(self.rules):
+            if all(needle in text for needle in rule.get("contains", [])):
+                return dict(rule, index=index, prompt_chars=len(text))
+        # Unreachable, the last fallback rule matches everything
+        raise LookupError("No fake Gemini rule matched")
+
+    def generate_content(self, model=None, contents=None, config=None, **kwargs):
+        rule = self.match(contents)
+        time.sleep((rule["latency"] or self.latency).sample())
+
+        with self._lock:
+            self.stats.calls += 1
+            name = rule.get("name") or f"rule {rule['index']}"
+            self.stats.by_rule[name] = self.stats.by_rule.get(name, 0) + 1
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.stats.errors += 1
+        if failed:
+            raise FakeAPIError(503, "UNAVAILABLE (injected by the fake Gemini client)")
+
+        prompt_tokens = rule["prompt_chars"] // 4
+        output_tokens = len(rule["text"]) // 4
+        return FakeResponse(
+            text=rule["text"],
+            usage_metadata=FakeUsage(
+                prompt_tokens, output_tokens, prompt_tokens + output_tokens
+            ),
+        )
+
+
+class FakeGeminiClient:
+    """Exposes `models` like genai.Client"""
+
+    def __init__(self, models: FakeModels):
+        self.models = models
+
+
+class RecordingModels:
+    """
+    Wraps the real genai models and appends every exchange to a JSON-lines
+    file as a rule FakeModels can replay (keyed on the start of the prompt
+    and the message body, with the observed latency)
+    """
+
+    def __init__(self, models, path: str):
+        self.models = models
+        self.path = path
+        self._lock = threading.Lock()
+
+    def generate_content(self, model=None, contents=None, config=None, **kwargs):
+        started = time.monotonic()
+        response = self.models.generate_content(
+            model=model, contents=contents, config=config, **kwargs
+        )
+        parts = [
+            part.strip()
+            for part in (contents if isinstance(contents, list) else [contents])
+            if isinstance(part, str) and not part.startswith(CONTEXT_PREFIX)
+        ]
+        rule = {
+            "contains": [parts[0][:80]] + parts[1:] if parts else [],
+            "text": response.text,
+            "latency": f"constant:{time.monotonic() - started:.3f}",
+        }
+        with self._lock, open(self.path, "a") as file:
+            file.write(json.dumps(rule) + "\n")
+        return response
+
+
+def load_rules(path: Optional[str]) -> List[dict]:
+    """Rules from a JSON list or a JSON-lines file (as written by RecordingModels)"""
+    if not path:
+        return []
+    with open(path) as file:
+        content = file.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def create_client() -> FakeGeminiClient:
+    """
+    COPILOT_GEMINI_CLIENT_FACTORY: fake client configured by COPILOT_LOADTEST,
+    answering with the recorded responses first, then the load test scenarios'
+    """
+    from copilot.loadtest.scenarios import scenario_rules
+
+    options = getattr(settings, "COPILOT_LOADTEST", {})
+    rules = load_rules(options.get("gemini_responses")) + scenario_rules()
+    return FakeGeminiClient(
+        FakeModels(
+            rules,
+            LatencyDistribution(options.get("gemini_latency")),
+            options.get("gemini_error_rate", 0.0),
+        )
+    )
+
+
+def create_recording_client():
+    """
+    COPILOT_GEMINI_CLIENT_FACTORY: real client for GOOGLE_API_KEY recording
+    its responses to COPILOT_LOADTEST["gemini_record"] for later replay
+    """
+    from google import genai
+
+    client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+    path = getattr(settings, "COPILOT_LOADTEST", {}).get("gemini_record")
+    if not path:
+        raise ValueError('COPILOT_LOADTEST["gemini_record"] is not set')
+    return FakeGeminiClient(RecordingModels(client.models, path))
@@ -0,0 +1,196 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+
+from django.conf import settings
+
+from copilot.loadtest.latency import LatencyDistribution
+
+TWILIO_API_URL = "https://api.twilio.com"
+MESSAGES_PATH = re.compile(r"^/2010-04-01/Accounts/([^/]+)/Messages\.json$")
+
+
+def receipt_image() -> bytes:
+    """A small receipt-like JPEG for media messages"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (240, 320), "white")
+    draw = ImageDraw.Draw(image)
+    lines = ["CORNER MARKET", "", "Milk        3.49", "Bread       2.99"]
+    lines += ["Apples      4.20", "", "TOTAL      10.68"]
+    for index, line in enumerate(lines):
+        draw.text((20, 20 + index * 24), line, fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeTwilioServer:
+    """
+    Local stand-in for the Twilio REST API and media host, on a thread:
+    GET /media/<name> serves a receipt JPEG, POST .../Messages.json accepts
+    outbound messages (201 with a message resource, or an injected 429/503
+    at error_rate) and passes (to, body) to every on_message callback. The
+    "sent" and "delivered" statuses of accepted messages are posted to their
+    StatusCallback, if any.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: Optional[LatencyDistribution] = None,
+        error_rate: float = 0.0,
+    ):
+        self.latency = latency or LatencyDistribution()
+        self.error_rate = error_rate
+        self.rng = random.Random()
+        self.on_message: List[Callable[[str, str], None]] = []
+        self.media = {"receipt.jpg": ("image/jpeg", receipt_image())}
+        self.stats = {"messages": 0, "errors": 0, "media": 0, "callbacks": 0}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def media_url(self, name: str) -> str:
+        return f"{self.url}/media/{name}"
+
+    def start(self) -> "FakeTwilioServer":
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="fake-twilio", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _post_statuses(self, url: str, form: dict):
+        for status in ("sent", "delivered"):
+            time.sleep(self.latency.sample())
+            try:
+                urlopen(url, urlencode(dict(form, MessageStatus=status)).encode())
+                self._count("callbacks")
+            except Exception:
+                return
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(server.latency.sample())
+                name = urlparse(self.path).path.rpartition("/media/")[2]
+                if not self.path.startswith("/media/") or name not in server.media:
+                    return self.reply(404, "application/json", b'{"status": 404}')
+                server._count("media")
+                content_type, content = server.media[name]
+                self.reply(200, content_type, content)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                form = parse_qs(self.rfile.read(length).decode())
+                match = MESSAGES_PATH.match(urlparse(self.path).path)
+                if not match:
+                    return self.reply(404, "application/json", b'{"status": 404}')
+
+                time.sleep(server.latency.sample())
+                if server.rng.random() < server.error_rate:
+                    server._count("errors")
+                    status = server.rng.choice((429, 503))
+                    body = {"code": 20429 if status == 429 else 20503, "status": status}
+                    body["message"] = "Injected by the fake Twilio server"
+                    return self.reply(status, "application/json", json.dumps(body))
+
+                to = form.get("To", [""])[0].replace("whatsapp:", "")
+                text = form.get("Body", [""])[0]
+                sid = "SM" + uuid.uuid4().hex
+                server._count("messages")
+                for callback in server.on_message:
+                    callback(to, text)
+                if form.get("StatusCallback"):
+                    threading.Thread(
+                        target=server._post_statuses,
+                        args=(
+                            form["StatusCallback"][0],
+                            {"MessageSid": sid, "AccountSid": match.group(1)},
+                        ),
+                        daemon=True,
+                    ).start()
+                self.reply(
+                    201,
+                    "application/json",
+                    json.dumps(
+                        {
+                            "sid": sid,
+                            "account_sid": match.group(1),
+                            "to": form.get("To", [""])[0],
+                            "from": form.get("From", [""])[0],
+                            "body": text,
+                            "status": "queued",
+                            "num_media": str(len(form.get("MediaUrl", []))),
+                            "num_segments": "1",
+                            "direction": "outbound-api",
+                            "api_version": "2010-04-01",
+                        }
+                    ),
+                )
+
+            def reply(self, status: int, content_type: str, content):
+                if isinstance(content, str):
+                    content = content.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def create_client(account_sid: str, auth_token: str):
+    """
+    COPILOT_TWILIO_CLIENT_FACTORY: the real Twilio REST client, its
+    requests sent to the fake server at COPILOT_LOADTEST["twilio_url"]
+    """
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    base_url = getattr(settings, "COPILOT_LOADTEST", {}).get(
+        "twilio_url", "http://127.0.0.1:8765"
+    )
+
+    class FakeServerHttpClient(TwilioHttpClient):
+        def request(self, method, url, *args, **kwargs):
+            url = url.replace(TWILIO_API_URL, base_url.rstrip("/"), 1)
+            return super().request(method, url, *args, **kwargs)
+
+    return Client(
+        account_sid or "AC" + "0" * 32,
+        auth_token or "fake",
+        http_client=FakeServerHttpClient(),
+    )
@@ -0,0 +1,52 @@
+import math
+import random
+from typing import List, Optional
+
+
+class LatencyDistribution:
+    """
+    Simulated service latency in seconds, parsed from a spec:
+    "constant:<seconds>", "uniform:<low>,<high>", "normal:<mean>,<stddev>"
+    or "lognormal:<median>,<sigma>" (long-tailed, the usual shape of LLM
+    and HTTP API latencies). "0" or an empty spec means no latency.
+    """
+
+    KINDS = ("constant", "uniform", "normal", "lognormal")
+
+    def __init__(self, spec: Optional[str] = None, rng: Optional[random.Random] = None):
+        self.spec = spec or "constant:0"
+        self.rng = rng or random.Random()
+        kind, _, values = self.spec.partition(":")
+        if not values and kind not in self.KINDS:
+            kind, values = "constant", kind
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution: {self.spec}")
+        self.kind = kind
+        self.params = self._parse_params(values)
+
+    def _parse_params(self, values: str) -> List[float]:
+        try:
+            params = [float(value) for value in values.split(",") if value.strip()]
+        except ValueError:
+            raise ValueError(f"Invalid latency distribution: {self.spec}")
+        expected = 1 if self.kind == "constant" else 2
+        if len(params) != expected or any(param < 0 for param in params):
+            raise ValueError(
+                f"{self.kind} latency takes {expected} non-negative values: {self.spec}"
+            )
+        return params
+
+    def sample(self) -> float:
+        if self.kind == "constant":
+            return self.params[0]
+        first, second = self.params
+        if self.kind == "uniform":
+            return self.rng.uniform(first, second)
+        if self.kind == "normal":
+            return max(0.0, self.rng.gauss(first, second))
+        if first == 0:
+            return 0.0
+        return self.rng.lognormvariate(math.log(first), second)
+
+    def __repr__(self):
+        return f"LatencyDistribution({self.spec!r})"
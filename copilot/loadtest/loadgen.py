@@ -0,0 +1,324 @@
+import math
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import requests
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from copilot.loadtest.fake_twilio import FakeTwilioServer
+from copilot.loadtest.scenarios import Scenario
+
+STATUS_OK = "ok"
+STATUS_TIMEOUT = "timeout"
+STATUS_ERROR = "error"
+
+# Header telling the in-process webhook which intent a request belongs to,
+# so its DB queries can be attributed (see QueryCounter)
+INTENT_HEADER = "X-Loadtest-Intent"
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+class QueryCounter:
+    """
+    Counts the SQL queries of every DB connection of the process (a
+    connection_created hook adds it to each new connection's
+    execute_wrappers), per label set by the running thread
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def install(self):
+        connection_created.connect(self._connection_created)
+        for connection in connections.all(initialized_only=True):
+            self._add(connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self._connection_created)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def _connection_created(self, sender, connection, **kwargs):
+        self._add(connection)
+
+    def _add(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        label = getattr(self._local, "label", None)
+        with self._lock:
+            self.counts[label] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def label(self, label):
+        previous = getattr(self._local, "label", None)
+        self._local.label = label
+        try:
+            yield
+        finally:
+            self._local.label = previous
+
+
+@dataclass
+class Sample:
+    scenario: str
+    intent: str
+    status: str
+    webhook_seconds: float
+    end_to_end_seconds: Optional[float] = None
+    error: str = ""
+    inline: bool = False  # reply came in the webhook's TwiML response
+
+
+class LoadGenerator:
+    """
+    Closed-loop virtual users: each one posts a form-encoded WhatsApp
+    webhook payload of a weighted random scenario for its own number, waits
+    for the reply (inline in the webhook response, or reaching the fake
+    Twilio server within reply_timeout), pauses for think_time and sends the
+    next one, until `duration` is over
+    """
+
+    def __init__(
+        self,
+        webhook_url: str,
+        numbers: List[str],
+        scenarios: List[Scenario],
+        twilio_server: FakeTwilioServer,
+        to_number: str,
+        duration: float,
+        think_time: float = 0.0,
+        reply_timeout: float = 30.0,
+        seed: Optional[int] = None,
+    ):
+        self.webhook_url = webhook_url
+        self.numbers = numbers
+        self.scenarios = scenarios
+        self.twilio_server = twilio_server
+        self.to_number = to_number
+        self.duration = duration
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.rng = random.Random(seed)
+        # MessageSid -> intent of the scenario, for QueryCounter labels
+        self.intents: Dict[str, str] = {}
+        self.samples: List[Sample] = []
+        self.started = None
+        self.elapsed = None
+        self._replies = {number: queue.Queue() for number in numbers}
+        self._lock = threading.Lock()
+
+    def on_reply(self, to: str, body: str):
+        replies = self._replies.get(to)
+        if replies is not None:
+            replies.put((time.perf_counter(), body))
+
+    def payload(self, number: str, scenario: Scenario, rng: random.Random) -> dict:
+        """Form fields of a Twilio WhatsApp webhook for an inbound message"""
+        payload = {
+            "SmsMessageSid": None,
+            "NumMedia": "0",
+            "ProfileName": f"Load Test {number[-3:]}",
+            "MessageType": "text",
+            "SmsSid": None,
+            "WaId": number.lstrip("+"),
+            "SmsStatus": "received",
+            "Body": scenario.render(rng),
+            "To": f"whatsapp:{self.to_number}",
+            "NumSegments": "1",
+            "ReferralNumMedia": "0",
+            "MessageSid": None,
+            "AccountSid": "AC" + "0" * 32,
+            "From": f"whatsapp:{number}",
+            "ApiVersion": "2010-04-01",
+        }
+        payload["SmsMessageSid"] = payload["SmsSid"] = payload["MessageSid"] = (
+            "SM" + uuid.uuid4().hex
+        )
+        if scenario.media:
+            content_type = self.twilio_server.media[scenario.media][0]
+            payload.update(
+                NumMedia="1",
+                MessageType=content_type.partition("/")[0],
+                MediaUrl0=self.twilio_server.media_url(scenario.media),
+                MediaContentType0=content_type,
+            )
+        return payload
+
+    def run(self) -> List[Sample]:
+        self.twilio_server.on_message.append(self.on_reply)
+        self.started = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=self._user_loop,
+                args=(number, self.rng.random()),
+                name=f"virtual-user-{index}",
+                daemon=True,
+            )
+            for index, number in enumerate(self.numbers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        self.twilio_server.on_message.remove(self.on_reply)
+        return self.samples
+
+    def _user_loop(self, number: str, seed: float):
+        rng = random.Random(seed)
+        session = requests.Session()
+        weights = [scenario.weight for scenario in self.scenarios]
+        replies = self._replies[number]
+        deadline = self.started + self.duration
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(self.scenarios, weights)[0]
+            payload = self.payload(number, scenario, rng)
+            self.intents[payload["MessageSid"]] = scenario.intent
+            # Late replies of timed out messages must not count for this one
+            while not replies.empty():
+                replies.get_nowait()
+
+            sent = time.perf_counter()
+            try:
+                response = session.post(
+                    self.webhook_url,
+                    data=payload,
+                    headers={INTENT_HEADER: scenario.intent},
+                    timeout=self.reply_timeout,
+                )
+                webhook_seconds = time.perf_counter() - sent
+                response.raise_for_status()
+            except Exception as e:
+                self._record(
+                    Sample(
+                        scenario.name,
+                        scenario.intent,
+                        STATUS_ERROR,
+                        time.perf_counter() - sent,
+                        error=str(e),
+                    )
+                )
+                time.sleep(max(self.think_time, 0.1))
+                continue
+
+            if "<Message>" in response.text:
+                sample = Sample(
+                    scenario.name,
+                    scenario.intent,
+                    STATUS_OK,
+                    webhook_seconds,
+                    webhook_seconds,
+                    inline=True,
+                )
+            else:
+                sample = self._wait_for_reply(scenario, replies, sent, webhook_seconds)
+            self._record(sample)
+            if self.think_time:
+                time.sleep(rng.expovariate(1 / self.think_time))
+
+    def _wait_for_reply(
+        self, scenario: Scenario, replies: queue.Queue, sent: float, webhook_seconds
+    ) -> Sample:
+        """Sample of a message answered over REST, once its reply arrives"""
+        try:
+            received, _ = replies.get(timeout=self.reply_timeout)
+        except queue.Empty:
+            return Sample(
+                scenario.name, scenario.intent, STATUS_TIMEOUT, webhook_seconds
+            )
+        return Sample(
+            scenario.name, scenario.intent, STATUS_OK, webhook_seconds, received - sent
+        )
+
+    def _record(self, sample: Sample):
+        with self._lock:
+            self.samples.append(sample)
+
+
+def build_report(
+    generator: LoadGenerator,
+    query_counts: Optional[Dict] = None,
+    extra: Optional[dict] = None,
+) -> dict:
+    """
+    Throughput, webhook and end-to-end latency percentiles (ms) and DB
+    queries per message, overall and per intent
+    """
+
+    def summarize(samples: List[Sample], intent=None) -> dict:
+        webhook = [sample.webhook_seconds * 1000 for sample in samples]
+        end_to_end = [
+            sample.end_to_end_seconds * 1000
+            for sample in samples
+            if sample.end_to_end_seconds is not None
+        ]
+        summary = {
+            "messages": len(samples),
+            "ok": sum(1 for sample in samples if sample.status == STATUS_OK),
+            "timeouts": sum(1 for sample in samples if sample.status == STATUS_TIMEOUT),
+            "errors": sum(1 for sample in samples if sample.status == STATUS_ERROR),
+            "inline": sum(1 for sample in samples if sample.inline),
+        }
+        for name, values in (("webhook_ms", webhook), ("end_to_end_ms", end_to_end)):
+            summary[name] = {
+                f"p{pct}": (round(percentile(values, pct), 1) if values else None)
+                for pct in (50, 95, 99)
+            }
+        if query_counts is not None:
+            queries = sum(
+                count
+                for (phase, label_intent), count in _labelled(query_counts)
+                if intent is None or label_intent == intent
+            )
+            summary["db_queries_per_message"] = (
+                round(queries / len(samples), 1) if samples else None
+            )
+        return summary
+
+    by_intent = defaultdict(list)
+    for sample in generator.samples:
+        by_intent[sample.intent].append(sample)
+
+    report = {
+        "users": len(generator.numbers),
+        "duration_seconds": round(generator.elapsed or 0, 1),
+        "throughput_per_second": round(
+            len(generator.samples) / generator.elapsed if generator.elapsed else 0, 2
+        ),
+        "total": summarize(generator.samples),
+        "intents": {
+            intent: summarize(samples, intent)
+            for intent, samples in sorted(by_intent.items())
+        },
+    }
+    if query_counts is not None:
+        report["db_queries_unattributed"] = query_counts.get(None, 0)
+    report.update(extra or {})
+    return report
+
+
+def _labelled(query_counts: Dict):
+    """(phase, intent) labelled query counts, leaving out unlabelled ones"""
+    return [(label, count) for label, count in query_counts.items() if label]
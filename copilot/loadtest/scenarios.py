@@ -0,0 +1,216 @@
+import json
+import random
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Dict, List, Optional
+
+from copilot.constants import PROMPT_CLASSIFY_MESSAGE
+
+# Markers of the GeminiService prompts the scenario rules answer
+CLASSIFY_AND_EXTRACT = '{"intent": <intent>'
+CLASSIFY = PROMPT_CLASSIFY_MESSAGE.strip().splitlines()[0][:60]
+MISCELLANEOUS = "Answer the miscellaneous query"
+ANALYTICAL = "Answer the analytical query"
+MULTIPLE_TRANSACTIONS = "Extract all transactions"
+
+
+@dataclass
+class Scenario:
+    """
+    A kind of message virtual users send. `body` is a str.format template
+    ({amount}, {item}) so bodies vary like real traffic while `marker`, a
+    fixed part of it, keys the canned Gemini responses
+    """
+
+    name: str
+    intent: str
+    body: str
+    marker: str
+    weight: float = 1.0
+    media: Optional[str] = None  # name of a fake Twilio media file
+    payload: Optional[dict] = None  # classify_and_extract payload
+    answer: Optional[str] = None  # answer of a free-text prompt
+    answer_prompt: Optional[str] = None
+    extra_rules: List[dict] = field(default_factory=list)
+
+    def render(self, rng: random.Random) -> str:
+        return self.body.format(
+            amount=f"{rng.uniform(2, 80):.2f}",
+            item=rng.choice(("lunch", "groceries", "a cab", "coffee", "books")),
+        )
+
+    def gemini_rules(self) -> List[dict]:
+        rules = list(self.extra_rules)
+        rules.append(
+            {
+                "name": f"{self.name}: classify_and_extract",
+                "contains": [CLASSIFY_AND_EXTRACT, self.marker],
+                "text": json.dumps(
+                    {"intent": self.intent, "payload": self.payload or {}}
+                ),
+            }
+        )
+        rules.append(
+            {
+                "name": f"{self.name}: identify_intent",
+                "contains": [CLASSIFY, self.marker],
+                "text": self.intent,
+            }
+        )
+        if self.answer:
+            rules.append(
+                {
+                    "name": f"{self.name}: answer",
+                    "contains": [self.answer_prompt, self.marker],
+                    "text": self.answer,
+                }
+            )
+        return rules
+
+
+def transaction(today: date, **fields) -> dict:
+    return dict({"day": today.day, "month": today.month, "year": today.year}, **fields)
+
+
+def receipt_payload(today: date) -> dict:
+    return {
+        "transactions": [
+            transaction(
+                today,
+                type="expense",
+                category="shopping",
+                amount=amount,
+                description=description,
+            )
+            for description, amount in (
+                ("milk", 3.49),
+                ("bread", 2.99),
+                ("apples", 4.2),
+            )
+        ]
+    }
+
+
+def default_scenarios(today: Optional[date] = None) -> List[Scenario]:
+    """The message mix of a typical day, by weight"""
+    today = today or date.today()
+    return [
+        Scenario(
+            name="create_local",
+            intent="CREATE_TRANSACTION",
+            body="Spent ${amount} on {item} today",
+            marker="Spent $",
+            weight=4,
+            payload=transaction(
+                today,
+                type="expense",
+                category="dining",
+                amount=12.5,
+                description="lunch",
+            ),
+        ),
+        Scenario(
+            name="create",
+            intent="CREATE_TRANSACTION",
+            body="grabbed {item} with Sam, it came to {amount}",
+            marker="with Sam",
+            weight=3,
+            payload=transaction(
+                today,
+                type="expense",
+                category="dining",
+                amount=18.4,
+                description="coffee with Sam",
+            ),
+        ),
+        Scenario(
+            name="update",
+            intent="UPDATE_TRANSACTION",
+            body="change the coffee one to {amount}",
+            marker="change the coffee one",
+            weight=1,
+            payload={
+                "search": {"description": ["coffee"]},
+                "updates": {"amount": 5.25},
+            },
+        ),
+        Scenario(
+            name="delete",
+            intent="DELETE_TRANSACTION",
+            body="remove the cab ride I added",
+            marker="remove the cab ride",
+            weight=1,
+            payload={"search": {"description": ["cab", "taxi"]}, "updates": {}},
+        ),
+        Scenario(
+            name="analytics",
+            intent="ANALYTICS_REQUEST",
+            body="how much did I spend on dining this month?",
+            marker="spend on dining this month",
+            weight=2,
+            # The analytical prompt carries a digest instead of the message
+            extra_rules=[
+                {
+                    "name": "analytics: answer",
+                    "contains": [ANALYTICAL],
+                    "text": "You spent $212.40 on dining this month, 18% more than last month.",
+                }
+            ],
+        ),
+        Scenario(
+            name="receipt",
+            intent="MULTIPLE_TRANSACTIONS",
+            body="",
+            marker="",
+            weight=1,
+            media="receipt.jpg",
+            payload=receipt_payload(today),
+            # Two-call mode extracts the items in the intent handler
+            extra_rules=[
+                {
+                    "name": "receipt: extract_multiple_transactions",
+                    "contains": [MULTIPLE_TRANSACTIONS],
+                    "text": json.dumps(receipt_payload(today)),
+                }
+            ],
+        ),
+        Scenario(
+            name="other",
+            intent="OTHER",
+            body="should I pay off my credit card before investing?",
+            marker="pay off my credit card",
+            weight=2,
+            answer="Usually yes: card interest is higher than typical investment returns.",
+            answer_prompt=MISCELLANEOUS,
+        ),
+    ]
+
+
+def scenario_rules(scenarios: Optional[List[Scenario]] = None) -> List[dict]:
+    """Canned Gemini responses of the scenarios, media-only ones last"""
+    scenarios = scenarios or default_scenarios()
+    ordered = sorted(scenarios, key=lambda scenario: not scenario.marker)
+    return [rule for scenario in ordered for rule in scenario.gemini_rules()]
+
+
+def parse_mix(mix: Optional[str], scenarios: List[Scenario]) -> List[Scenario]:
+    """
+    Apply a "name=weight,..." mix; scenarios it leaves out are dropped
+    Raises ValueError for unknown names or invalid weights
+    """
+    if not mix:
+        return scenarios
+    by_name: Dict[str, Scenario] = {scenario.name: scenario for scenario in scenarios}
+    selected = []
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in by_name:
+            raise ValueError(
+                f"Unknown scenario {name!r}, expected one of {', '.join(by_name)}"
+            )
+        scenario = by_name[name]
+        scenario.weight = float(weight) if weight else 1.0
+        if scenario.weight < 0:
+            raise ValueError(f"Negative weight for scenario {name!r}")
+        selected.append(scenario)
+    return selected
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+
+from copilot.models import Transaction
+from copilot.services.date_ranges import transaction_date
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the date column of transactions saved before it existed from "
+        "their year/month/day (run once after migrating, safe to re-run)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family", action="append", default=[], help="Only these familyIds"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="Rows per bulk_update"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Count the rows, change nothing"
+        )
+
+    def handle(self, *args, **options):
+        transactions = (
+            Transaction.objects.filter(date=None)
+            .exclude(year=None)
+            .exclude(month=None)
+            .only("id", "year", "month", "day")
+        )
+        if options["family"]:
+            transactions = transactions.filter(familyId__in=options["family"])
+
+        filled = skipped = 0
+        last_pk = 0
+        while True:
+            # Keyset batches rather than a cursor over the rows being updated
+            batch = list(
+                transactions.filter(pk__gt=last_pk).order_by("pk")[
+                    : options["batch_size"]
+                ]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            dated = []
+            for transaction in batch:
+                transaction.date = transaction_date(
+                    transaction.year, transaction.month, transaction.day
+                )
+                if transaction.date is None:
+                    skipped += 1
+                else:
+                    dated.append(transaction)
+            filled += self.flush(dated, options["dry_run"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Would fill' if options['dry_run'] else 'Filled'} the date of "
+                f"{filled} transactions, {skipped} have an invalid year/month"
+            )
+        )
+
+    def flush(self, batch, dry_run):
+        # bulk_update skips Transaction.save, which would touch the summaries
+        if batch and not dry_run:
+            Transaction.objects.bulk_update(batch, ["date"])
+        return len(batch)
@@ -0,0 +1,112 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cold-start import time of the app in fresh interpreters "
+        "(python -X importtime) to track worker startup regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--module",
+            action="append",
+            help="Module to import after django.setup() (default: copilot.views)",
+        )
+        parser.add_argument("--runs", type=int, default=3, help="Interpreters to start")
+        parser.add_argument("--top", type=int, default=15, help="Modules to list")
+        parser.add_argument("--json", action="store_true", help="Print a JSON report")
+        parser.add_argument(
+            "--max-ms",
+            type=float,
+            help="Fail if the median startup time exceeds this many milliseconds",
+        )
+
+    def handle(self, *args, **options):
+        modules = options["module"] or ["copilot.views"]
+        code = "import django; django.setup()\n" + "".join(
+            f"import {module}\n" for module in modules
+        )
+
+        wall_times = []
+        imports = {}
+        for _ in range(options["runs"]):
+            started = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", code],
+                capture_output=True,
+                text=True,
+                env=os.environ.copy(),
+            )
+            wall_times.append((time.perf_counter() - started) * 1000)
+            if result.returncode != 0:
+                raise CommandError(f"Import failed:\n{result.stderr[-2000:]}")
+            # Keep the last run, the OS file cache is warm by then
+            imports = self.parse_importtime(result.stderr)
+
+        report = {
+            "modules": modules,
+            "runs": options["runs"],
+            "wall_ms_median": round(statistics.median(wall_times), 1),
+            "wall_ms": [round(value, 1) for value in wall_times],
+            "import_ms_total": round(
+                sum(self_us for self_us, _ in imports.values()) / 1000, 1
+            ),
+            "top_cumulative": self.top(imports, 1, options["top"]),
+            "top_self": self.top(imports, 0, options["top"]),
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+        if options["max_ms"] and report["wall_ms_median"] > options["max_ms"]:
+            raise CommandError(
+                f"Startup took {report['wall_ms_median']} ms, "
+                f"more than the {options['max_ms']} ms budget"
+            )
+
+    def parse_importtime(self, stderr):
+        """{module: (self_us, cumulative_us)} from -X importtime output"""
+        imports = {}
+        for line in stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+        return imports
+
+    def top(self, imports, index, count):
+        ranked = sorted(imports.items(), key=lambda item: item[1][index], reverse=True)
+        return [
+            {
+                "module": module,
+                "self_ms": times[0] / 1000,
+                "cumulative_ms": times[1] / 1000,
+            }
+            for module, times in ranked[:count]
+        ]
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"Startup ({', '.join(report['modules'])}): median "
+            f"{report['wall_ms_median']} ms over {report['runs']} runs, "
+            f"{report['import_ms_total']} ms in imports"
+        )
+        for title, key, column in (
+            ("Slowest imports (cumulative)", "top_cumulative", "cumulative_ms"),
+            ("Slowest imports (self)", "top_self", "self_ms"),
+        ):
+            self.stdout.write(f"\n{title}:")
+            for entry in report[key]:
+                self.stdout.write(f"  {entry[column]:9.1f} ms  {entry['module']}")
@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from copilot.models import User
+from copilot.services.statement_import import (
+    CSV_COLUMNS,
+    StatementError,
+    detect_format,
+    import_statement,
+)
+
+
+def _init_worker():
+    # Spawned workers start without Django, forked ones must not reuse the
+    # parent's database connections
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Import bank/card statements (CSV, OFX, QIF) for a user: files are "
+        "stream-parsed in parallel worker processes and inserted with chunked "
+        "bulk_create, one transaction per file, skipping lines imported before; "
+        "the family summary and description index are rebuilt once at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files", nargs="+", help="Statement files (.csv, .ofx, .qif)"
+        )
+        parser.add_argument(
+            "--number", required=True, help="WhatsApp number of the user to import for"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000, help="Rows per bulk_create"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Files parsed in parallel"
+        )
+        parser.add_argument(
+            "--column",
+            action="append",
+            default=[],
+            metavar="FIELD=HEADER",
+            help=f"CSV column of a field ({', '.join(CSV_COLUMNS)})",
+        )
+        parser.add_argument("--date-format", help="strptime format of the dates")
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Parse and count, insert nothing"
+        )
+
+    def handle(self, *args, **options):
+        # Users are stored under the bare number (see parse_incoming_message)
+        number = options["number"].replace("whatsapp:", "")
+        user = User.objects.filter(number=number).first()
+        if user is None:
+            raise CommandError(f"No user with number {number}")
+
+        columns = {}
+        for mapping in options["column"]:
+            field, _, header = mapping.partition("=")
+            if field not in CSV_COLUMNS or not header:
+                raise CommandError(f"Invalid --column {mapping!r}")
+            columns[field] = header
+
+        try:
+            for path in options["files"]:
+                detect_format(path)
+        except StatementError as e:
+            raise CommandError(str(e))
+
+        jobs = [
+            dict(
+                path=path,
+                family_id=user.familyId,
+                user_id=user.userId,
+                chunk_size=options["chunk_size"],
+                columns=columns,
+                date_format=options["date_format"],
+                dry_run=options["dry_run"],
+            )
+            for path in options["files"]
+        ]
+
+        started = time.perf_counter()
+        total = 0
+        failed = []
+        for path, result, error in self.run(jobs, options["workers"]):
+            if error:
+                failed.append(path)
+                self.stderr.write(f"{path}: {error}")
+                continue
+            total += result["rows"]
+            self.stdout.write(
+                f"{path}: {result['rows']} rows in {result['seconds']:.1f}s "
+                f"({result['rows'] / max(result['seconds'], 1e-6):.0f} rows/s), "
+                f"{result['skipped']} already imported"
+            )
+
+        if total and not options["dry_run"]:
+            call_command(
+                "rebuild_summaries", family=[user.familyId], stdout=self.stdout
+            )
+            call_command(
+                "rebuild_description_index",
+                family=[user.familyId],
+                stdout=self.stdout,
+            )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Parsed' if options['dry_run'] else 'Imported'} {total} rows from "
+                f"{len(jobs) - len(failed)} files in {elapsed:.1f}s "
+                f"({total / max(elapsed, 1e-6):.0f} rows/s)"
+            )
+        )
+        if failed:
+            raise CommandError(f"{len(failed)} files failed: {', '.join(failed)}")
+
+    def run(self, jobs, workers):
+        """Yields (path, result, error) per file as they finish"""
+        if workers <= 1 or len(jobs) == 1:
+            for job in jobs:
+                try:
+                    yield job["path"], import_statement(**job), None
+                except Exception as e:
+                    yield job["path"], None, str(e)
+            return
+
+        # Children must open their own connections
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)), initializer=_init_worker
+        ) as executor:
+            futures = {executor.submit(import_statement, **job): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future]["path"], future.result(), None
+                except Exception as e:
+                    yield futures[future]["path"], None, str(e)
@@ -0,0 +1,437 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+from datetime import date, timedelta
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from copilot.loadtest.fake_twilio import FakeTwilioServer
+from copilot.loadtest.latency import LatencyDistribution
+from copilot.loadtest.loadgen import (
+    INTENT_HEADER,
+    LoadGenerator,
+    QueryCounter,
+    build_report,
+)
+from copilot.loadtest.scenarios import default_scenarios, parse_mix
+
+# Load test users are +1555010xxxx, a range reserved for fictional numbers
+NUMBER_PREFIX = "+1555010"
+
+# Settings of the in-process run, applied before copilot.views is imported:
+# fake clients, no burst coalescing and no rate limits so the measured
+# latency is the pipeline's own, and workers that poll without sleeping long
+IN_PROCESS_SETTINGS = {
+    "COPILOT_GEMINI_CLIENT_FACTORY": "copilot.loadtest.fake_gemini.create_client",
+    "COPILOT_TWILIO_CLIENT_FACTORY": "copilot.loadtest.fake_twilio.create_client",
+    "COPILOT_DEBOUNCE_WINDOW": 0,
+    "COPILOT_SENDER_RATE_PER_MINUTE": 10**6,
+    "COPILOT_SENDER_BURST": 10**6,
+    "COPILOT_GLOBAL_RATE_PER_MINUTE": 10**6,
+    "COPILOT_GLOBAL_BURST": 10**6,
+    # The webhook and the workers share this process and its LocMemCache
+    "COPILOT_INLINE_REPLY_SAME_PROCESS": True,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Offline end-to-end load test: replay WhatsApp webhook payloads from "
+        "closed-loop virtual users against whatsapp_webhook, with fake Gemini "
+        "and Twilio, and report throughput, latency per intent and DB queries"
+    )
+    # The URL checks import copilot.views, which must see IN_PROCESS_SETTINGS
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10, help="Virtual users")
+        parser.add_argument(
+            "--duration", type=float, default=30, help="Seconds to send messages for"
+        )
+        parser.add_argument(
+            "--think-time",
+            type=float,
+            default=0,
+            help="Mean seconds a virtual user waits between a reply and its next message",
+        )
+        parser.add_argument(
+            "--reply-timeout",
+            type=float,
+            default=30,
+            help="Seconds to wait for a reply before counting a timeout",
+        )
+        parser.add_argument(
+            "--mix",
+            help="Scenario weights, e.g. create=3,analytics=1,receipt=1 "
+            "(default: every scenario with its default weight)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "COPILOT_WORKER_CONCURRENCY", 4),
+            help="Message worker threads of the in-process run",
+        )
+        parser.add_argument(
+            "--gemini-latency",
+            help='Fake Gemini latency, e.g. "constant:0.5", "uniform:0.2,1" or '
+            '"lognormal:0.8,0.4" (median, sigma)',
+        )
+        parser.add_argument(
+            "--gemini-error-rate", type=float, help="Share of Gemini calls failing"
+        )
+        parser.add_argument(
+            "--gemini-responses",
+            help="JSON(-lines) file of recorded Gemini responses to replay first",
+        )
+        parser.add_argument(
+            "--twilio-latency",
+            default="lognormal:0.08,0.3",
+            help="Fake Twilio REST and media latency",
+        )
+        parser.add_argument(
+            "--twilio-error-rate",
+            type=float,
+            default=0,
+            help="Share of outbound sends failing with 429/503",
+        )
+        parser.add_argument(
+            "--twilio-port",
+            type=int,
+            help="Port of the fake Twilio server (default: any free port, or the "
+            'port of COPILOT_LOADTEST["twilio_url"] with --url)',
+        )
+        parser.add_argument(
+            "--url",
+            help="Webhook URL of an already running server (started with the fake "
+            "client factories and COPILOT_LOADTEST pointing at this command's fake "
+            "Twilio server) instead of an in-process server and workers",
+        )
+        parser.add_argument("--seed", type=int, help="Random seed of the traffic")
+        parser.add_argument(
+            "--keep-data",
+            action="store_true",
+            help="Keep the load test users and their data afterwards",
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            help="Show the application's log during the run",
+        )
+        parser.add_argument("--json", action="store_true", help="Print a JSON report")
+        parser.add_argument(
+            "--max-p95-ms",
+            type=float,
+            help="Fail if the end-to-end p95 latency exceeds this many milliseconds",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            scenarios = parse_mix(options["mix"], default_scenarios())
+            twilio_latency = LatencyDistribution(options["twilio_latency"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["users"] < 1:
+            raise CommandError("--users must be at least 1")
+
+        twilio_port = options["twilio_port"]
+        if twilio_port is None and options["url"]:
+            twilio_port = urlparse(settings.COPILOT_LOADTEST["twilio_url"]).port
+        twilio_server = FakeTwilioServer(
+            port=twilio_port or 0,
+            latency=twilio_latency,
+            error_rate=options["twilio_error_rate"],
+        ).start()
+
+        numbers = [f"{NUMBER_PREFIX}{index:04d}" for index in range(options["users"])]
+        self.create_users(numbers)
+
+        counter = None
+        server = stop_event = workers = None
+        try:
+            if options["url"]:
+                webhook_url = options["url"]
+            else:
+                self.configure(options, twilio_server)
+                counter = QueryCounter()
+                counter.install()
+                server, webhook_url = self.start_server(counter)
+                settings.COPILOT_TWILIO_STATUS_CALLBACK_URL = webhook_url + "/status"
+
+            generator = LoadGenerator(
+                webhook_url,
+                numbers,
+                scenarios,
+                twilio_server,
+                to_number=os.getenv("TWILIO_WHATSAPP_NUMBER") or "+15550000000",
+                duration=options["duration"],
+                think_time=options["think_time"],
+                reply_timeout=options["reply_timeout"],
+                seed=options["seed"],
+            )
+            if not options["url"]:
+                stop_event, workers = self.start_workers(
+                    options["workers"], counter, generator
+                )
+
+            self.stdout.write(
+                f"Running {options['users']} virtual users for "
+                f"{options['duration']}s against {webhook_url}"
+            )
+            # The app logs every message it handles, keep it off the report
+            copilot_logger = logging.getLogger("copilot")
+            level = copilot_logger.level
+            if not options["verbose"]:
+                copilot_logger.setLevel(logging.ERROR)
+            try:
+                generator.run()
+            finally:
+                copilot_logger.setLevel(level)
+        finally:
+            if stop_event is not None:
+                stop_event.set()
+                for thread in workers:
+                    thread.join()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if counter is not None:
+                counter.uninstall()
+            twilio_server.stop()
+            if not options["keep_data"]:
+                self.delete_users(numbers)
+
+        report = build_report(
+            generator,
+            dict(counter.counts) if counter else None,
+            extra={
+                "gemini": self.gemini_stats() if not options["url"] else None,
+                "twilio": dict(twilio_server.stats),
+                "stage_mean_ms": self.stage_means() if not options["url"] else None,
+            },
+        )
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+        p95 = report["total"]["end_to_end_ms"]["p95"]
+        if options["max_p95_ms"] and (p95 is None or p95 > options["max_p95_ms"]):
+            raise CommandError(
+                f"End-to-end p95 latency was {p95} ms, more than the "
+                f"{options['max_p95_ms']} ms budget"
+            )
+
+    def configure(self, options, twilio_server):
+        """Point the in-process app at the fakes; must run before views is imported"""
+        if "copilot.views" in sys.modules:
+            raise CommandError(
+                "copilot.views is already imported, run the in-process load test "
+                "in a fresh process (or use --url)"
+            )
+        for name, value in IN_PROCESS_SETTINGS.items():
+            setattr(settings, name, value)
+        loadtest = dict(getattr(settings, "COPILOT_LOADTEST", {}))
+        loadtest["twilio_url"] = twilio_server.url
+        for option in ("gemini_latency", "gemini_error_rate", "gemini_responses"):
+            if options[option] is not None:
+                loadtest[option] = options[option]
+        settings.COPILOT_LOADTEST = loadtest
+        settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ["127.0.0.1"]
+
+    def start_server(self, counter: QueryCounter):
+        """Threaded WSGI server of the app on a free local port"""
+        from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+        from django.core.wsgi import get_wsgi_application
+
+        application = get_wsgi_application()
+        header = "HTTP_" + INTENT_HEADER.upper().replace("-", "_")
+
+        def counted_application(environ, start_response):
+            # Status callbacks carry no intent and are left unattributed
+            label = ("webhook", environ[header]) if header in environ else None
+            with counter.label(label):
+                return application(environ, start_response)
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadedWSGIServer(("127.0.0.1", 0), QuietRequestHandler)
+        server.set_app(counted_application)
+        threading.Thread(
+            target=server.serve_forever, name="loadtest-wsgi", daemon=True
+        ).start()
+        host, port = server.server_address[:2]
+        return server, f"http://{host}:{port}/whatsapp"
+
+    def start_workers(self, concurrency, counter: QueryCounter, generator):
+        """Message and outbound worker pools of the app in background threads"""
+        from copilot.models import OutboundMessage
+        from copilot.services.job_queue import run_worker_pool
+        from copilot.services.outbound import outbound_queue, send_outbound_job
+        from copilot.views import message_queue, process_message_job
+
+        def handler(job):
+            with counter.label(("worker", generator.intents.get(job.message_sid))):
+                process_message_job(job)
+
+        def outbound_handler(job: OutboundMessage):
+            with counter.label(("outbound", generator.intents.get(job.reply_to))):
+                send_outbound_job(job)
+
+        stop_event = threading.Event()
+        threads = [
+            threading.Thread(
+                target=run_worker_pool,
+                args=(queue, pool_handler, concurrency, stop_event, 0.05),
+                name=name,
+                daemon=True,
+            )
+            for name, queue, pool_handler in (
+                ("loadtest-workers", message_queue, handler),
+                ("loadtest-outbound", outbound_queue, outbound_handler),
+            )
+        ]
+        for thread in threads:
+            thread.start()
+        return stop_event, threads
+
+    def create_users(self, numbers):
+        """Register the virtual users, each with a few transactions to work on"""
+        from copilot.models import Transaction, User
+
+        rng = random.Random(0)
+        transactions = []
+        for index, number in enumerate(numbers):
+            user, created = User.objects.get_or_create(
+                number=number, defaults={"name": f"Load Test {index}"}
+            )
+            if not created:
+                continue
+            for days, description, category, amount in (
+                (1, "coffee at Blue Bottle", "dining", 4.75),
+                (2, "cab ride home", "transport", 23.1),
+                (3, "weekly groceries", "shopping", 86.4),
+                (9, "phone bill", "bills", 45.0),
+            ):
+                day = date.today() - timedelta(days=days)
+                transactions.append(
+                    Transaction(
+                        familyId=user.familyId,
+                        userId=str(user.userId),
+                        type="expense",
+                        category=category,
+                        amount=round(amount * rng.uniform(0.8, 1.2), 2),
+                        description=description,
+                        year=day.year,
+                        month=day.month,
+                        day=day.day,
+                    )
+                )
+        Transaction.objects.bulk_create_with_summaries(transactions)
+
+    def delete_users(self, numbers):
+        """Remove the virtual users and everything the run stored for them"""
+        from copilot.models import (
+            ChatMessage,
+            DescriptionNgram,
+            MessageJob,
+            OutboundMessage,
+            Transaction,
+            TransactionSummary,
+            User,
+        )
+
+        users = list(User.objects.filter(number__in=numbers))
+        family_ids = [user.familyId for user in users]
+        ChatMessage.objects.filter(
+            userId__in=[str(user.userId) for user in users]
+        ).delete()
+        MessageJob.objects.filter(sender__in=numbers).delete()
+        OutboundMessage.objects.filter(to__in=numbers).delete()
+        Transaction.objects.filter(familyId__in=family_ids).delete()
+        DescriptionNgram.objects.filter(familyId__in=family_ids).delete()
+        TransactionSummary.objects.filter(familyId__in=family_ids).delete()
+        for user in users:
+            user.delete()
+
+    def stage_means(self):
+        """Mean time per pipeline stage of the handled messages, per intent"""
+        from copilot.services.metrics import registry
+
+        stages = {}
+        for key, histogram in registry.series("copilot_stage_seconds").items():
+            labels = dict(key)
+            if labels["kind"] != "worker" or not histogram.count:
+                continue
+            stages.setdefault(labels["intent"], {})[labels["stage"]] = round(
+                histogram.sum / histogram.count * 1000, 1
+            )
+        return {intent: stages[intent] for intent in sorted(stages)}
+
+    def gemini_stats(self):
+        from copilot.services.gemini_api import get_gemini_service
+
+        gemini_service = get_gemini_service()
+        models = gemini_service.client.models
+        return {
+            "calls": models.stats.calls,
+            "errors_injected": models.stats.errors,
+            "by_rule": models.stats.by_rule,
+            "response_cache": gemini_service.response_cache.stats(),
+        }
+
+    def print_report(self, report):
+        total = report["total"]
+        self.stdout.write(
+            f"\n{total['messages']} messages from {report['users']} users in "
+            f"{report['duration_seconds']}s: {report['throughput_per_second']} msg/s, "
+            f"{total['timeouts']} timeouts, {total['errors']} errors, "
+            f"{total['inline']} replies inline"
+        )
+        self.stdout.write(
+            f"\n{'intent':<24}{'msgs':>6}{'ok':>6}"
+            f"{'webhook p50/p95/p99 ms':>26}{'end-to-end p50/p95/p99 ms':>29}"
+            f"{'db q/msg':>10}"
+        )
+        for intent, summary in list(report["intents"].items()) + [("total", total)]:
+            self.stdout.write(
+                f"{intent:<24}{summary['messages']:>6}{summary['ok']:>6}"
+                f"{self.percentiles(summary['webhook_ms']):>26}"
+                f"{self.percentiles(summary['end_to_end_ms']):>29}"
+                f"{self.value(summary.get('db_queries_per_message')):>10}"
+            )
+        if report.get("stage_mean_ms"):
+            self.stdout.write("\nMean stage time (ms):")
+            for intent, stages in report["stage_mean_ms"].items():
+                self.stdout.write(
+                    f"  {intent:<22}"
+                    + "  ".join(f"{stage} {ms:g}" for stage, ms in stages.items())
+                )
+        if "db_queries_unattributed" in report:
+            self.stdout.write(
+                f"\nDB queries outside messages (job claims, polling): "
+                f"{report['db_queries_unattributed']}"
+            )
+        if report["gemini"]:
+            self.stdout.write(
+                f"Gemini: {report['gemini']['calls']} calls, "
+                f"{report['gemini']['errors_injected']} injected errors"
+            )
+        twilio = report["twilio"]
+        self.stdout.write(
+            f"Twilio: {twilio['messages']} messages sent, {twilio['errors']} "
+            f"injected errors, {twilio['media']} media downloads, "
+            f"{twilio['callbacks']} status callbacks"
+        )
+
+    def percentiles(self, values):
+        return "/".join(self.value(values[f"p{pct}"]) for pct in (50, 95, 99))
+
+    def value(self, value):
+        return "-" if value is None else f"{value:g}"
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from copilot.models import DescriptionNgram, Transaction
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the DescriptionNgram index of fuzzy description search, e.g. "
+        "after statement imports or for transactions saved before it existed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family", action="append", default=[], help="Only these familyIds"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="Transactions per batch"
+        )
+
+    def handle(self, *args, **options):
+        transactions = Transaction.objects.only("id", "familyId", "description")
+        ngrams = DescriptionNgram.objects.all()
+        if options["family"]:
+            transactions = transactions.filter(familyId__in=options["family"])
+            ngrams = ngrams.filter(familyId__in=options["family"])
+
+        with db_transaction.atomic():
+            ngrams.delete()
+            count = 0
+            batch = []
+            for transaction in transactions.order_by("pk").iterator(
+                chunk_size=options["batch_size"]
+            ):
+                batch.append(transaction)
+                if len(batch) >= options["batch_size"]:
+                    DescriptionNgram.objects.index(batch, replace=False)
+                    count += len(batch)
+                    batch = []
+            DescriptionNgram.objects.index(batch, replace=False)
+            count += len(batch)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Indexed the descriptions of {count} transactions")
+        )
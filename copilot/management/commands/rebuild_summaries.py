@@ -0,0 +1,85 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+
+from copilot.datamodels.summary import YearlySummary
+from copilot.models import Transaction, TransactionSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or with --verify, check) the TransactionSummary rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family", action="append", default=[], help="Only these familyIds"
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Report summaries that differ from the transactions, change nothing",
+        )
+
+    def handle(self, *args, **options):
+        expected = self.compute_summaries(options["family"])
+        stored = TransactionSummary.objects.all()
+        if options["family"]:
+            stored = stored.filter(familyId__in=options["family"])
+        stored = {summary.familyId: summary for summary in stored}
+
+        mismatched = [
+            family_id
+            for family_id in set(expected) | set(stored)
+            if self.to_dict(stored.get(family_id))
+            != expected.get(family_id, YearlySummary()).to_dict()
+        ]
+
+        if options["verify"]:
+            for family_id in sorted(mismatched):
+                self.stdout.write(f"Summary of family {family_id} is out of date")
+            if mismatched:
+                raise CommandError(f"{len(mismatched)} summaries are out of date")
+            self.stdout.write(self.style.SUCCESS(f"{len(stored)} summaries verified"))
+            return
+
+        new_summaries = []
+        for family_id in mismatched:
+            data = expected.get(family_id, YearlySummary()).to_dict()
+            if family_id in stored:
+                summary = stored[family_id]
+                TransactionSummary.objects.filter(pk=summary.pk).update(
+                    data=data, version=summary.version + 1
+                )
+            else:
+                new_summaries.append(TransactionSummary(familyId=family_id, data=data))
+        TransactionSummary.objects.bulk_create(new_summaries)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt {len(mismatched)} of {len(expected)} summaries"
+            )
+        )
+
+    def compute_summaries(self, family_ids):
+        """Aggregate all transactions into a YearlySummary per family in one query"""
+        transactions = Transaction.objects.exclude(year=None).exclude(month=None)
+        if family_ids:
+            transactions = transactions.filter(familyId__in=family_ids)
+        totals = (
+            transactions.values("familyId", "year", "month", "type", "category")
+            .annotate(total=Sum("amount"))
+            .order_by()
+        )
+
+        summaries = defaultdict(YearlySummary)
+        for row in totals.iterator():
+            summaries[row["familyId"]].apply_delta(
+                row["year"], row["month"], row["type"], row["category"], row["total"]
+            )
+        return summaries
+
+    def to_dict(self, summary):
+        if summary is None:
+            return YearlySummary().to_dict()
+        if isinstance(summary.data, YearlySummary):
+            return summary.data.to_dict()
+        return summary.data
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from copilot.models import MessageJob, OutboundMessage, QueuedJob
+from copilot.services.job_queue import JobQueue
+
+
+class Command(BaseCommand):
+    help = (
+        "Requeue message jobs (or outbound messages) so the workers process them again"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids", nargs="*", type=int, help="MessageJob (OutboundMessage) ids"
+        )
+        parser.add_argument(
+            "--sid",
+            action="append",
+            default=[],
+            help="MessageSid (of the answered message with --outbound)",
+        )
+        parser.add_argument(
+            "--status",
+            choices=[status for status, _ in QueuedJob.STATUSES],
+            help="Replay every job with this status (e.g. failed)",
+        )
+        parser.add_argument(
+            "--outbound",
+            action="store_true",
+            help="Replay outbound messages instead of inbound message jobs",
+        )
+
+    def handle(self, *args, **options):
+        if not (options["ids"] or options["sid"] or options["status"]):
+            raise CommandError("Pass job ids, --sid or --status")
+
+        model = OutboundMessage if options["outbound"] else MessageJob
+        jobs = model.objects.all()
+        if options["ids"]:
+            jobs = jobs.filter(pk__in=options["ids"])
+        if options["sid"]:
+            if options["outbound"]:
+                jobs = jobs.filter(reply_to__in=options["sid"])
+            else:
+                jobs = jobs.filter(message_sid__in=options["sid"])
+        if options["status"]:
+            jobs = jobs.filter(status=options["status"])
+
+        count = JobQueue(model).replay(jobs)
+        self.stdout.write(self.style.SUCCESS(f"Requeued {count} job(s)"))
@@ -0,0 +1,100 @@
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from copilot.services.job_queue import run_worker_pool
+from copilot.services.metrics import serve_metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued WhatsApp messages and send the queued replies with "
+        "pools of background workers"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=getattr(settings, "COPILOT_WORKER_CONCURRENCY", 4),
+            help="Number of worker threads",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=getattr(settings, "COPILOT_WORKER_POLL_INTERVAL", 1.0),
+            help="Seconds to sleep when the queue is empty",
+        )
+        parser.add_argument(
+            "--outbound-concurrency",
+            type=int,
+            default=getattr(settings, "COPILOT_OUTBOUND_CONCURRENCY", 4),
+            help="Number of threads sending replies (0 leaves them to other processes)",
+        )
+        parser.add_argument(
+            "--outbound-poll-interval",
+            type=float,
+            default=getattr(settings, "COPILOT_OUTBOUND_POLL_INTERVAL", 0.25),
+            help="Seconds to sleep when no reply is waiting",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=getattr(settings, "COPILOT_WORKER_METRICS_PORT", None),
+            help="Serve the workers' Prometheus metrics on this port (/metrics)",
+        )
+
+    def handle(self, *args, **options):
+        # Imported here so the services are only built in the worker process
+        from copilot.services.outbound import outbound_queue, send_outbound_job
+        from copilot.views import message_queue, process_message_job
+
+        if options["metrics_port"]:
+            serve_metrics(options["metrics_port"])
+            self.stdout.write(f"Serving metrics on :{options['metrics_port']}/metrics")
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+        pools = [
+            (
+                message_queue,
+                process_message_job,
+                options["concurrency"],
+                options["poll_interval"],
+            ),
+            (
+                outbound_queue,
+                send_outbound_job,
+                options["outbound_concurrency"],
+                options["outbound_poll_interval"],
+            ),
+        ]
+        threads = [
+            threading.Thread(
+                target=run_worker_pool,
+                args=(queue, handler, concurrency, stop_event, poll_interval),
+                name=f"copilot-pool-{queue.model.__name__}",
+                daemon=True,
+            )
+            for queue, handler, concurrency, poll_interval in pools
+            if concurrency > 0
+        ]
+
+        self.stdout.write(
+            f"Starting {options['concurrency']} message workers and "
+            f"{options['outbound_concurrency']} outbound workers (Ctrl+C to stop)"
+        )
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            stop_event.set()
+        for thread in threads:
+            thread.join()
+        self.stdout.write("Workers stopped")
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from copilot.datamodels.chatentry import ChatEntry
+from copilot.models import Chat, ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the entries of the legacy Chat documents into per-entry "
+        "ChatMessage rows and empty the documents"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", action="append", default=[], help="Only these userIds"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="Rows per bulk_create"
+        )
+
+    def handle(self, *args, **options):
+        chats = Chat.objects.all()
+        if options["user"]:
+            chats = chats.filter(userId__in=options["user"])
+
+        documents = moved = 0
+        for chat in chats.iterator():
+            if not chat.data:
+                continue
+            with db_transaction.atomic():
+                moved += self.split(chat, options["batch_size"])
+                Chat.objects.filter(pk=chat.pk).update(data=[])
+            documents += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Moved {moved} entries out of {documents} chats")
+        )
+
+    def split(self, chat, batch_size):
+        messages = []
+        previous = None
+        for entry in chat.data:
+            # Entries without a parseable timestamp keep their position
+            fields = ChatMessage.fields_from_entry(
+                ChatEntry.from_dict(entry), default_timestamp=previous
+            )
+            previous = fields["timestamp"]
+            messages.append(ChatMessage(userId=chat.userId, **fields))
+        ChatMessage.objects.bulk_create(messages, batch_size=batch_size)
+        return len(messages)
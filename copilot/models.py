@@ -1,10 +1,18 @@
 import uuid
+from collections import defaultdict
+from datetime import datetime
 
+from django.conf import settings
 from django.db import models
+from django.db import transaction as db_transaction
+from django.utils import timezone
 
+from copilot.constants import REPLY_INVALID_TRANSACTION_TYPE, TRANSACTION_TYPES
 from copilot.datamodels.chatentry import ChatEntry
 from copilot.datamodels.fields import YearlySummaryField
 from copilot.datamodels.summary import YearlySummary
+from copilot.services import date_ranges, description_search
+from copilot.services.user_cache import user_cache
 
 
 class User(models.Model):
@@ -18,11 +26,146 @@ class User(models.Model):
     def save(self, *args, **kwargs):
         self.familyId = self.userId
         super(User, self).save(*args, **kwargs)
+        user_cache.invalidate(self.number, user_pk=self.pk)
+
+    def delete(self, *args, **kwargs):
+        user_cache.invalidate(self.number, user_pk=self.pk)
+        return super(User, self).delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.name} ({self.number})"
 
 
+class TransactionQuerySet(models.QuerySet):
+    def for_family(self, family_id):
+        return self.filter(familyId=family_id)
+
+    def matching(self, search: dict):
+        """
+        Filter on the "search" criteria extracted by Gemini
+        (see GeminiService.extract_transaction_update_details).
+        Amounts match on their whole-dollar part, a year, month or day is a
+        date range, descriptions match if they contain any of the candidate
+        words.
+        """
+        filters = {}
+        for field in ("type", "category"):
+            if search.get(field):
+                filters[field] = search[field]
+
+        amount = _to_number(search.get("amount"), float)
+        if amount is not None:
+            filters["amount__gte"] = int(amount)
+            filters["amount__lt"] = int(amount) + 1
+
+        dates = {
+            field: _to_number(search.get(field), int)
+            for field in ("year", "month", "day")
+        }
+        date_range = date_ranges.search_range(**dates)
+        if date_range:
+            filters["date__gte"], filters["date__lt"] = date_range
+        else:
+            # Partial dates (e.g. a day of any month) match the ints
+            filters.update(
+                {field: value for field, value in dates.items() if value is not None}
+            )
+
+        queryset = self.filter(**filters)
+
+        description = search.get("description")
+        if description:
+            words = (
+                description
+                if isinstance(description, list)
+                else str(description).split()
+            )
+            condition = models.Q()
+            for word in words:
+                condition |= models.Q(description__icontains=word)
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def description_matches(self, family_id, search: dict, limit=5):
+        """
+        Fuzzy description search: candidates come from the family's
+        DescriptionNgram index (so the cost depends on how many descriptions
+        share n-grams with the terms, not on the family size), are filtered
+        on the other exact criteria and ranked by similarity, recency and
+        closeness to the searched amount
+        Args:
+            family_id: Family whose transactions are searched
+            search: Search criteria extracted by Gemini, with a "description"
+            limit: Matches returned
+        Returns:
+            List of transactions, best match first
+        """
+        terms = description_search.words(search.get("description"))
+        candidate_ids = DescriptionNgram.objects.candidate_ids(family_id, terms)
+        if not candidate_ids:
+            return []
+        # The amount ranks the candidates instead of filtering them
+        exact = {
+            field: value
+            for field, value in search.items()
+            if field not in ("description", "amount")
+        }
+        candidates = self.for_family(family_id).filter(pk__in=candidate_ids)
+        return description_search.rank_matches(
+            candidates.matching(exact),
+            terms,
+            amount=_to_number(search.get("amount"), float),
+        )[:limit]
+
+    def between(self, start, end):
+        """Transactions dated start <= date < end, a range scan of the date index"""
+        return self.filter(date__gte=start, date__lt=end)
+
+    def in_month(self, year, month):
+        return self.between(*date_ranges.month_range(year, month))
+
+    def in_week(self, day, weeks=1):
+        """Transactions of `weeks` calendar weeks, starting with the one of `day`"""
+        return self.between(*date_ranges.week_range(day, weeks))
+
+    def last_days(self, days, today=None):
+        """Transactions of the last `days` days, today included"""
+        return self.between(*date_ranges.last_days(days, today))
+
+    def latest_first(self):
+        return self.order_by("-date", "-created_at")
+
+    def bulk_create_with_summaries(self, transactions, batch_size=None):
+        """
+        Insert transactions with bulk_create (which skips Transaction.save),
+        apply their rollup deltas with one summary update per family and
+        index their descriptions
+        """
+        deltas = defaultdict(list)
+        for transaction in transactions:
+            transaction.normalize_type()
+            transaction.sync_date()
+            deltas[transaction.familyId] += summary_deltas(transaction.__dict__, 1)
+        with db_transaction.atomic():
+            created = self.bulk_create(transactions, batch_size=batch_size)
+            for family_id, family_deltas in deltas.items():
+                TransactionSummary.apply_deltas(family_id, family_deltas)
+            DescriptionNgram.objects.index(created, replace=False)
+        return created
+
+
+class InvalidTransaction(ValueError):
+    """Transaction details that can't be recorded, the message is for the user"""
+
+
+def _to_number(value, cast):
+    """Cast a search value to a number, None for missing or placeholder values"""
+    try:
+        return cast(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
 class Transaction(models.Model):
     TRANSACTION_TYPES = [
         ("income", "Income"),
@@ -36,20 +179,211 @@ class Transaction(models.Model):
     year = models.IntegerField(null=True)
     month = models.IntegerField(blank=True, null=True)
     day = models.IntegerField(blank=True, null=True)
+    # Kept in step with year/month/day by save (see sync_date), the column
+    # that range queries and ordering use
+    date = models.DateField(blank=True, null=True)
     amount = models.FloatField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     description = models.TextField(blank=True)
     recordType = models.CharField(max_length=20, default="transaction")
 
+    objects = TransactionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # update/delete lookups: exact type and amount, latest date first
+            models.Index(fields=["familyId", "type", "amount", "date"]),
+            # date ranges and latest first
+            models.Index(fields=["familyId", "date"]),
+        ]
+
     def __str__(self):
         return f"{self.type.capitalize()} - {self.category}"
 
+    # Fields that determine the transaction's contribution to the rollups
+    SUMMARY_FIELDS = ("type", "category", "year", "month", "amount")
+
+    def sync_date(self):
+        """Set date from year/month/day"""
+        self.date = date_ranges.transaction_date(self.year, self.month, self.day)
+
+    def normalize_type(self):
+        """
+        Lowercase type, as the rollups key on it
+        Raises:
+            InvalidTransaction if it is neither income nor expense
+        """
+        transaction_type = str(self.type or "").strip().lower()
+        if transaction_type not in TRANSACTION_TYPES:
+            raise InvalidTransaction(
+                REPLY_INVALID_TRANSACTION_TYPE.format(
+                    description=f'"{self.description}"' if self.description else "it"
+                )
+            )
+        self.type = transaction_type
+
+    def save(self, *args, **kwargs):
+        self.normalize_type()
+        self.sync_date()
+        # Keep the family's TransactionSummary and description index in step
+        # with the row
+        with db_transaction.atomic():
+            previous = (
+                Transaction.objects.filter(pk=self.pk)
+                .values("description", *self.SUMMARY_FIELDS)
+                .first()
+                if self.pk
+                else None
+            )
+            super().save(*args, **kwargs)
+            deltas = summary_deltas(self.__dict__, 1)
+            if previous:
+                deltas += summary_deltas(previous, -1)
+            TransactionSummary.apply_deltas(self.familyId, deltas)
+            if previous is None or previous["description"] != self.description:
+                DescriptionNgram.objects.index([self], replace=previous is not None)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        with db_transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            TransactionSummary.apply_deltas(
+                self.familyId, summary_deltas(self.__dict__, -1)
+            )
+            DescriptionNgram.objects.remove([pk])
+        return result
+
+
+def summary_deltas(values, sign):
+    """
+    Rollup changes of a transaction, given as a dict of SUMMARY_FIELDS
+    Args:
+        values: Transaction field values
+        sign: 1 to add the transaction to the totals, -1 to remove it
+    Returns:
+        List of (year, month, type, category, amount) tuples
+    """
+    if values.get("year") is None or values.get("month") is None:
+        return []
+    return [
+        (
+            values["year"],
+            values["month"],
+            values["type"],
+            values["category"],
+            sign * float(values["amount"]),
+        )
+    ]
+
+
+class DescriptionNgramQuerySet(models.QuerySet):
+    def index(self, transactions, replace=True):
+        """
+        Add the n-grams of the transactions' descriptions
+        Args:
+            transactions: Saved transactions (without a pk they are skipped,
+                rebuild_description_index picks them up)
+            replace: Remove the transactions' previous n-grams first
+        """
+        transactions = [transaction for transaction in transactions if transaction.pk]
+        if replace:
+            self.remove([transaction.pk for transaction in transactions])
+        self.bulk_create(
+            [
+                DescriptionNgram(
+                    familyId=transaction.familyId,
+                    gram=gram,
+                    transactionId=transaction.pk,
+                )
+                for transaction in transactions
+                for gram in description_search.ngrams(transaction.description)
+            ],
+            batch_size=1000,
+        )
+
+    def remove(self, transaction_ids):
+        if transaction_ids:
+            self.filter(transactionId__in=transaction_ids).delete()
+
+    def candidate_ids(self, family_id, terms, limit=None):
+        """
+        Ids of the family's transactions whose description shares at least
+        MIN_NGRAM_OVERLAP of the n-grams of one of the terms, most shared first
+        Args:
+            family_id: Family whose index is searched
+            terms: Search words
+            limit: Most candidates returned (COPILOT_FUZZY_CANDIDATES)
+        Returns:
+            List of transaction ids
+        """
+        if limit is None:
+            limit = getattr(settings, "COPILOT_FUZZY_CANDIDATES", 50)
+        term_grams = [description_search.ngrams(term) for term in terms]
+        term_grams = [grams for grams in term_grams if grams]
+        if not term_grams:
+            return []
+
+        postings = defaultdict(set)  # {gram: transaction ids}
+        rows = self.filter(
+            familyId=family_id, gram__in=set().union(*term_grams)
+        ).values_list("transactionId", "gram")
+        for transaction_id, gram in rows.iterator():
+            postings[gram].add(transaction_id)
+
+        overlap = defaultdict(float)
+        for grams in term_grams:
+            shared = defaultdict(int)
+            for gram in grams:
+                for transaction_id in postings[gram]:
+                    shared[transaction_id] += 1
+            for transaction_id, count in shared.items():
+                overlap[transaction_id] = max(
+                    overlap[transaction_id], count / len(grams)
+                )
+        ranked = sorted(
+            (
+                transaction_id
+                for transaction_id, share in overlap.items()
+                if share >= description_search.MIN_NGRAM_OVERLAP
+            ),
+            key=lambda transaction_id: (overlap[transaction_id], transaction_id),
+            reverse=True,
+        )
+        return ranked[:limit]
+
+
+class DescriptionNgram(models.Model):
+    """
+    One n-gram of a transaction description: the per-family inverted index
+    of fuzzy description search, maintained by Transaction.save/delete and
+    bulk_create_with_summaries (rebuild with rebuild_description_index)
+    """
 
-class TransactionSummary(models.Model):
     familyId = models.CharField(max_length=50)
+    gram = models.CharField(max_length=8)
+    transactionId = models.IntegerField()
+
+    objects = DescriptionNgramQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["familyId", "gram"]),
+            models.Index(fields=["transactionId"]),
+        ]
+
+    def __str__(self):
+        return f"{self.gram!r} of transaction {self.transactionId}"
+
+
+class TransactionSummary(models.Model):
+    familyId = models.CharField(max_length=50, unique=True)
     recordType = models.CharField(max_length=20, default="transactionsummary")
     data = YearlySummaryField(default=YearlySummary)
+    # Bumped on every rollup update, used for optimistic concurrency
+    version = models.IntegerField(default=0)
+
+    MAX_UPDATE_ATTEMPTS = 10
 
     def save(self, *args, **kwargs):
         # Ensure the data is converted to a dictionary before saving
@@ -60,23 +394,57 @@ class TransactionSummary(models.Model):
     def __str__(self):
         return f"Summary for {self.familyId}: {self.data}"
 
+    @classmethod
+    def apply_deltas(cls, family_id, deltas):
+        """
+        Apply income/expense deltas to a family's summary.
+        The read-modify-write is retried if another worker updated the
+        document in between, so concurrent changes are never lost.
+        Args:
+            family_id: Family whose summary is updated
+            deltas: List of (year, month, type, category, amount) tuples
+        """
+        if not deltas:
+            return
+        for _ in range(cls.MAX_UPDATE_ATTEMPTS):
+            summary, _ = cls.objects.get_or_create(familyId=family_id)
+            data = summary.data
+            if not isinstance(data, YearlySummary):
+                data = YearlySummary.from_dict(data)
+            for delta in deltas:
+                data.apply_delta(*delta)
+            updated = cls.objects.filter(pk=summary.pk, version=summary.version).update(
+                data=data.to_dict(), version=summary.version + 1
+            )
+            if updated:
+                return
+        raise RuntimeError(f"Could not update the summary of family {family_id}")
+
 
 class Chat(models.Model):
+    """
+    Legacy per-user chat document holding the whole conversation in `data`.
+    New entries go to ChatMessage (one row per entry); split_chat_documents
+    moves existing documents over.
+    """
+
     userId = models.CharField(max_length=50)
     # Store data as a list of dictionaries
     data = models.JSONField(default=list)
 
     def __str__(self):
-        return f"Chat for {self.userId}: {self.data}"
+        return f"Chat for {self.userId}: {len(self.data)} unsplit entries"
 
     def get_chat_entries(self):
-        """Convert the stored data to a list of ChatEntry objects."""
-        return [ChatEntry.from_dict(entry) for entry in self.data]
+        """Lazily iterate the user's ChatEntry objects, oldest first."""
+        for entry in self.data:
+            yield ChatEntry.from_dict(entry)
+        yield from ChatMessage.objects.for_user(self.userId).entries()
 
     def add_chat_entry(self, entry):
-        """Add a ChatEntry to the 'data' field."""
+        """Append a ChatEntry as its own ChatMessage row."""
         if isinstance(entry, ChatEntry):
-            self.data.append(entry.to_dict())
+            return ChatMessage.objects.append(self.userId, entry)
         else:
             raise ValueError("entry must be a ChatEntry instance")
 
@@ -85,4 +453,233 @@ class Chat(models.Model):
         super().save(*args, **kwargs)
 
 
+class ChatMessageQuerySet(models.QuerySet):
+    def for_user(self, user_id):
+        return self.filter(userId=str(user_id))
+
+    def append(self, user_id, entry: ChatEntry):
+        """Insert one entry, cost does not depend on the history length"""
+        return self.create(userId=str(user_id), **ChatMessage.fields_from_entry(entry))
+
+    def entries(self, chunk_size=500):
+        """Lazy iterator of ChatEntry objects, oldest first"""
+        for message in self.order_by("timestamp", "pk").iterator(chunk_size=chunk_size):
+            yield message.to_entry()
+
+    def after(self, cursor):
+        """Messages newer than a cursor (see ChatMessage.encode_cursor)"""
+        timestamp, pk = ChatMessage.decode_cursor(cursor)
+        return self.filter(
+            models.Q(timestamp__gt=timestamp) | models.Q(timestamp=timestamp, pk__gt=pk)
+        )
+
+    def page(self, cursor=None, limit=50):
+        """
+        Keyset page of entries, newest first
+        Args:
+            cursor: next_cursor of the previous page, None for the latest entries
+            limit: Entries per page
+        Returns:
+            (list of ChatEntry, next_cursor or None when there is no older entry)
+        """
+        messages = self.order_by("-timestamp", "-pk")
+        if cursor:
+            timestamp, pk = ChatMessage.decode_cursor(cursor)
+            messages = messages.filter(
+                models.Q(timestamp__lt=timestamp)
+                | models.Q(timestamp=timestamp, pk__lt=pk)
+            )
+        messages = list(messages[: limit + 1])
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = ChatMessage.encode_cursor(messages[-1])
+        return [message.to_entry() for message in messages], next_cursor
+
+
+class ChatMessage(models.Model):
+    """One chat entry of a user, append-only"""
+
+    userId = models.CharField(max_length=50)
+    timestamp = models.DateTimeField(default=timezone.now)
+    sender = models.CharField(max_length=50)
+    message = models.TextField(blank=True)
+    attachment = models.TextField(blank=True, default="")
+
+    objects = ChatMessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["userId", "timestamp"])]
+
+    def __str__(self):
+        return f"{self.sender} at {self.timestamp}: {self.message}"
+
+    def to_entry(self) -> ChatEntry:
+        return ChatEntry(
+            timestamp=self.timestamp.isoformat(),
+            sender=self.sender,
+            message=self.message,
+            attachment=self.attachment,
+        )
+
+    @staticmethod
+    def fields_from_entry(entry: ChatEntry, default_timestamp=None) -> dict:
+        timestamp = entry.timestamp
+        if isinstance(timestamp, str):
+            try:
+                timestamp = datetime.fromisoformat(timestamp)
+            except ValueError:
+                timestamp = None
+        if isinstance(timestamp, datetime) and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return {
+            "timestamp": timestamp or default_timestamp or timezone.now(),
+            "sender": entry.sender,
+            "message": entry.message or "",
+            "attachment": entry.attachment or "",
+        }
+
+    @staticmethod
+    def encode_cursor(message) -> str:
+        return f"{message.timestamp.isoformat()}|{message.pk}"
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            timestamp, pk = cursor.rsplit("|", 1)
+            return datetime.fromisoformat(timestamp), int(pk)
+        except ValueError:
+            raise ValueError(f"Invalid chat cursor: {cursor!r}")
+
+
+class QueuedJob(models.Model):
+    """
+    Common bookkeeping for rows processed by the DB-backed worker pool
+    (see copilot.services.job_queue.JobQueue)
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUSES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    status = models.CharField(
+        max_length=10, choices=STATUSES, default=STATUS_PENDING, db_index=True
+    )
+    attempts = models.IntegerField(default=0)
+    # Times the job was put back without using up an attempt (see Deferred)
+    deferrals = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+
+class MessageJob(QueuedJob):
+    """An inbound WhatsApp message waiting to be processed by a worker"""
+
+    message_sid = models.CharField(max_length=64, db_index=True)
+    sender = models.CharField(max_length=20)
+    # Serialized TwilioMessage (see TwilioMessage.to_dict)
+    payload = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "available_at"]),
+            # pending job of a sender, for burst coalescing
+            models.Index(fields=["sender", "status"]),
+        ]
+
+    def __str__(self):
+        return f"MessageJob {self.message_sid} ({self.status})"
+
+
+class OutboundMessageQuerySet(models.QuerySet):
+    def record_status(self, status, outbound_id=None, twilio_sid="", error_code=""):
+        """
+        Record a Twilio status callback. Callbacks may arrive out of order,
+        a status never replaces a later one (e.g. "sent" after "delivered")
+        Args:
+            status: MessageStatus of the callback
+            outbound_id: OutboundMessage id carried in the callback URL
+            twilio_sid: MessageSid, used when there is no outbound_id
+            error_code: ErrorCode of failed deliveries
+        Returns:
+            Number of messages updated (0 or 1)
+        """
+        if outbound_id:
+            messages = self.filter(pk=outbound_id)
+        elif twilio_sid:
+            messages = self.filter(twilio_sid=twilio_sid)
+        else:
+            return 0
+        message = messages.first()
+        rank = OutboundMessage.DELIVERY_RANKS.get(status)
+        if message is None or rank is None:
+            return 0
+        if rank <= OutboundMessage.DELIVERY_RANKS.get(message.delivery_status, -1):
+            return 0
+        fields = {"delivery_status": status, "updated_at": timezone.now()}
+        if twilio_sid:
+            fields["twilio_sid"] = twilio_sid
+        if error_code:
+            fields["error_code"] = error_code
+        # Conditional on the status read, a concurrent callback wins
+        return self.filter(
+            pk=message.pk, delivery_status=message.delivery_status
+        ).update(**fields)
+
+
+class OutboundMessage(QueuedJob):
+    """
+    A reply (or one part of a long reply) waiting to be sent to a WhatsApp
+    number by the outbound workers (see copilot.services.outbound)
+    """
+
+    # Twilio MessageStatus values in delivery order; failures are final
+    DELIVERY_RANKS = {
+        "accepted": 0,
+        "queued": 1,
+        "sending": 2,
+        "sent": 3,
+        "delivered": 4,
+        "read": 5,
+        "undelivered": 6,
+        "failed": 6,
+    }
+
+    to = models.CharField(max_length=20)
+    body = models.TextField()
+    part = models.IntegerField(default=1)
+    parts = models.IntegerField(default=1)
+    # MessageSid of the inbound message answered, if any
+    reply_to = models.CharField(max_length=64, blank=True, db_index=True)
+    twilio_sid = models.CharField(max_length=64, blank=True, db_index=True)
+    delivery_status = models.CharField(max_length=20, blank=True)
+    error_code = models.CharField(max_length=10, blank=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    objects = OutboundMessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "available_at"]),
+            # earlier unsent messages to a number, for per-destination order
+            models.Index(fields=["to", "status"]),
+        ]
+
+    def __str__(self):
+        return f"OutboundMessage {self.pk} to {self.to} ({self.part}/{self.parts}, {self.status})"
+
+
 # class Metadata(models.Model):
@@ -0,0 +1,367 @@
+import re
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+
+from copilot.constants import TRANSACTION_CATEGORIES
+from copilot.datamodels.summary import YearlySummary
+from copilot.models import Transaction, TransactionSummary
+from copilot.services import date_ranges
+from copilot.services.local_parser import CATEGORY_KEYWORDS, MONTHS
+
+# Rough size of a token for budgeting the prompt
+CHARS_PER_TOKEN = 4
+
+ROW_COLUMNS = (
+    "id",
+    "type",
+    "category",
+    "date",
+    "amount",
+    "description",
+)
+
+STOP_WORDS = {
+    "how",
+    "much",
+    "many",
+    "what",
+    "did",
+    "does",
+    "spend",
+    "spent",
+    "spending",
+    "on",
+    "in",
+    "the",
+    "my",
+    "for",
+    "and",
+    "this",
+    "that",
+    "last",
+    "month",
+    "year",
+    "week",
+    "total",
+    "show",
+    "me",
+    "was",
+    "were",
+    "have",
+    "has",
+    "with",
+    "from",
+    "income",
+    "expense",
+    "expenses",
+    "money",
+    "about",
+    "compare",
+}
+
+
+class AnalyticsEngine:
+    """
+    Builds a compact digest of a family's finances for analytical queries.
+    Totals per month and category come from the family's TransactionSummary,
+    merchants and trends from a columnar projection of the recent
+    transactions, and the remaining token budget is filled with the raw rows
+    most relevant to the question.
+    """
+
+    def __init__(
+        self, token_budget: Optional[int] = None, window_months: Optional[int] = None
+    ):
+        self.token_budget = token_budget or getattr(
+            settings, "COPILOT_ANALYTICS_TOKEN_BUDGET", 1500
+        )
+        self.window_months = window_months or getattr(
+            settings, "COPILOT_ANALYTICS_WINDOW_MONTHS", 12
+        )
+
+    def build_digest(
+        self, family_id: str, question: str, today: Optional[date] = None
+    ) -> str:
+        """
+        Args:
+            family_id: Family whose transactions are summarized
+            question: The user's analytical query
+        Returns:
+            Digest text of at most token_budget (estimated) tokens
+        """
+        today = today or date.today()
+        summary = self._load_summary(family_id)
+        columns = self._load_columns(family_id, self._window_start(today))
+
+        sections = [
+            self._totals_section(summary, today),
+            self._monthly_section(summary, today),
+            self._category_section(summary, today),
+            self._merchant_section(columns),
+            self._trend_section(summary, today),
+        ]
+
+        budget = self.token_budget * CHARS_PER_TOKEN
+        digest = []
+        for section in sections:
+            if section and len(section) + 1 <= budget:
+                digest.append(section)
+                budget -= len(section) + 1
+
+        rows = self._relevant_rows_section(family_id, columns, question, budget, today)
+        if rows:
+            digest.append(rows)
+        return "\n".join(digest)
+
+    def _load_summary(self, family_id: str) -> YearlySummary:
+        summary = TransactionSummary.objects.filter(familyId=family_id).first()
+        if summary is None:
+            return YearlySummary()
+        if isinstance(summary.data, YearlySummary):
+            return summary.data
+        return YearlySummary.from_dict(summary.data)
+
+    def _load_columns(
+        self, family_id: str, start: date, end: Optional[date] = None
+    ) -> dict:
+        """
+        Column-oriented projection of the transactions dated from start (to
+        end), newest first, with one range scan of the date index
+        """
+        transactions = Transaction.objects.for_family(family_id)
+        if end:
+            transactions = transactions.between(start, end)
+        else:
+            transactions = transactions.filter(date__gte=start)
+        rows = transactions.latest_first().values_list(*ROW_COLUMNS)
+        values = list(zip(*rows)) or [()] * len(ROW_COLUMNS)
+        return dict(zip(ROW_COLUMNS, values))
+
+    def _window_start(self, today: date) -> date:
+        """First day of the analysis window"""
+        return date(
+            *self._shift_month(today.year, today.month, 1 - self.window_months), 1
+        )
+
+    def _months(self, today: date, count: int) -> List[Tuple[int, int]]:
+        """The last `count` (year, month) pairs, newest first"""
+        return [self._shift_month(today.year, today.month, -i) for i in range(count)]
+
+    _shift_month = staticmethod(date_ranges.shift_month)
+
+    def _totals_section(self, summary: YearlySummary, today: date) -> str:
+        income = expense = 0
+        for months in summary.years.values():
+            for monthly in months.values():
+                income += monthly.income
+                expense += monthly.expense
+        this_year = summary.years.get(str(today.year), {}).values()
+        return (
+            f"All-time totals: income {income:.2f}, expense {expense:.2f}, net {income - expense:.2f}\n"
+            f"{today.year} so far: income {sum(m.income for m in this_year):.2f}, "
+            f"expense {sum(m.expense for m in this_year):.2f}"
+        )
+
+    def _monthly_section(self, summary: YearlySummary, today: date) -> str:
+        lines = ["Monthly totals (month-year: income, expense):"]
+        for year, month in self._months(today, self.window_months):
+            monthly = summary.get_monthly_summary(year, month)
+            if monthly.income or monthly.expense:
+                lines.append(
+                    f"{month:02d}-{year}: {monthly.income:.2f}, {monthly.expense:.2f}"
+                )
+        return "\n".join(lines) if len(lines) > 1 else ""
+
+    def _category_section(self, summary: YearlySummary, today: date) -> str:
+        # {type: {category: [this month, window, all time]}}, kept apart so
+        # salary never counts as spending
+        totals = {
+            type: defaultdict(lambda: [0.0, 0.0, 0.0]) for type in ("expense", "income")
+        }
+        window = set(self._months(today, self.window_months))
+        for year, months in summary.years.items():
+            for month, monthly in months.items():
+                key = (int(year), int(month))
+                for category, amounts in monthly.categories.items():
+                    for type, type_totals in totals.items():
+                        amount = amounts.get(type, 0)
+                        if not amount:
+                            continue
+                        type_totals[category][2] += amount
+                        if key in window:
+                            type_totals[category][1] += amount
+                        if key == (today.year, today.month):
+                            type_totals[category][0] += amount
+        lines = []
+        for type, type_totals in totals.items():
+            if not type_totals:
+                continue
+            lines.append(
+                f"Category {type} totals (this month, last {self.window_months} "
+                "months, all time):"
+            )
+            for category, (month, window_total, all_time) in sorted(
+                type_totals.items(), key=lambda item: -item[1][2]
+            ):
+                lines.append(
+                    f"{category}: {month:.2f}, {window_total:.2f}, {all_time:.2f}"
+                )
+        return "\n".join(lines)
+
+    def _merchant_section(self, columns: dict, limit: int = 10) -> str:
+        totals = defaultdict(float)
+        counts = defaultdict(int)
+        for type, description, amount in zip(
+            columns["type"], columns["description"], columns["amount"]
+        ):
+            merchant = " ".join((description or "").lower().split())
+            if type == "expense" and merchant:
+                totals[merchant] += amount
+                counts[merchant] += 1
+        if not totals:
+            return ""
+        top = sorted(totals, key=totals.get, reverse=True)[:limit]
+        return "\n".join(
+            [f"Top expenses by description (last {self.window_months} months):"]
+            + [
+                f"{merchant}: {totals[merchant]:.2f} in {counts[merchant]} transactions"
+                for merchant in top
+            ]
+        )
+
+    def _trend_section(self, summary: YearlySummary, today: date) -> str:
+        recent = [
+            summary.get_monthly_summary(*key).expense for key in self._months(today, 4)
+        ]
+        if not any(recent[1:]):
+            return ""
+        previous = [value for value in recent[1:] if value]
+        average = sum(previous) / len(previous)
+        lines = [
+            f"Average monthly expense over the previous {len(previous)} months: {average:.2f}"
+        ]
+        if recent[1]:
+            change = (recent[0] - recent[1]) / recent[1] * 100
+            lines.append(
+                f"This month vs last month expense: {change:+.1f}% (month not over yet)"
+            )
+        return "\n".join(lines)
+
+    def _relevant_rows_section(
+        self, family_id: str, columns: dict, question: str, budget: int, today: date
+    ) -> str:
+        """
+        Raw rows that match the question's categories, date ranges or words,
+        newest first. Ranges older than the analysis window are loaded with
+        one more range query.
+        """
+        header = "Relevant transactions (" + ",".join(ROW_COLUMNS) + "):"
+        if budget <= len(header):
+            return ""
+
+        categories, ranges, words = self._question_terms(question, today)
+        rows = list(zip(*(columns[column] for column in ROW_COLUMNS)))
+        window_start = self._window_start(today)
+        older = [start for start, _ in ranges if start < window_start]
+        if older:
+            columns = self._load_columns(family_id, min(older), window_start)
+            rows += zip(*(columns[column] for column in ROW_COLUMNS))
+
+        scored = []
+        for position, row in enumerate(rows):
+            description = (row[5] or "").lower()
+            dated = row[3] is not None and any(
+                start <= row[3] < end for start, end in ranges
+            )
+            score = (
+                (2 if row[2] in categories else 0)
+                + (2 if dated else 0)
+                + sum(1 for word in words if word in description)
+            )
+            if score or not (categories or ranges or words):
+                scored.append((-score, position, row))
+        scored.sort()
+
+        lines = [header]
+        budget -= len(header) + 1
+        for _, _, row in scored:
+            line = ",".join(self._format_value(value) for value in row)
+            if len(line) + 1 > budget:
+                break
+            lines.append(line)
+            budget -= len(line) + 1
+        return "\n".join(lines) if len(lines) > 1 else ""
+
+    @staticmethod
+    def _format_value(value) -> str:
+        if value is None:
+            return ""
+        if isinstance(value, date):
+            # Month-day-year, like the rest of the prompts
+            return value.strftime("%m-%d-%Y")
+        return str(value)
+
+    def _question_terms(self, question: str, today: date):
+        """
+        Categories, date ranges (half-open (start, end) pairs) and description
+        words mentioned in the question
+        """
+        text = (question or "").lower()
+        tokens = re.findall(r"[a-z']+", text)
+        categories = {
+            category for category in TRANSACTION_CATEGORIES if category in tokens
+        }
+        for category, keywords in CATEGORY_KEYWORDS.items():
+            if any(keyword in tokens for keyword in keywords):
+                categories.add(category)
+        words = {
+            token
+            for token in tokens
+            if len(token) > 3 and token not in STOP_WORDS and token not in MONTHS
+        }
+        return categories, self._question_ranges(text, tokens, today), words
+
+    def _question_ranges(self, text: str, tokens: List[str], today: date):
+        """Date ranges of the periods a question mentions, latest occurrence"""
+        ranges = []
+        for month in {
+            MONTHS[token] for token in tokens if token in MONTHS and token != "may"
+        }:
+            # The latest such month, "december" asked in January is last year's
+            year = today.year if month <= today.month else today.year - 1
+            ranges.append(date_ranges.month_range(year, month))
+        for quarter in re.findall(r"\bq([1-4])\b", text):
+            start, end = date_ranges.quarter_range(today.year, int(quarter))
+            if start > today:
+                start, end = date_ranges.quarter_range(today.year - 1, int(quarter))
+            ranges.append((start, end))
+        if "this month" in text:
+            ranges.append(date_ranges.month_range(today.year, today.month))
+        if "last month" in text:
+            ranges.append(
+                date_ranges.month_range(*self._shift_month(today.year, today.month, -1))
+            )
+        if "this week" in text:
+            ranges.append(date_ranges.week_range(today))
+        if "last week" in text:
+            ranges.append(date_ranges.week_range(today - timedelta(weeks=1)))
+        if "today" in tokens:
+            ranges.append(date_ranges.day_range(today))
+        if "yesterday" in tokens:
+            ranges.append(date_ranges.day_range(today - timedelta(days=1)))
+        for count, unit in re.findall(
+            r"\b(?:last|past) (\d+) (day|week|month)s?\b", text
+        ):
+            if unit == "month":
+                start = date_ranges.transaction_date(
+                    *self._shift_month(today.year, today.month, -int(count)),
+                    today.day,
+                )
+                ranges.append((start, today + timedelta(days=1)))
+            else:
+                days = int(count) * (7 if unit == "week" else 1)
+                ranges.append(date_ranges.last_days(days, today))
+        return ranges
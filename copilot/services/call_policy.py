@@ -0,0 +1,327 @@
+import logging
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, fields
+from typing import Callable, Optional, Union
+
+from django.conf import settings
+
+from copilot.services.llm_scheduler import LLMUnavailable
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes of Gemini API errors worth retrying
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def _no_lease(blocking: bool = True) -> Callable[[], None]:
+    """Lease of calls made without a scheduler"""
+    return lambda: None
+
+
+class CallTimeout(TimeoutError):
+    """A Gemini call did not finish within its policy's deadline"""
+
+
+class CircuitOpen(LLMUnavailable):
+    """Calls of a method are failing too often and are paused for a while"""
+
+    def __init__(self, method: str, retry_after: float):
+        super().__init__(f"Circuit of {method} is open, retry in {retry_after:.0f}s")
+        self.method = method
+        self.retry_after = retry_after
+
+
+@dataclass
+class CallPolicy:
+    timeout: float = 20.0  # seconds per attempt, hedges included
+    retries: int = 2  # extra attempts after a retryable error
+    backoff: float = 0.5  # first retry delay, doubled on each retry
+    backoff_max: float = 8.0
+    # Send a second identical request once an attempt is slower than this:
+    # seconds, "p95" of the method's recent latencies, or None to disable
+    hedge_after: Union[float, str, None] = None
+    breaker_threshold: float = 0.5  # error rate that opens the circuit
+    breaker_min_calls: int = 10  # calls in the window before it can open
+    breaker_window: float = 60.0
+    breaker_cooldown: float = 30.0  # seconds open before a probe call
+
+    @classmethod
+    def for_method(cls, method: Optional[str]) -> "CallPolicy":
+        """Policy of a GeminiService method from COPILOT_GEMINI_CALL_POLICIES"""
+        policies = getattr(settings, "COPILOT_GEMINI_CALL_POLICIES", {})
+        values = dict(policies.get("default", {}))
+        values.update(policies.get(method, {}))
+        names = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in values.items() if key in names})
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (0-based)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Rolling-window error-rate breaker. Opens when at least
+    breaker_threshold of the last breaker_window seconds' calls failed, lets
+    one probe call through every breaker_cooldown seconds while open, and
+    closes again on the first successful probe.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, policy: CallPolicy):
+        self.policy = policy
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._outcomes = deque()  # (time, ok)
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.policy.breaker_cooldown:
+                return False
+            # Let one probe through, the next one a cooldown later
+            self.state = self.HALF_OPEN
+            self._opened_at = now
+            return True
+
+    def record(self, ok: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+            self._outcomes.append((now, ok))
+            while (
+                self._outcomes
+                and self._outcomes[0][0] < now - self.policy.breaker_window
+            ):
+                self._outcomes.popleft()
+            failures = sum(1 for _, outcome in self._outcomes if not outcome)
+            if (
+                len(self._outcomes) >= self.policy.breaker_min_calls
+                and failures / len(self._outcomes) >= self.policy.breaker_threshold
+            ):
+                self._open(now)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            return max(
+                0.0,
+                self._opened_at + self.policy.breaker_cooldown - time.monotonic(),
+            )
+
+    def _open(self, now: float):
+        logger.warning("Circuit opened for %ss", self.policy.breaker_cooldown)
+        self.state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+
+
+class ResilientCaller:
+    """
+    Runs Gemini calls under their method's CallPolicy: a deadline per
+    attempt, jittered exponential retries of retryable errors, an optional
+    hedged duplicate request for slow attempts and a circuit breaker per
+    method. Requests run on a worker thread so a hung call cannot hold the
+    caller past its deadline (the abandoned call finishes in the background).
+    Every request, hedges and abandoned ones included, holds its own
+    scheduler slot until it finishes, so the scheduler's concurrency bounds
+    the requests in flight. A hedge is only sent when a slot is free.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        # Running requests hold a scheduler slot, so with as many threads as
+        # slots (plus headroom for calls made without a scheduler) a request
+        # never queues for a thread and its deadline is all its own
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers
+            or getattr(settings, "COPILOT_GEMINI_CONCURRENCY", 8) * 2,
+            thread_name_prefix="gemini-call",
+        )
+        self._lock = threading.Lock()
+        self._policies = {}
+        self._breakers = {}
+        self._latencies = defaultdict(lambda: deque(maxlen=200))
+        self._counters = defaultdict(lambda: defaultdict(int))
+
+    def policy(self, method: Optional[str]) -> CallPolicy:
+        with self._lock:
+            if method not in self._policies:
+                self._policies[method] = CallPolicy.for_method(method)
+            return self._policies[method]
+
+    def breaker(self, method: Optional[str]) -> CircuitBreaker:
+        policy = self.policy(method)
+        with self._lock:
+            if method not in self._breakers:
+                self._breakers[method] = CircuitBreaker(policy)
+            return self._breakers[method]
+
+    def call(
+        self, method: Optional[str], fn: Callable, lease: Callable = None, **kwargs
+    ):
+        """
+        Call fn(**kwargs) under the policy of `method`
+        Args:
+            method: GeminiService method name, selects the policy and breaker
+            fn: The API call
+            lease: Takes a scheduler slot for one request and returns the
+                function releasing it (see LLMScheduler.lease); called with
+                blocking=False for hedges
+        Raises:
+            CircuitOpen without calling fn while the method's circuit is open,
+            otherwise the error of the last attempt
+        """
+        lease = lease or _no_lease
+        policy = self.policy(method)
+        breaker = self.breaker(method)
+        if not breaker.allow():
+            self._count(method, "short_circuited")
+            raise CircuitOpen(method or "default", breaker.retry_after())
+
+        for attempt in range(policy.retries + 1):
+            try:
+                release = lease()
+                started = time.monotonic()
+                result = self._attempt(method, policy, fn, kwargs, lease, release)
+                elapsed = time.monotonic() - started
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                breaker.record(False)
+                self._count(method, "failures")
+                if attempt == policy.retries or breaker.state != breaker.CLOSED:
+                    raise
+                delay = policy.backoff_delay(attempt)
+                logger.info("Retrying %s in %.1fs after: %s", method, delay, e)
+                self._count(method, "retries")
+                time.sleep(delay)
+                continue
+            breaker.record(True)
+            self._count(method, "calls")
+            with self._lock:
+                self._latencies[method].append(elapsed)
+            return result
+
+    def _attempt(
+        self,
+        method,
+        policy: CallPolicy,
+        fn: Callable,
+        kwargs: dict,
+        lease: Callable,
+        release: Callable,
+    ):
+        deadline = time.monotonic() + policy.timeout
+        futures = [self._submit(fn, kwargs, release)]
+        hedge_after = self.hedge_delay(method, policy)
+        if hedge_after is not None and hedge_after < policy.timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                try:
+                    hedge_release = lease(blocking=False)
+                except LLMUnavailable:
+                    # Every slot is taken, a hedge would only add to the load
+                    self._count(method, "hedges_skipped")
+                else:
+                    self._count(method, "hedges")
+                    futures.append(self._submit(fn, kwargs, hedge_release))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        self._count(method, "timeouts")
+        raise CallTimeout(f"{method} did not finish within {policy.timeout}s")
+
+    def _submit(self, fn: Callable, kwargs: dict, release: Callable) -> Future:
+        """Run fn(**kwargs) on the executor, releasing its slot once it finished"""
+
+        def run():
+            try:
+                return fn(**kwargs)
+            finally:
+                release()
+
+        try:
+            return self.executor.submit(run)
+        except BaseException:
+            release()
+            raise
+
+    def hedge_delay(self, method, policy: CallPolicy) -> Optional[float]:
+        if policy.hedge_after != "p95":
+            return policy.hedge_after
+        with self._lock:
+            latencies = sorted(self._latencies[method])
+        # Too few samples for a meaningful percentile
+        if len(latencies) < 20:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, LLMUnavailable):
+            return False
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        # google.genai.errors.APIError and HTTP client errors carry a status code
+        code = getattr(error, "code", None) or getattr(error, "status_code", None)
+        if code in RETRYABLE_STATUS_CODES:
+            return True
+        # Transport errors of the HTTP client (httpx.TransportError and friends)
+        return type(error).__module__.startswith(("httpx", "httpcore", "requests"))
+
+    def stats(self) -> dict:
+        """Per method counters, p95 latency and circuit state of this process"""
+        with self._lock:
+            methods = set(self._counters) | set(self._breakers)
+            stats = {}
+            for method in methods:
+                latencies = sorted(self._latencies[method])
+                stats[method or "default"] = dict(
+                    self._counters[method],
+                    p95_seconds=(
+                        latencies[int(len(latencies) * 0.95) - 1]
+                        if len(latencies) >= 20
+                        else None
+                    ),
+                    circuit=(
+                        self._breakers[method].state
+                        if method in self._breakers
+                        else CircuitBreaker.CLOSED
+                    ),
+                )
+            return stats
+
+    def _count(self, method, name: str):
+        with self._lock:
+            self._counters[method][name] += 1
@@ -0,0 +1,203 @@
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from copilot.datamodels.chatentry import ChatEntry
+from copilot.models import ChatMessage
+from copilot.services.analytics import CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# Longest part of a single message kept in the context
+MAX_MESSAGE_CHARS = 300
+
+
+def default_summarizer(summary: str, lines: List[str], max_chars: int) -> str:
+    from copilot.services.gemini_api import get_gemini_service
+
+    return get_gemini_service().summarize_conversation(summary, lines, max_chars)
+
+
+class ChatContextBuilder:
+    """
+    Conversational context of a user for Gemini prompts: the last `max_turns`
+    messages verbatim plus a rolling summary of the older ones, rendered
+    within `token_budget` (estimated) tokens.
+    ChatMessage rows are the source of truth for the turns, the Django cache
+    (COPILOT_CHAT_CONTEXT_CACHE_ALIAS) only holds the summary and the cursor
+    of the last message folded into it. Messages past the window and the
+    cursor are folded in with one summarizer call once they outgrow the
+    summary's share of the budget, by one worker at a time (a cache.add
+    lock), so concurrent workers of a sender never lose turns or overwrite
+    a newer summary with an older one.
+    """
+
+    def __init__(
+        self,
+        max_turns: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        summary_share: Optional[float] = None,
+        alias: Optional[str] = None,
+        ttl: Optional[int] = None,
+        summarizer: Optional[Callable] = None,
+        lock_timeout: int = 60,
+    ):
+        self.max_turns = max_turns or getattr(settings, "COPILOT_CHAT_CONTEXT_TURNS", 6)
+        self.token_budget = token_budget or getattr(
+            settings, "COPILOT_CHAT_CONTEXT_TOKEN_BUDGET", 400
+        )
+        self.summary_share = summary_share or getattr(
+            settings, "COPILOT_CHAT_CONTEXT_SUMMARY_SHARE", 0.4
+        )
+        self.alias = alias or getattr(
+            settings, "COPILOT_CHAT_CONTEXT_CACHE_ALIAS", "default"
+        )
+        self.ttl = ttl or getattr(
+            settings, "COPILOT_CHAT_CONTEXT_TTL", 7 * 24 * 60 * 60
+        )
+        if summarizer is None and getattr(
+            settings, "COPILOT_CHAT_CONTEXT_SUMMARIZE", True
+        ):
+            summarizer = default_summarizer
+        self.summarizer = summarizer
+        self.lock_timeout = lock_timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def summary_chars(self) -> int:
+        return int(self.token_budget * CHARS_PER_TOKEN * self.summary_share)
+
+    def key(self, user_id, scope: str = "summary") -> str:
+        return f"chat_context:{scope}:{user_id}"
+
+    def render(self, user_id) -> str:
+        """
+        Args:
+            user_id: userId of the conversation
+        Returns:
+            Context text of at most token_budget (estimated) tokens, "" if
+            there is no history
+        """
+        state = self.get_summary(user_id)
+        pending, turns = self.unsummarized(user_id, state["through"])
+        summary = self._join(state["summary"], [self._line(turn) for turn in pending])
+        budget = self.token_budget * CHARS_PER_TOKEN
+
+        sections = []
+        if summary:
+            summary = summary[-self.summary_chars :]
+            sections.append("Summary of the earlier conversation:\n" + summary)
+            budget -= len(sections[0]) + 1
+
+        recent = []
+        for turn in reversed(turns):
+            line = self._line(turn)
+            if len(line) + 1 > budget:
+                break
+            recent.insert(0, line)
+            budget -= len(line) + 1
+        if recent:
+            sections.append("Recent messages:\n" + "\n".join(recent))
+        return "\n".join(sections)
+
+    def record_turns(self, user_id, turns: List[Tuple[str, str, str]]):
+        """
+        Store new messages and fold the ones leaving the window into the
+        summary if needed
+        Args:
+            user_id: userId of the conversation
+            turns: (sender, message, attachment) tuples, oldest first
+        """
+        ChatMessage.objects.bulk_create(
+            [
+                ChatMessage(
+                    userId=str(user_id),
+                    **ChatMessage.fields_from_entry(
+                        ChatEntry(None, sender, message, attachment)
+                    ),
+                )
+                for sender, message, attachment in turns
+            ]
+        )
+        self.compact(user_id)
+
+    def get_summary(self, user_id) -> dict:
+        """{"summary": text, "through": cursor of the last folded message or None}"""
+        return self.cache.get(self.key(user_id)) or {"summary": "", "through": None}
+
+    def unsummarized(self, user_id, through: Optional[str]):
+        """
+        Messages after `through`, oldest first, split into those past the
+        window (to be summarized) and the last max_turns. Only the latest
+        few windows are read, older messages that never made it into the
+        summary are dropped
+        Returns:
+            (pending, turns), lists of ChatMessage objects
+        """
+        messages = ChatMessage.objects.for_user(user_id)
+        if through:
+            messages = messages.after(through)
+        messages = list(messages.order_by("-timestamp", "-pk")[: self.max_turns * 4])
+        messages.reverse()
+        split = max(len(messages) - self.max_turns, 0)
+        return messages[:split], messages[split:]
+
+    def compact(self, user_id):
+        """Fold the messages past the window into the summary once they outgrow it"""
+        state = self.get_summary(user_id)
+        pending, _ = self.unsummarized(user_id, state["through"])
+        lines = [self._line(entry) for entry in pending]
+        if len(self._join(state["summary"], lines)) <= self.summary_chars:
+            return
+        # Another worker is folding this conversation, it'll cover these too
+        lock = self.key(user_id, "lock")
+        if not self.cache.add(lock, True, self.lock_timeout):
+            return
+        try:
+            # Re-read under the lock, a previous holder may have moved on
+            state = self.get_summary(user_id)
+            pending, _ = self.unsummarized(user_id, state["through"])
+            if not pending:
+                return
+            lines = [self._line(entry) for entry in pending]
+            summary = None
+            if self.summarizer:
+                try:
+                    summary = self.summarizer(
+                        state["summary"], lines, self.summary_chars
+                    )
+                except Exception as e:
+                    logger.warning("Error summarizing conversation: %s", e)
+            if summary:
+                summary = summary.strip()[-self.summary_chars :]
+            else:
+                # No summarizer: keep the most recent lines that fit
+                summary = self._join(state["summary"], lines)
+                summary = summary[-self.summary_chars :].partition("\n")[2]
+            self.cache.set(
+                self.key(user_id),
+                {"summary": summary, "through": ChatMessage.encode_cursor(pending[-1])},
+                self.ttl,
+            )
+        finally:
+            self.cache.delete(lock)
+
+    def invalidate(self, user_id):
+        self.cache.delete(self.key(user_id))
+
+    def _line(self, message: ChatMessage) -> str:
+        text = " ".join((message.message or "").split())[:MAX_MESSAGE_CHARS]
+        if message.attachment:
+            text = f"{text} [attachment]".strip()
+        return f"{message.sender}: {text}"
+
+    def _join(self, summary: str, lines: List[str]) -> str:
+        return "\n".join([summary] + lines if summary else lines)
+
+
+chat_context = ChatContextBuilder()
@@ -0,0 +1,72 @@
+import calendar
+from datetime import date, timedelta
+from typing import Optional, Tuple
+
+# Half-open date range: start <= date < end
+DateRange = Tuple[date, date]
+
+
+def transaction_date(year, month, day=None) -> Optional[date]:
+    """
+    Date of a transaction's year/month/day ints, None without a valid year
+    and month. A missing day means the 1st, days past the end of the month
+    (e.g. 31 in April) are clamped to its last day.
+    """
+    try:
+        year, month = int(year), int(month)
+        last_day = calendar.monthrange(year, month)[1]
+        return date(year, month, min(max(int(day or 1), 1), last_day))
+    except (TypeError, ValueError, calendar.IllegalMonthError):
+        return None
+
+
+def shift_month(year: int, month: int, offset: int) -> Tuple[int, int]:
+    """(year, month) `offset` months after (or before, if negative) year/month"""
+    index = year * 12 + (month - 1) + offset
+    return index // 12, index % 12 + 1
+
+
+def day_range(day: date) -> DateRange:
+    return day, day + timedelta(days=1)
+
+
+def month_range(year: int, month: int) -> DateRange:
+    return date(year, month, 1), date(*shift_month(year, month, 1), 1)
+
+
+def year_range(year: int) -> DateRange:
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+
+def quarter_range(year: int, quarter: int) -> DateRange:
+    start_month = 3 * (quarter - 1) + 1
+    return date(year, start_month, 1), date(*shift_month(year, start_month, 3), 1)
+
+
+def week_range(day: date, weeks: int = 1) -> DateRange:
+    """`weeks` calendar weeks (Monday to Sunday) starting with the one of `day`"""
+    start = day - timedelta(days=day.weekday())
+    return start, start + timedelta(weeks=weeks)
+
+
+def last_days(days: int, today: Optional[date] = None) -> DateRange:
+    """The last `days` days up to and including today"""
+    today = today or date.today()
+    return today - timedelta(days=days - 1), today + timedelta(days=1)
+
+
+def search_range(year=None, month=None, day=None) -> Optional[DateRange]:
+    """
+    Range of a day, month or year given as (possibly partial) search
+    criteria, None if they don't pin one down (e.g. a month without a year)
+    """
+    try:
+        if year is None:
+            return None
+        if month is None:
+            return year_range(year) if day is None else None
+        if day is None:
+            return month_range(year, month)
+        return day_range(date(year, month, day))
+    except ValueError:
+        return None
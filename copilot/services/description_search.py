@@ -0,0 +1,116 @@
+import re
+from datetime import date
+from difflib import SequenceMatcher
+from typing import Iterable, List, Optional, Set
+
+from django.conf import settings
+
+# Length of the n-grams of the description index (trigrams)
+NGRAM_SIZE = 3
+
+# Weights of the ranking signals of fuzzy description matches
+SIMILARITY_WEIGHT = 0.7
+RECENCY_WEIGHT = 0.2
+AMOUNT_WEIGHT = 0.1
+# Share of a search term's n-grams a description must contain to be a candidate
+MIN_NGRAM_OVERLAP = 0.3
+# Days after which the recency signal of a transaction has halved
+RECENCY_HALF_LIFE_DAYS = 30
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def words(text) -> List[str]:
+    """Lowercase alphanumeric words of a description or search term(s)"""
+    if not text:
+        return []
+    if isinstance(text, (list, tuple)):
+        text = " ".join(str(term) for term in text)
+    return WORD.findall(str(text).lower())
+
+
+def ngrams(text, size: int = NGRAM_SIZE) -> Set[str]:
+    """
+    N-grams of every word of `text`, padded with a space on both sides so
+    short words still have one and word boundaries count ("starbucks" gives
+    " st", "sta", ..., "ks ")
+    """
+    grams = set()
+    for word in words(text):
+        padded = f" {word} "
+        grams.update(
+            padded[i : i + size] for i in range(max(len(padded) - size + 1, 1))
+        )
+    return grams
+
+
+def similarity(terms: List[str], description: str) -> float:
+    """
+    Best SequenceMatcher ratio (0-1) between a search term and a word of the
+    description, or the whole description for multi-word terms
+    """
+    description_words = words(description)
+    if not terms or not description_words:
+        return 0.0
+    targets = description_words + [" ".join(description_words)]
+    return max(
+        SequenceMatcher(None, term, target).ratio()
+        for term in terms
+        for target in targets
+    )
+
+
+def recency(transaction, today: date) -> float:
+    """1 for today, halving every RECENCY_HALF_LIFE_DAYS"""
+    when = transaction.date
+    if when is None:
+        when = transaction.created_at.date() if transaction.created_at else today
+    days = max((today - when).days, 0)
+    return 0.5 ** (days / RECENCY_HALF_LIFE_DAYS)
+
+
+def amount_proximity(transaction, amount: Optional[float]) -> float:
+    """1 for the same amount, falling with the relative difference"""
+    if amount is None:
+        return 0.0
+    difference = abs(float(transaction.amount) - amount)
+    return 1 / (1 + difference / max(abs(amount), 1.0))
+
+
+def rank_matches(
+    transactions: Iterable,
+    terms,
+    amount: Optional[float] = None,
+    today: Optional[date] = None,
+    min_similarity: Optional[float] = None,
+) -> list:
+    """
+    Order candidate transactions by a weighted mix of description similarity,
+    recency and closeness to `amount`, dropping those whose description is
+    less similar than min_similarity (COPILOT_FUZZY_MIN_SIMILARITY)
+    Args:
+        transactions: Candidates, usually from DescriptionNgram.candidate_ids
+        terms: Search term or list of alternative terms
+        amount: Amount the user mentioned, if any
+        today: Reference date of the recency signal
+    Returns:
+        List of transactions, best match first
+    """
+    terms = words(terms)
+    today = today or date.today()
+    if min_similarity is None:
+        min_similarity = getattr(settings, "COPILOT_FUZZY_MIN_SIMILARITY", 0.6)
+
+    scored = []
+    for transaction in transactions:
+        score = similarity(terms, transaction.description)
+        if score < min_similarity:
+            continue
+        score = (
+            SIMILARITY_WEIGHT * score
+            + RECENCY_WEIGHT * recency(transaction, today)
+            + AMOUNT_WEIGHT * amount_proximity(transaction, amount)
+        )
+        scored.append((score, transaction.pk or 0, transaction))
+    scored.sort(key=lambda item: item[:2], reverse=True)
+    return [transaction for _, _, transaction in scored]
@@ -1,43 +1,212 @@
+import contextvars
 import json
+import logging
 import os
 import os.path
 import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from http import client
-from io import BytesIO
 from typing import List, Optional
-from urllib.parse import urljoin
 
-import PIL.Image
-import requests
-import speech_recognition as sr
 from django.conf import settings
 from django.core.files.storage import default_storage
-from django.urls import get_script_prefix
-from google import genai
-from google.genai import types
-from openai import Image
-from pydub import AudioSegment
-
-genaiClient = genai.Client()
+from django.utils.module_loading import import_string
+
+from copilot.constants import PROMPT_CLASSIFY_AND_EXTRACT
+from copilot.datamodels.intent_result import IntentResult, validate_transactions
+from copilot.services.call_policy import CallTimeout, CircuitOpen, ResilientCaller
+from copilot.services.llm_scheduler import (
+    LANE_INTERACTIVE,
+    LLMScheduler,
+    SchedulerSaturated,
+)
+from copilot.services.metrics import (
+    STAGE_ANSWER,
+    STAGE_EXTRACTION,
+    STAGE_TRANSCRIPTION,
+    record_gemini_call,
+    registry,
+    traced,
+)
+from copilot.services.response_cache import MISSING, ResponseCache, media_digest
+
+logger = logging.getLogger(__name__)
+
+# google.genai, PIL, pydub and speech_recognition are slow to import and only
+# needed once a message is processed, so they are imported where they're used.
+
+_gemini_service = None
+_gemini_service_lock = threading.Lock()
+
+
+def get_gemini_service() -> "GeminiService":
+    """
+    Process-wide GeminiService, built on first use so importing this module
+    (e.g. from management commands) needs neither the SDK nor GOOGLE_API_KEY
+    """
+    global _gemini_service
+    if _gemini_service is None:
+        with _gemini_service_lock:
+            if _gemini_service is None:
+                _gemini_service = GeminiService()
+    return _gemini_service
 
 
 class GeminiService:
     def __init__(self):
+        self.client = self.create_client()
+        self._recognizer = None
+        self.response_cache = ResponseCache()
+        self.scheduler = LLMScheduler()
+        self.caller = ResilientCaller()
+        registry.add_collector(self.collect_metrics)
+        self.media_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "COPILOT_MEDIA_DECODE_WORKERS", 4),
+            thread_name_prefix="media-decode",
+        )
+
+    def create_client(self):
+        """
+        genai.Client for GOOGLE_API_KEY, or the client built by the callable
+        named in COPILOT_GEMINI_CLIENT_FACTORY (e.g. the load test's fake,
+        see copilot.loadtest.fake_gemini)
+        """
+        factory = getattr(settings, "COPILOT_GEMINI_CLIENT_FACTORY", None)
+        if factory:
+            return import_string(factory)()
+
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise ValueError("GOOGLE_API_KEY environment variable is not set")
 
-        self.client = genai.Client(api_key=api_key)
-        self.recognizer = sr.Recognizer()
+        from google import genai
+
+        return genai.Client(api_key=api_key)
+
+    @property
+    def recognizer(self):
+        """Speech recognizer, only created once a voice message shows up"""
+        if self._recognizer is None:
+            import speech_recognition as sr
+
+            self._recognizer = sr.Recognizer()
+        return self._recognizer
+
+    def generate(self, method: Optional[str], **kwargs):
+        """
+        Call generate_content under the calling method's CallPolicy
+        (COPILOT_GEMINI_CALL_POLICIES), each request holding a scheduler slot
+        of the method's priority lane (COPILOT_GEMINI_LANES)
+        Raises SchedulerSaturated when the call is shed, CircuitOpen while
+        the method is failing too often
+        """
+        lanes = getattr(settings, "COPILOT_GEMINI_LANES", {})
+        lane = lanes.get(method, lanes.get("default", LANE_INTERACTIVE))
+        started = time.perf_counter()
+        try:
+            response = self.caller.call(
+                method,
+                self.client.models.generate_content,
+                lease=lambda blocking=True: self.scheduler.lease(lane, blocking),
+                **kwargs,
+            )
+        except Exception as e:
+            record_gemini_call(
+                method, time.perf_counter() - started, self.call_outcome(e)
+            )
+            raise
+        record_gemini_call(
+            method,
+            time.perf_counter() - started,
+            "ok",
+            getattr(response, "usage_metadata", None),
+        )
+        return response
+
+    def call_outcome(self, error: Exception) -> str:
+        """Outcome label of a failed Gemini call"""
+        if isinstance(error, SchedulerSaturated):
+            return "shed"
+        if isinstance(error, CircuitOpen):
+            return "circuit_open"
+        if isinstance(error, CallTimeout):
+            return "timeout"
+        return "error"
+
+    def collect_metrics(self, metrics):
+        """Scheduler, circuit and response cache state for /metrics"""
+        scheduler = self.scheduler.stats()
+        metrics.set("copilot_gemini_active_calls", scheduler["active"])
+        for lane, stats in scheduler["lanes"].items():
+            metrics.set("copilot_gemini_queued_calls", stats["queued"], lane=lane)
+            for reason in ("rejected", "timed_out"):
+                metrics.set(
+                    "copilot_gemini_shed_calls_total",
+                    stats[reason],
+                    lane=lane,
+                    reason=reason,
+                )
+        for method, stats in self.caller.stats().items():
+            metrics.set(
+                "copilot_gemini_circuit_open",
+                int(stats["circuit"] != "closed"),
+                method=method,
+            )
+        for method, stats in self.response_cache.stats().items():
+            for result in ("hits", "misses"):
+                metrics.set(
+                    "copilot_gemini_cache_lookups_total",
+                    stats[result],
+                    method=method,
+                    result=result,
+                )
 
-    def send_message(self, prompt, twillio_message) -> str:
+    def send_message(
+        self,
+        prompt,
+        twillio_message,
+        json_response=False,
+        cache_method=None,
+        cache_date=None,
+        context=None,
+    ) -> str:
         """
         Send a text message to Gemini and get the response
+        :param json_response: Ask Gemini for a JSON (application/json) response
+        :param cache_method: Name of the calling method; enables the response
+            cache with that method's TTL (COPILOT_GEMINI_CACHE_TTLS)
+        :param cache_date: Date the response depends on, made part of the cache key
+        :param context: Conversational context (see ChatContextBuilder) sent
+            ahead of the message, made part of the cache key
         """
+        cache_key = None
+        if cache_method and self.response_cache.ttl(cache_method):
+            cache_key = self.response_cache.make_key(
+                cache_method,
+                prompt,
+                twillio_message.body,
+                [
+                    self.media_digest(media)
+                    for media in twillio_message.media
+                    if media.local_path
+                ],
+                cache_date,
+                context,
+            )
+            cached = self.response_cache.get(cache_method, cache_key)
+            if cached is not MISSING:
+                return cached
+
         # Initialize contents list with the prompt
 
         contents = [prompt]
+        if context:
+            contents.append(
+                "Conversation so far, for reference only (the message to handle "
+                "follows):\n" + context
+            )
 
         # Add message body if it exists and is not empty
         if twillio_message.body and twillio_message.body.strip():
@@ -46,43 +215,36 @@ class GeminiService:
         # Add media contents if they exist
         if twillio_message.media:
             media_contents = [
-                self.toBytes(media.local_path, media.content_type)
+                self.media_content(media)
                 for media in twillio_message.media
                 if media.local_path
             ]
-            contents.extend(media_contents)
-        response = self.client.models.generate_content(
+            contents.extend(content for content in media_contents if content)
+        from google.genai import types
+
+        config = (
+            types.GenerateContentConfig(response_mime_type="application/json")
+            if json_response
+            else None
+        )
+        response = self.generate(
+            cache_method,
             model="gemini-2.0-flash",
             contents=contents,
+            config=config,
         )
+        if cache_key and response.text is not None:
+            self.response_cache.set(cache_method, cache_key, response.text)
         return response.text
 
-    # def send_message_with_images(self, message: str, image_urls: List[str]) -> str:
-    #     """
-    #     Send a message with images to Gemini and get the response
-    #     """
-    #     print(f"Sending message with images to Gemini: {message}, {image_urls}")
-    #     try:
-    #         images = []
-    #         for url in image_urls:
-    #             response = requests.get(url)
-    #             img = PIL.Image.open(BytesIO(response.content))
-    #             images.append(img)
-
-    #         response = self.client.models.generate_content(
-    #             model="gemini-2.0-flash", contents=[message, *images]
-    #         )
-    #         return response.text
-    #     except Exception as e:
-    #         print(f"Error sending message with images to Gemini: {str(e)}")
-    #         return "Sorry, I couldn't process your message and images."
-
     def convert_oga_to_wav(self, oga_path: str) -> Optional[str]:
         """
         Convert OGA audio file to WAV format
         :param oga_path: Path to the OGA file
         :return: Path to the converted WAV file or None if conversion fails
         """
+        from pydub import AudioSegment
+
         try:
             # Create a temporary file with .wav extension
             with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav:
@@ -90,10 +252,10 @@ class GeminiService:
                 audio = AudioSegment.from_ogg(oga_path)
                 # Export as WAV
                 audio.export(temp_wav.name, format="wav")
-                print(f"Successfully converted OGA to WAV: {temp_wav.name}")
+                logger.debug("Converted OGA to WAV: %s", temp_wav.name)
                 return temp_wav.name
-        except Exception as e:
-            print(f"Error converting OGA to WAV: {str(e)}")
+        except Exception:
+            logger.exception("Error converting OGA to WAV")
             return None
 
     def convert_speech_to_text(self, audio_file_path: str) -> Optional[str]:
@@ -102,10 +264,12 @@ class GeminiService:
         :param audio_file_path: Absolute path to the audio file
         :return: Transcribed text or None if failed
         """
+        import speech_recognition as sr
+
         try:
             # Check if file exists
             if not os.path.isfile(audio_file_path):
-                print(f"Audio file not found at path: {audio_file_path}")
+                logger.warning("Audio file not found at path: %s", audio_file_path)
                 return None
 
             # Check if file is OGA and convert if necessary
@@ -117,24 +281,25 @@ class GeminiService:
 
             # Load and convert audio file
             with sr.AudioFile(audio_file_path) as source:
-                print(f"Loading audio file from: {audio_file_path}")
+                logger.debug("Loading audio file from: %s", audio_file_path)
                 audio_data = self.recognizer.record(source)
 
             # Convert speech to text
             try:
                 # First try using Google's speech recognition
                 text = self.recognizer.recognize_google(audio_data)
-                print(f"Successfully transcribed audio using Google Speech Recognition")
+                logger.debug("Transcribed audio using Google Speech Recognition")
             except sr.UnknownValueError:
-                print("Google Speech Recognition could not understand audio")
+                logger.info("Google Speech Recognition could not understand audio")
                 return None
             except sr.RequestError as e:
-                print(
-                    f"Could not request results from Google Speech Recognition service; {e}"
+                logger.warning(
+                    "Could not request results from Google Speech Recognition: %s", e
                 )
                 # Fallback to Gemini
                 try:
-                    response = self.client.models.generate_content(
+                    response = self.generate(
+                        "convert_speech_to_text",
                         model="gemini-2.0-flash",
                         contents=[
                             {
@@ -145,9 +310,9 @@ class GeminiService:
                         ],
                     )
                     text = response.text
-                    print(f"Successfully transcribed audio using Gemini fallback")
+                    logger.debug("Transcribed audio using the Gemini fallback")
                 except Exception as gemini_error:
-                    print(f"Gemini fallback also failed: {gemini_error}")
+                    logger.warning("Gemini fallback also failed: %s", gemini_error)
                     return None
 
             # Clean up temporary WAV file if it was created
@@ -155,42 +320,66 @@ class GeminiService:
                 try:
                     os.unlink(audio_file_path)
                 except Exception as e:
-                    print(f"Error removing temporary file: {str(e)}")
+                    logger.warning("Error removing temporary file: %s", e)
 
             return text.strip()
 
-        except Exception as e:
-            print(f"Error converting speech to text: {str(e)}")
+        except Exception:
+            logger.exception("Error converting speech to text")
             return None
 
-    def start_chat(self):
+    def start_chat(self, user_id) -> str:
         """
-        Start a new chat session with Gemini
+        Conversational context to send with the next prompt of a user
+        :param user_id: userId of the conversation
+        :return: Context text within COPILOT_CHAT_CONTEXT_TOKEN_BUDGET
         """
-        # Note: Update this method based on the new client API chat functionality
-        pass
+        from copilot.services.chat_context import chat_context
+
+        return chat_context.render(user_id)
+
+    def summarize_conversation(
+        self, summary: str, lines: List[str], max_chars: int
+    ) -> str:
+        """
+        Fold older chat messages into the rolling conversation summary
+        :param summary: Current summary, may be empty
+        :param lines: "sender: message" lines leaving the recent window
+        :param max_chars: Length the new summary must fit in
+        """
+        prompt = f"""Update the summary of a conversation between a user and a finance assistant on WhatsApp.
+        Keep facts that later messages may refer to (amounts, categories, dates, names, what was created/updated/deleted).
+        Reply with the new summary only, at most {max_chars} characters.
+        Current summary: {summary or "(none)"}
+        New messages:
+        """ + "\n".join(
+            lines
+        )
+        response = self.generate(
+            "summarize_conversation", model="gemini-2.0-flash", contents=[prompt]
+        )
+        return response.text
 
+    @traced(STAGE_EXTRACTION)
     def extract_user_name(self, twilio_message: str) -> Optional[str]:
         """
         Extract user name from the message
         """
-        print("extract_user_name")
         # Note: Update this method based on the new client API chat functionality
         return self.send_message(
             """Extract the full name of user from the message and return only the full name. 
                                  """,
             twilio_message,
+            cache_method="extract_user_name",
         )
 
+    @traced(STAGE_EXTRACTION)
     def extract_transaction_details(self, twilio_message) -> Optional[dict]:
         """
         Extract transaction details from the message
         """
-        print("extract_transaction_details")
         # Note: Update this method based on the new client API chat functionality
         today = datetime.now().strftime("%B-%d-%Y")
-        print(f"Today's date: {today}")
-
         response = self.send_message(
             """Extract transaction details and return a strict JSON object (starting with { and ending with }) in this format:
             {"type": <income|expense>, "category": <shopping|dining|bills|transport|health|misc|salary|gift|rewards>, "amount": <amount in $>, "day": <day (0-31)>, "month":<1-12>, "year":<year>, "description": <description>}.
@@ -199,23 +388,41 @@ class GeminiService:
                 "$date", today
             ),
             twilio_message,
+            cache_method="extract_transaction_details",
+            cache_date=today,
         )
 
-        # Clean the response to ensure it contains valid JSON
-        jsonData = response.strip()
-        # Find the first '{' and last '}'
-        start = jsonData.find("{")
-        end = jsonData.rfind("}")
-        if start != -1 and end != -1:
-            jsonData = jsonData[start : end + 1]
-        print(f"Extracted transaction details: {jsonData}")
-        return json.loads(jsonData)
+        jsonData = self.parse_json(response)
+        logger.debug("Extracted transaction details: %s", jsonData)
+        return jsonData
 
+    @traced(STAGE_EXTRACTION)
+    def extract_multiple_transactions(self, twilio_message) -> List[dict]:
+        """
+        Extract every transaction of a message (e.g. a receipt or a list of
+        expenses) in a single call
+        Returns the valid transactions; raises ValueError if there are none
+        """
+        today = datetime.now().strftime("%B-%d-%Y")
+        response = self.send_message(
+            """Extract all transactions from the message/attached media and return a strict JSON object (starting with { and ending with }) in this format:
+            {"transactions": [{"type": <income|expense>, "category": <shopping|dining|bills|transport|health|misc|salary|gift|rewards>, "amount": <amount in $>, "day": <day (0-31)>, "month":<1-12>, "year":<year>, "description": <description>}, ...]}.
+            Use today's date ($date in mm-dd-yyyy) as default for day, month and year if not specified in the message""".replace(
+                "$date", today
+            ),
+            twilio_message,
+            json_response=True,
+            cache_method="extract_multiple_transactions",
+            cache_date=today,
+        )
+        transactions = validate_transactions(self.parse_json(response))["transactions"]
+        logger.debug("Extracted %d transactions", len(transactions))
+        return transactions
+
+    @traced(STAGE_EXTRACTION)
     def extract_transaction_update_details(self, twilio_message) -> Optional[dict]:
-        print("extract_transaction_update_details")
         """Extract transaction search criteria and update details from the message"""
         today = datetime.now()
-        print(f"Today's date: {today}")
         response = self.send_message(
             """Extract key details from the text required for fetching the correct transaction entry from the db and then updating the correct fields and their values.
             If you find that "description" is the key field, it should always be a fuzzy match.
@@ -248,36 +455,75 @@ class GeminiService:
 
             """,
             twilio_message,
+            cache_method="extract_transaction_update_details",
+            cache_date=today.date().isoformat(),
+            context=twilio_message.context,
         )
         # Clean and parse JSON response
         try:
-            jsonData = response.strip()
-            start = jsonData.find("{")
-            end = jsonData.rfind("}")
-            if start != -1 and end != -1:
-                jsonData = jsonData[start : end + 1]
-            print(f"Extracted transaction update details: {jsonData}")
-            parsed_data = json.loads(jsonData)
-
-            # Convert relative dates to absolute dates
-            if "search" in parsed_data:
-                search = parsed_data["search"]
-                if "day" in search and search["day"] == "<today-7>":
-                    search["day"] = (today - timedelta(days=7)).day
-                elif "day" in search and search["day"] == "<yesterday's day>":
-                    search["day"] = (today - timedelta(days=1)).day
-
-                # Ensure current year/month if not specified
-                if "year" not in search or str(search["year"]).startswith("<"):
-                    search["year"] = today.year
-                if "month" not in search or str(search["month"]).startswith("<"):
-                    search["month"] = today.month
-
-            return parsed_data
+            parsed_data = self.parse_json(response)
+            logger.debug("Extracted transaction update details: %s", parsed_data)
+            return self.resolve_search_dates(parsed_data, today)
         except Exception as e:
-            print(f"Error parsing transaction update details: {str(e)}")
+            logger.warning("Error parsing transaction update details: %s", e)
             return None
 
+    def classify_and_extract(self, twilio_message) -> IntentResult:
+        """
+        Classify the intent of the message and extract its intent-specific
+        details in a single Gemini call
+        Raises ValueError if the response doesn't match the expected schema
+        """
+        today = datetime.now()
+        response = self.send_message(
+            PROMPT_CLASSIFY_AND_EXTRACT.replace("$date", today.strftime("%B-%d-%Y")),
+            twilio_message,
+            json_response=True,
+            cache_method="classify_and_extract",
+            cache_date=today.date().isoformat(),
+            context=twilio_message.context,
+        )
+        result = IntentResult.from_dict(self.parse_json(response))
+        if result.intent in ("UPDATE_TRANSACTION", "DELETE_TRANSACTION"):
+            self.resolve_search_dates(result.payload, today)
+        logger.debug("Classified and extracted: %s", result)
+        return result
+
+    def parse_json(self, response: str):
+        """
+        Parse the JSON object contained in a Gemini response
+        """
+        # Clean the response to ensure it contains valid JSON
+        jsonData = response.strip()
+        # Find the first '{' and last '}'
+        start = jsonData.find("{")
+        end = jsonData.rfind("}")
+        if start != -1 and end != -1:
+            jsonData = jsonData[start : end + 1]
+        return json.loads(jsonData)
+
+    def resolve_search_dates(self, parsed_data: dict, today: datetime) -> dict:
+        """
+        Convert relative dates in the "search" criteria of update details to
+        absolute dates and drop the date parts Gemini didn't extract, so
+        they don't restrict the search
+        """
+        search = parsed_data.get("search") if parsed_data else None
+        if isinstance(search, dict):
+            offset = {"<today-7>": 7, "<yesterday's day>": 1}.get(search.get("day"))
+            if offset is not None:
+                resolved = today - timedelta(days=offset)
+                search.update(
+                    year=resolved.year, month=resolved.month, day=resolved.day
+                )
+            for field in ("year", "month", "day"):
+                value = search.get(field)
+                if value in (None, "") or str(value).startswith("<"):
+                    search.pop(field, None)
+
+        return parsed_data
+
+    @traced(STAGE_ANSWER)
     def answer_miscellaneous_query(self, twilio_message) -> str:
         """
         Answer miscellaneous queries
@@ -285,43 +531,111 @@ class GeminiService:
         prompt = """Answer the miscellaneous query based on your knowledge only if it is related to personal finances or financial literacy. Otherwise reply with "Sorry, I couldn't process your query".
             """ + (
             ("Query:" + twilio_message.body)
-            if (not twilio_message.body and len(twilio_message.body.strip()) > 0)
+            if (twilio_message.body and len(twilio_message.body.strip()) > 0)
             else ""
         )
         twilio_message.body = ""
-        return self.send_message(prompt, twilio_message)
+        return self.send_message(
+            prompt,
+            twilio_message,
+            cache_method="answer_miscellaneous_query",
+            context=twilio_message.context,
+        )
 
+    @traced(STAGE_ANSWER)
     def answer_analytical_query(self, twilio_message) -> str:
         """
         Answer analytical queries
         """
         today = datetime.now().strftime("%B-%d-%Y")
-        print(f"Today's date: {today}")
         return self.send_message(
-            """Answer the analytical query based on the data provided in the message from a personal finances perspective. You are the best finance assistant ever made in the universe".
+            """Answer the analytical query based on the data provided in the message (a summary of the user's finances followed by the transactions relevant to the query) from a personal finances perspective. You are the best finance assistant ever made in the universe".
             Remember that the country is USA and the currency is USD. THe date format is month-Day-year.
             Today's date = $current_date
             """.replace(
                 "$current_date", today
             ),
             twilio_message,
+            cache_method="answer_analytical_query",
+            cache_date=today,
         )
 
+    def prepare_media(self, twilio_message) -> List[Future]:
+        """
+        Start decoding every media item of the message in the background, so
+        transcription and image decoding overlap with each other and with
+        the rest of the pipeline. Returns the futures; prompts that need the
+        media before it's ready wait for the same computation.
+        """
+        # Each task runs in a copy of the caller's context to keep its trace
+        return [
+            self.media_executor.submit(
+                contextvars.copy_context().run, self.media_content, media
+            )
+            for media in twilio_message.media
+            if media.local_path
+        ]
+
+    def media_digest(self, media) -> str:
+        """SHA-256 of a media item, computed once per message"""
+        if media.digest is None:
+            media.digest = media_digest(media.local_path)
+        return media.digest
+
+    def media_content(self, media):
+        """
+        Decoded content of a media item for Gemini: the PIL image for images,
+        the transcript for voice messages. Computed once and kept on the
+        TwilioMedia so every prompt about the message reuses it.
+        """
+        with media.lock:
+            self.media_digest(media)
+            if media.content_type.startswith("image"):
+                if media.image is None:
+                    media.image = self.toBytes(media.local_path, media.content_type)
+                    media.image.load()
+                return media.image
+            elif media.content_type.startswith("audio"):
+                if media.transcript is None:
+                    media.transcript = self.transcribe(media)
+                return "Voice Message: " + media.transcript
+            return None
+
+    @traced(STAGE_TRANSCRIPTION)
+    def transcribe(self, media) -> str:
+        """
+        Speech-to-text of an audio media item, cached by content digest so a
+        forwarded or resent voice note is only transcribed once
+        """
+        method = "convert_speech_to_text"
+        cache_key = None
+        if self.response_cache.ttl(method):
+            cache_key = self.response_cache.make_key(method, "", "", [media.digest])
+            cached = self.response_cache.get(method, cache_key)
+            if cached is not MISSING:
+                return cached
+
+        transcript = self.convert_speech_to_text(default_storage.path(media.local_path))
+        if not transcript:
+            return ""
+        if cache_key:
+            self.response_cache.set(method, cache_key, transcript)
+        return transcript
+
     def toBytes(self, media_path, content_type):
         """
-        Convert media file to appropriate format for Gemini API
+        Convert an image file to the format of the Gemini API (voice messages
+        are transcribed instead, see transcribe)
         Args:
             media_path: Relative path to media file in storage
             content_type: MIME type of the media
+        Returns:
+            PIL image, None for other media
         """
+        if not content_type.startswith("image"):
+            return None
 
-        # Get absolute filesystem path
-        abs_file_path = default_storage.path(media_path)
-        print(f"Absolute file path: {abs_file_path}")
+        import PIL.Image
 
-        if content_type.startswith("image"):
-            # For images, load the file directly using PIL
-            return PIL.Image.open(abs_file_path)
-        elif content_type.startswith("audio"):
-            # For audio, use the absolute file path
-            return "Voice Message: " + self.convert_speech_to_text(abs_file_path)
+        # For images, load the file directly using PIL
+        return PIL.Image.open(default_storage.path(media_path))
@@ -0,0 +1,99 @@
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+
+
+class MessageInProgress(Exception):
+    """Another execution of the same message did not finish in time"""
+
+
+class IdempotencyStore:
+    """
+    Outcome of each inbound message, keyed on its MessageSid, kept in a Django
+    cache (COPILOT_IDEMPOTENCY_CACHE_ALIAS) for `ttl` seconds.
+    The first execution of a message claims it with cache.add (atomic on
+    every backend). Retries and duplicate jobs then reuse the stored reply,
+    and duplicates arriving while the first execution is still running wait
+    for its result. A claim that is never finished, e.g. because the worker
+    died, expires after `lease` seconds.
+    Webhook receivers and workers only see each other's records when the
+    alias points to a shared backend (database, Redis, Memcached).
+    """
+
+    def __init__(
+        self,
+        alias: Optional[str] = None,
+        ttl: Optional[int] = None,
+        lease: Optional[int] = None,
+        wait_timeout: Optional[float] = None,
+        poll_interval: float = 0.25,
+    ):
+        self.alias = alias or getattr(
+            settings, "COPILOT_IDEMPOTENCY_CACHE_ALIAS", "idempotency"
+        )
+        self.ttl = ttl or getattr(settings, "COPILOT_IDEMPOTENCY_TTL", 24 * 60 * 60)
+        self.lease = lease or getattr(settings, "COPILOT_IDEMPOTENCY_LEASE", 300)
+        self.wait_timeout = (
+            wait_timeout
+            if wait_timeout is not None
+            else getattr(settings, "COPILOT_IDEMPOTENCY_WAIT", 30)
+        )
+        self.poll_interval = poll_interval
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, message_sid: str, scope: str = "result") -> str:
+        return f"idempotency:{scope}:{message_sid}"
+
+    def mark_received(self, message_sid: str) -> bool:
+        """
+        Record a webhook delivery
+        Returns:
+            False if this MessageSid was already received within the TTL
+        """
+        return self.cache.add(self.key(message_sid, "received"), True, self.ttl)
+
+    def acquire(self, message_sid: str) -> Optional[dict]:
+        """
+        Claim the execution of a message
+        Returns:
+            None if the caller owns the execution and must call finish (or
+            release), otherwise the record of the first execution:
+            {"state": "done", "reply": ..., "sent": bool}
+        Raises:
+            MessageInProgress if the first execution is still running after
+            wait_timeout seconds
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        key = self.key(message_sid)
+        while True:
+            if self.cache.add(key, {"state": STATE_RUNNING}, self.lease):
+                return None
+            record = self.cache.get(key)
+            if record is not None and record["state"] == STATE_DONE:
+                return record
+            if time.monotonic() >= deadline:
+                raise MessageInProgress(f"Message {message_sid} is being processed")
+            time.sleep(self.poll_interval)
+
+    def finish(self, message_sid: str, reply, sent: bool = False):
+        """Store the reply of an owned execution"""
+        self.cache.set(
+            self.key(message_sid),
+            {"state": STATE_DONE, "reply": reply, "sent": sent},
+            self.ttl,
+        )
+
+    def mark_sent(self, message_sid: str, reply):
+        self.finish(message_sid, reply, sent=True)
+
+    def release(self, message_sid: str):
+        """Give up an owned execution so a retry starts from scratch"""
+        self.cache.delete(self.key(message_sid))
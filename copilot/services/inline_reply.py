@@ -0,0 +1,131 @@
+import logging
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Decision of a message: {"reply": answer} of the worker, or this marker once
+# the webhook stopped waiting (tagged, so no answer can be mistaken for it)
+GAVE_UP = {"gave_up": True}
+
+# Cache backends that are private to a process, so a webhook and a worker
+# process never see each other's keys
+PROCESS_LOCAL_BACKENDS = ("LocMemCache", "DummyCache")
+
+
+class InlineReplyBroker:
+    """
+    Hands a worker's answer to the webhook request of the same message, so
+    it goes out inline in the TwiML response instead of over the REST API.
+
+    The webhook registers as the waiter of a MessageSid (one per message)
+    before queueing the message, so a worker can never finish first, then
+    polls until COPILOT_INLINE_REPLY_DEADLINE. A finished worker offers its
+    answer if a waiter is registered. Who wins is decided by a single
+    cache.add of the "decision" key: either the worker's answer or the
+    webhook's GAVE_UP marker, so an answer is never both inlined and sent,
+    nor dropped. Uses the idempotency cache (COPILOT_IDEMPOTENCY_CACHE_ALIAS),
+    webhook and worker processes only meet through a shared backend, so the
+    broker is disabled on a process-local one (LocMemCache) unless
+    COPILOT_INLINE_REPLY_SAME_PROCESS says webhook and workers share a
+    process (manage.py loadtest).
+    """
+
+    def __init__(
+        self,
+        alias: Optional[str] = None,
+        deadline: Optional[float] = None,
+        poll_interval: float = 0.05,
+    ):
+        self.alias = alias or getattr(
+            settings, "COPILOT_IDEMPOTENCY_CACHE_ALIAS", "idempotency"
+        )
+        self.deadline = (
+            deadline
+            if deadline is not None
+            else getattr(settings, "COPILOT_INLINE_REPLY_DEADLINE", 5)
+        )
+        self.poll_interval = poll_interval
+        self._enabled = None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def shared(self) -> bool:
+        """Whether webhook and worker processes see the same cache entries"""
+        if getattr(settings, "COPILOT_INLINE_REPLY_SAME_PROCESS", False):
+            return True
+        return type(self.cache).__name__ not in PROCESS_LOCAL_BACKENDS
+
+    @property
+    def enabled(self) -> bool:
+        if self.deadline <= 0:
+            return False
+        if self._enabled is None:
+            self._enabled = self.shared
+            if not self._enabled:
+                logger.info(
+                    "Inline replies disabled: the %r cache is local to each "
+                    "process, replies are sent over the REST API",
+                    self.alias,
+                )
+        return self._enabled
+
+    def key(self, message_sid: str, scope: str) -> str:
+        return f"inline_reply:{scope}:{message_sid}"
+
+    def register(self, message_sid: str) -> bool:
+        """
+        Become the waiter of a message, before it is queued. Every
+        registered message must then be waited for, with a timeout of 0 to
+        give up right away
+        Returns:
+            False if inline replies are disabled or the message has a waiter
+        """
+        if not self.enabled:
+            return False
+        # Outlives the wait so a late worker still sees a decision to make
+        timeout = int(self.deadline) + 60
+        return self.cache.add(self.key(message_sid, "waiter"), True, timeout)
+
+    def wait(self, message_sid: str, timeout: Optional[float] = None):
+        """
+        Wait for the worker's answer of a registered message
+        Args:
+            timeout: Seconds to wait, at most the deadline
+        Returns:
+            The answer, or None once the webhook gave up (the worker then
+            sends it over REST)
+        """
+        key = self.key(message_sid, "decision")
+        wait = self.deadline if timeout is None else min(timeout, self.deadline)
+        deadline = time.monotonic() + max(wait, 0)
+        while time.monotonic() < deadline:
+            decision = self.cache.get(key)
+            if decision is not None:
+                return decision.get("reply")
+            time.sleep(self.poll_interval)
+        if self.cache.add(key, GAVE_UP, int(self.deadline) + 60):
+            return None
+        # The worker offered its answer at the last moment
+        decision = self.cache.get(key) or GAVE_UP
+        return decision.get("reply")
+
+    def offer(self, message_sid: str, answer: str) -> bool:
+        """
+        Offer a worker's answer to the message's waiting webhook
+        Returns:
+            True if the webhook takes it, False if the caller must send it
+        """
+        if not self.enabled or not self.cache.get(self.key(message_sid, "waiter")):
+            return False
+        return self.cache.add(
+            self.key(message_sid, "decision"),
+            {"reply": answer},
+            int(self.deadline) + 60,
+        )
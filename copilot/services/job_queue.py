@@ -0,0 +1,260 @@
+import logging
+import threading
+import time
+import traceback
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from copilot.models import QueuedJob
+
+logger = logging.getLogger(__name__)
+
+
+class Deferred(Exception):
+    """
+    Raised by a handler to put its job back without using up an attempt,
+    e.g. when rate limited
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(f"Deferred for {delay:.1f}s")
+        self.delay = delay
+
+
+class PermanentError(Exception):
+    """
+    Raised by a handler for a failure retrying cannot fix, e.g. an invalid
+    destination; the job fails right away
+    """
+
+
+class JobQueue:
+    """
+    Durable job queue backed by a QueuedJob model.
+    Jobs are claimed with a conditional update so several worker threads or
+    processes can poll the same table without handing a job out twice.
+    A claimed job holds a lease; if its worker dies the lease expires and the
+    job becomes claimable again. A job deferred more than max_deferrals times
+    fails, so a lasting outage or rate limit can't keep it queued forever.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_attempts: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+        lease_seconds: Optional[int] = None,
+        max_deferrals: Optional[int] = None,
+    ):
+        self.model = model
+        self.max_attempts = max_attempts or getattr(
+            settings, "COPILOT_JOB_MAX_ATTEMPTS", 3
+        )
+        self.retry_backoff = (
+            retry_backoff
+            if retry_backoff is not None
+            else getattr(settings, "COPILOT_JOB_RETRY_BACKOFF", 5.0)
+        )
+        self.lease_seconds = lease_seconds or getattr(
+            settings, "COPILOT_JOB_LEASE_SECONDS", 300
+        )
+        self.max_deferrals = max_deferrals or getattr(
+            settings, "COPILOT_JOB_MAX_DEFERRALS", 30
+        )
+
+    def enqueue(self, delay: float = 0, **fields):
+        """
+        Persist a new pending job
+        Args:
+            delay: Seconds before the job becomes claimable
+            fields: Model fields of the job
+        Returns:
+            Created job object
+        """
+        return self.model.objects.create(
+            available_at=timezone.now() + timedelta(seconds=delay), **fields
+        )
+
+    def claimable(self):
+        """Jobs that are due, including running jobs whose lease expired"""
+        now = timezone.now()
+        return self.model.objects.filter(
+            Q(status=QueuedJob.STATUS_PENDING, available_at__lte=now)
+            | Q(status=QueuedJob.STATUS_RUNNING, locked_until__lt=now)
+        )
+
+    def claim(self, batch_size: int = 10):
+        """
+        Claim the oldest due job
+        Returns:
+            Claimed job object (status running, attempts incremented) or None
+        """
+        for job in self.claimable().order_by("available_at")[:batch_size]:
+            if not self.can_claim(job):
+                continue
+            locked_until = timezone.now() + timedelta(seconds=self.lease_seconds)
+            claimed = self.model.objects.filter(
+                pk=job.pk, status=job.status, attempts=job.attempts
+            ).update(
+                status=QueuedJob.STATUS_RUNNING,
+                attempts=job.attempts + 1,
+                locked_until=locked_until,
+            )
+            if claimed:
+                job.status = QueuedJob.STATUS_RUNNING
+                job.attempts += 1
+                job.locked_until = locked_until
+                return job
+        return None
+
+    def can_claim(self, job) -> bool:
+        """Whether a due job may be handed out now, for subclasses that order jobs"""
+        return True
+
+    def complete(self, job, **fields):
+        """Mark a claimed job as done, optionally updating extra fields"""
+        fields.update(status=QueuedJob.STATUS_DONE, locked_until=None, last_error="")
+        self.model.objects.filter(pk=job.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(job, name, value)
+
+    def fail(self, job, error: str, retry: bool = True):
+        """
+        Record a failed attempt. The job is retried with exponential backoff
+        until max_attempts is reached (or right away with retry=False), after
+        which it stays failed until replayed (see on_failed).
+        """
+        if not retry or job.attempts >= self.max_attempts:
+            fields = {"status": QueuedJob.STATUS_FAILED}
+        else:
+            delay = self.retry_backoff * (2 ** (job.attempts - 1))
+            fields = {
+                "status": QueuedJob.STATUS_PENDING,
+                "available_at": timezone.now() + timedelta(seconds=delay),
+            }
+        fields.update(locked_until=None, last_error=error)
+        self.model.objects.filter(pk=job.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(job, name, value)
+        if job.status == QueuedJob.STATUS_FAILED:
+            try:
+                self.on_failed(job)
+            except Exception:
+                logger.exception("Error handling the failure of %s", job)
+
+    def on_failed(self, job):
+        """Called once a job failed for good, for subclasses that report failures"""
+
+    def defer(self, job, delay: float):
+        """
+        Return a claimed job to the queue for `delay` seconds, attempt not
+        counted. Fails the job once it was deferred max_deferrals times
+        """
+        if job.deferrals >= self.max_deferrals:
+            logger.warning("Giving up on %s after %d deferrals", job, job.deferrals)
+            self.fail(job, f"Deferred {job.deferrals} times", retry=False)
+            return
+        fields = {
+            "status": QueuedJob.STATUS_PENDING,
+            "attempts": job.attempts - 1,
+            "deferrals": job.deferrals + 1,
+            "available_at": timezone.now() + timedelta(seconds=delay),
+            "locked_until": None,
+        }
+        self.model.objects.filter(pk=job.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(job, name, value)
+
+    def replay(self, queryset) -> int:
+        """
+        Reset jobs so they are processed again from scratch
+        Returns:
+            Number of jobs requeued
+        """
+        return queryset.update(
+            status=QueuedJob.STATUS_PENDING,
+            attempts=0,
+            deferrals=0,
+            available_at=timezone.now(),
+            locked_until=None,
+            last_error="",
+        )
+
+    def run_once(self, handler: Callable) -> bool:
+        """
+        Claim and process a single job
+        Returns:
+            True if a job was processed (successfully or not)
+        """
+        job = self.claim()
+        if job is None:
+            return False
+        try:
+            handler(job)
+            self.complete(job)
+        except Deferred as e:
+            self.defer(job, e.delay)
+        except PermanentError as e:
+            logger.warning("Giving up on %s: %s", job, e)
+            self.fail(job, str(e), retry=False)
+        except Exception:
+            logger.exception("Error processing %s", job)
+            self.fail(job, traceback.format_exc())
+        return True
+
+    def work(
+        self,
+        handler: Callable,
+        stop_event: threading.Event,
+        poll_interval: Optional[float] = None,
+    ):
+        """Process jobs until stop_event is set, sleeping while the queue is empty"""
+        poll_interval = poll_interval or getattr(
+            settings, "COPILOT_WORKER_POLL_INTERVAL", 1.0
+        )
+        while not stop_event.is_set():
+            close_old_connections()
+            try:
+                processed = self.run_once(handler)
+            except Exception:
+                # Lost the DB connection or similar; back off and keep polling
+                logger.exception("Worker error")
+                processed = False
+            if not processed:
+                stop_event.wait(poll_interval)
+        close_old_connections()
+
+
+def run_worker_pool(
+    queue: JobQueue,
+    handler: Callable,
+    concurrency: int,
+    stop_event: threading.Event,
+    poll_interval: Optional[float] = None,
+):
+    """
+    Run `concurrency` worker threads against a queue until stop_event is set
+    """
+    threads = [
+        threading.Thread(
+            target=queue.work,
+            args=(handler, stop_event, poll_interval),
+            name=f"copilot-worker-{i}",
+            daemon=True,
+        )
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        stop_event.set()
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from django.conf import settings
+
+# Priority lanes, most important first
+LANE_INTERACTIVE = "interactive"
+LANE_ANALYTICS = "analytics"
+LANE_BACKGROUND = "background"
+LANES = (LANE_INTERACTIVE, LANE_ANALYTICS, LANE_BACKGROUND)
+
+
+class LLMUnavailable(Exception):
+    """Gemini cannot take the call right now; callers shed or defer the work"""
+
+
+class SchedulerSaturated(LLMUnavailable):
+    """A Gemini call was shed: its lane's queue is full or its wait timed out"""
+
+    def __init__(self, lane: str, reason: str):
+        super().__init__(f"Gemini {lane} lane saturated: {reason}")
+        self.lane = lane
+
+
+class LLMScheduler:
+    """
+    Bounded-concurrency gate in front of the Gemini client.
+    At most `concurrency` requests are in flight at once (per process),
+    each holding a slot until it finishes (see ResilientCaller). Callers beyond
+    that wait in priority order (interactive, then analytics, then
+    background, FIFO within a lane). A lane whose queue is longer than its
+    max_queue rejects new calls right away, and a call that waited longer
+    than its lane's max_wait gives up; both raise SchedulerSaturated so the
+    caller can shed the work.
+    """
+
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        max_queue: Optional[dict] = None,
+        max_wait: Optional[dict] = None,
+    ):
+        self.concurrency = concurrency or getattr(
+            settings, "COPILOT_GEMINI_CONCURRENCY", 8
+        )
+        self.max_queue = max_queue or getattr(settings, "COPILOT_GEMINI_MAX_QUEUE", {})
+        self.max_wait = max_wait or getattr(settings, "COPILOT_GEMINI_MAX_WAIT", {})
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []  # heap of (lane rank, sequence)
+        self._sequence = itertools.count()
+        self._depth = {lane: 0 for lane in LANES}
+        self._stats = {
+            lane: {
+                "submitted": 0,
+                "granted": 0,
+                "rejected": 0,
+                "timed_out": 0,
+                "completed": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0,
+            }
+            for lane in LANES
+        }
+
+    def run(self, lane: str, fn: Callable, *args, **kwargs):
+        """Call fn(*args, **kwargs) once a slot of `lane` is granted"""
+        with self.slot(lane):
+            return fn(*args, **kwargs)
+
+    @contextmanager
+    def slot(self, lane: str):
+        self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def lease(self, lane: str, blocking: bool = True) -> Callable[[], None]:
+        """
+        Take a slot of `lane` for a request finished on another thread
+        Args:
+            blocking: False to raise SchedulerSaturated right away instead of
+                queueing when no slot is free (e.g. for a hedged request)
+        Returns:
+            Function releasing the slot
+        """
+        self.acquire(lane, blocking)
+        return lambda: self.release(lane)
+
+    def acquire(self, lane: str, blocking: bool = True):
+        if lane not in LANES:
+            raise ValueError(f"Unknown Gemini lane: {lane}")
+        started = time.monotonic()
+        with self._cond:
+            free = self._active < self.concurrency and not self._waiting
+            if not blocking and not free:
+                # Not counted as shed, the caller does without the call
+                raise SchedulerSaturated(lane, "no free slot")
+            stats = self._stats[lane]
+            stats["submitted"] += 1
+            if free:
+                self._active += 1
+                stats["granted"] += 1
+                return
+
+            if self._depth[lane] >= self.max_queue.get(lane, float("inf")):
+                stats["rejected"] += 1
+                raise SchedulerSaturated(lane, f"{self._depth[lane]} calls queued")
+
+            ticket = (LANES.index(lane), next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            self._depth[lane] += 1
+            max_wait = self.max_wait.get(lane)
+            try:
+                while self._active >= self.concurrency or self._waiting[0] != ticket:
+                    if max_wait is None:
+                        self._cond.wait()
+                        continue
+                    remaining = started + max_wait - time.monotonic()
+                    if remaining <= 0:
+                        stats["timed_out"] += 1
+                        raise SchedulerSaturated(lane, f"no slot within {max_wait}s")
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+                self._active += 1
+                stats["granted"] += 1
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._depth[lane] -= 1
+                # The next waiter may be able to go (or become the head)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+
+    def release(self, lane: str):
+        with self._cond:
+            self._active -= 1
+            self._stats[lane]["completed"] += 1
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Queue depth, wait time and shed counters per lane of this process"""
+        with self._cond:
+            lanes = {}
+            for lane, stats in self._stats.items():
+                lanes[lane] = dict(
+                    stats,
+                    queued=self._depth[lane],
+                    wait_seconds_avg=(
+                        stats["wait_seconds_total"] / stats["granted"]
+                        if stats["granted"]
+                        else 0.0
+                    ),
+                )
+            return {
+                "concurrency": self.concurrency,
+                "active": self._active,
+                "lanes": lanes,
+            }
@@ -0,0 +1,364 @@
+import re
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+from copilot.datamodels.intent_result import IntentResult
+
+# fmt: off
+# Words that map a message to one of the categories of the extraction prompt
+CATEGORY_KEYWORDS = {
+    "dining": [
+        "coffee", "lunch", "dinner", "breakfast", "brunch", "restaurant", "cafe",
+        "pizza", "burger", "food", "snack", "snacks", "drinks", "beer", "bar",
+        "starbucks", "mcdonalds", "subway", "chipotle", "doordash", "ubereats",
+        "grubhub", "takeout", "tea",
+    ],
+    "shopping": [
+        "shopping", "amazon", "walmart", "target", "instacart", "groceries",
+        "grocery", "clothes", "shoes", "shirt", "jeans", "costco", "mall",
+        "electronics", "books",
+    ],
+    "bills": [
+        "rent", "bill", "bills", "electricity", "electric", "internet", "wifi",
+        "phone", "water", "utilities", "utility", "insurance", "subscription",
+        "netflix", "spotify", "mortgage",
+    ],
+    "transport": [
+        "uber", "lyft", "taxi", "cab", "gas", "fuel", "petrol", "bus", "train",
+        "metro", "subway fare", "parking", "toll", "flight", "amtrak", "delta",
+    ],
+    "health": [
+        "doctor", "pharmacy", "medicine", "medicines", "hospital", "dentist",
+        "gym", "cvs", "walgreens", "clinic", "therapy", "health",
+    ],
+    "salary": ["salary", "paycheck", "payroll", "wages", "wage", "stipend"],
+    "gift": ["gift", "gifts", "birthday", "present"],
+    "rewards": ["reward", "rewards", "cashback", "cash back", "points", "bonus"],
+}
+
+INCOME_CATEGORIES = {"salary", "gift", "rewards"}
+
+INCOME_WORDS = [
+    "got", "received", "receive", "earned", "earn", "salary", "paycheck",
+    "income", "refund", "refunded", "bonus", "deposited", "credited", "won",
+    "paid me", "sold",
+]
+EXPENSE_WORDS = [
+    "spent", "spend", "paid", "pay", "bought", "buy", "purchased", "cost",
+    "costs", "charged", "expense", "ordered", "gave",
+]
+UPDATE_WORDS = ["change", "update", "edit", "modify", "correct", "make that", "should be"]
+DELETE_WORDS = ["delete", "remove", "cancel", "undo", "erase"]
+QUESTION_WORDS = ["how much", "how many", "what", "show", "total", "summary", "summarize", "list", "breakdown"]
+# First words that make a message a question even without a "?"
+QUESTION_OPENERS = ["did", "do", "does", "how", "what", "was", "were", "is", "are", "am", "can", "should", "when", "where", "which", "why"]
+# Plans and reminders mention amounts but aren't transactions (yet)
+FUTURE_WORDS = ["tomorrow", "next", "will", "planning", "plan to", "going to", "gonna", "remind", "need to", "have to", "want to", "should", "later"]
+FINANCE_WORDS = ["spend", "spent", "spending", "expense", "expenses", "income", "earn", "earned", "budget", "save", "saved", "money", "transactions"]
+# (pattern, confidence), "i am ..." is as likely to be "i am broke" as a name,
+# so it stays below COPILOT_DEGRADED_PARSER_THRESHOLD and always goes to Gemini
+NAME_PATTERNS = [
+    (re.compile(r"^(?:hi|hello|hey)?[,!. ]*(?:my name is|call me) ([a-z][a-z .'-]{0,60})$"), 0.9),
+    (re.compile(r"^(?:hi|hello|hey)?[,!. ]*(?:i am|i'm|this is) ([a-z][a-z .'-]{0,60})$"), 0.3),
+]
+
+AMOUNT_PATTERN = re.compile(
+    r"(?P<currency>\$|usd|€|£|₹|eur|gbp|inr|rs\.?)?\s*"
+    r"(?P<number>\d{1,3}(?:,\d{3})+|\d+)(?:\.(?P<cents>\d{1,2}))?"
+    r"(?P<suffix>k\b)?\s*(?P<unit>dollars?|bucks|usd)?",
+    re.I,
+)
+DOLLAR_MARKERS = {"$", "usd", "dollar", "dollars", "bucks"}
+# Numbers counting something else ("5 hours at the gym") aren't amounts
+NON_AMOUNT_UNITS = re.compile(
+    r"\s*(hours?|hrs?|minutes?|mins?|km|miles?|kg|lbs?|times|people|items?)\b"
+)
+# Highest confidence of an amount without a currency marker: "spent 5 at the
+# gym" may be anything, so it never skips Gemini
+UNMARKED_AMOUNT_CONFIDENCE = 0.6
+
+MONTHS = {
+    name: index
+    for index, names in enumerate(
+        [
+            ("jan", "january"), ("feb", "february"), ("mar", "march"),
+            ("apr", "april"), ("may",), ("jun", "june"), ("jul", "july"),
+            ("aug", "august"), ("sep", "sept", "september"), ("oct", "october"),
+            ("nov", "november"), ("dec", "december"),
+        ],
+        start=1,
+    )
+    for name in names
+}
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+MONTH_NAMES = "|".join(sorted(MONTHS, key=len, reverse=True))
+# fmt: on
+
+DATE_PATTERNS = [
+    (
+        re.compile(r"\bday before yesterday\b"),
+        lambda m, today: today - timedelta(days=2),
+    ),
+    (
+        re.compile(r"\byesterday\b|\blast night\b"),
+        lambda m, today: today - timedelta(days=1),
+    ),
+    (
+        re.compile(r"\btoday\b|\btonight\b|\bthis (?:morning|afternoon|evening)\b"),
+        lambda m, today: today,
+    ),
+    (
+        re.compile(r"\b(\d+|a|one|two|three|four|five|six) (day|week)s? ago\b"),
+        lambda m, today: today
+        - timedelta(days=_number(m.group(1)) * (7 if m.group(2) == "week" else 1)),
+    ),
+    (re.compile(r"\blast week\b"), lambda m, today: today - timedelta(days=7)),
+    (
+        re.compile(r"\b(?:on |last )?(" + "|".join(WEEKDAYS) + r")\b"),
+        lambda m, today: today
+        - timedelta(days=(today.weekday() - WEEKDAYS.index(m.group(1))) % 7 or 7),
+    ),
+    (
+        re.compile(
+            r"\b(" + MONTH_NAMES + r")\.? (\d{1,2})(?:st|nd|rd|th)?(?:,? (\d{4}))?\b"
+        ),
+        lambda m, today: _make_date(
+            today, MONTHS[m.group(1)], int(m.group(2)), m.group(3)
+        ),
+    ),
+    (
+        re.compile(
+            r"\b(\d{1,2})(?:st|nd|rd|th)? (?:of )?("
+            + MONTH_NAMES
+            + r")\b(?:,? (\d{4}))?"
+        ),
+        lambda m, today: _make_date(
+            today, MONTHS[m.group(2)], int(m.group(1)), m.group(3)
+        ),
+    ),
+    (
+        # US format, as used by the rest of the app: month/day[/year]
+        re.compile(r"\b(\d{1,2})/(\d{1,2})(?:/(\d{2,4}))?\b"),
+        lambda m, today: _make_date(
+            today, int(m.group(1)), int(m.group(2)), m.group(3)
+        ),
+    ),
+]
+# Date-ish words we don't understand, including ordinals and month names left
+# over by DATE_PATTERNS ("on the 3rd", "in march"); their presence lowers the
+# confidence
+UNKNOWN_DATE_WORDS = re.compile(
+    r"\b(ago|last|next|week|month|weekend|since|\d{1,2}(?:st|nd|rd|th)|"
+    + "|".join(name for name in MONTHS if name != "may")
+    + r")\b"
+)
+
+SMALL_NUMBERS = {"a": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6}
+
+
+def _number(value: str) -> int:
+    return SMALL_NUMBERS.get(value) or int(value)
+
+
+def _make_date(
+    today: date, month: int, day: int, year: Optional[str]
+) -> Optional[date]:
+    try:
+        if year:
+            return date(int(year) + (2000 if len(year) == 2 else 0), month, day)
+        parsed = date(today.year, month, day)
+        # "Dec 30" sent in January means last year
+        return parsed.replace(year=today.year - 1) if parsed > today else parsed
+    except ValueError:
+        return None
+
+
+def _contains(text: str, words: List[str]) -> Optional[str]:
+    for word in words:
+        if re.search(r"\b" + re.escape(word) + r"\b", text):
+            return word
+    return None
+
+
+class LocalParser:
+    """
+    Deterministic rule-based parser for short text messages.
+    Returns an IntentResult with a confidence score between 0 and 1, so the
+    caller can decide whether to trust it or fall back to Gemini.
+    """
+
+    def parse(self, text: str, today: Optional[date] = None) -> IntentResult:
+        text = " ".join((text or "").lower().split())
+        today = today or date.today()
+        if not text:
+            return IntentResult(intent="OTHER", confidence=0.0)
+
+        for pattern, confidence in NAME_PATTERNS:
+            match = pattern.match(text)
+            if match:
+                return IntentResult(
+                    intent="INPUT_NAME",
+                    payload={"name": match.group(1).strip(" .").title()},
+                    confidence=confidence,
+                )
+
+        if _contains(text, DELETE_WORDS):
+            return IntentResult(intent="DELETE_TRANSACTION", confidence=0.7)
+        if _contains(text, UPDATE_WORDS) or text.startswith("actually"):
+            return IntentResult(intent="UPDATE_TRANSACTION", confidence=0.7)
+
+        if (
+            text.endswith("?")
+            or text.startswith(tuple(QUESTION_WORDS))
+            or text.split()[0] in QUESTION_OPENERS
+        ):
+            if _contains(text, FINANCE_WORDS):
+                return IntentResult(intent="ANALYTICS_REQUEST", confidence=0.85)
+            return IntentResult(intent="OTHER", confidence=0.0)
+
+        if _contains(text, FUTURE_WORDS):
+            return IntentResult(intent="OTHER", confidence=0.0)
+
+        return self.parse_transaction(text, today)
+
+    def parse_transaction(self, text: str, today: date) -> IntentResult:
+        """Parse a single income/expense statement like 'spent $12 on coffee'"""
+        amounts, text_without_amounts = self._find_amounts(text)
+        if not amounts:
+            return IntentResult(intent="OTHER", confidence=0.0)
+        if len(amounts) > 1:
+            return IntentResult(intent="MULTIPLE_TRANSACTIONS", confidence=0.5)
+        amount, is_dollar, is_foreign = amounts[0]
+
+        transaction_date, text_without_date, date_known = self._find_date(
+            text_without_amounts, today
+        )
+        category, category_word = self._find_category(text_without_date)
+
+        income_word = _contains(text_without_date, INCOME_WORDS)
+        expense_word = _contains(text_without_date, EXPENSE_WORDS)
+        if category in INCOME_CATEGORIES and not expense_word:
+            income_word = income_word or category_word
+        if income_word and expense_word:
+            transaction_type = None
+        elif income_word and category and category not in INCOME_CATEGORIES:
+            # "got $12 lunch", "received $40 electricity bill": more likely
+            # paid than earned, let Gemini decide
+            transaction_type = None
+        elif income_word:
+            transaction_type = "income"
+        else:
+            transaction_type = "expense"
+
+        confidence = 0.4
+        if income_word or expense_word:
+            confidence += 0.25
+        if transaction_type and category:
+            confidence += 0.2
+        if is_dollar:
+            confidence += 0.1
+        if is_foreign:
+            confidence -= 0.3
+        if not transaction_type:
+            confidence -= 0.3
+        if not date_known:
+            confidence -= 0.2
+        if not is_dollar and not is_foreign:
+            confidence = min(confidence, UNMARKED_AMOUNT_CONFIDENCE)
+
+        if not category:
+            category = (
+                "salary" if transaction_type == "income" and "pay" in text else "misc"
+            )
+
+        return IntentResult(
+            intent="CREATE_TRANSACTION",
+            payload={
+                "type": transaction_type or "expense",
+                "category": category,
+                "amount": amount,
+                "day": transaction_date.day,
+                "month": transaction_date.month,
+                "year": transaction_date.year,
+                "description": self._find_description(text_without_date, category_word),
+            },
+            confidence=round(max(0.0, min(confidence, 0.95)), 2),
+        )
+
+    def _find_amounts(self, text: str) -> Tuple[List[Tuple[float, bool, bool]], str]:
+        """
+        Returns a list of (amount, is_dollar, is_foreign_currency) and the text
+        with the amounts removed
+        """
+        amounts = []
+        spans = []
+        for match in AMOUNT_PATTERN.finditer(text):
+            # Skip numbers that are part of a date (e.g. 10/3, oct 3, 3rd, 2 days ago)
+            before = text[: match.start("number")]
+            after = text[match.end("number") :]
+            if before.endswith("/") or re.match(r"(/|st\b|nd\b|rd\b|th\b)", after):
+                continue
+            if not match.group("currency") and re.search(
+                r"\b(" + MONTH_NAMES + r")\.? $", before
+            ):
+                continue
+            if re.match(r"\s*(days?|weeks?) ago", after):
+                continue
+            if not match.group("currency") and NON_AMOUNT_UNITS.match(after):
+                continue
+
+            amount = float(match.group("number").replace(",", ""))
+            if match.group("cents"):
+                amount += float("0." + match.group("cents"))
+            if match.group("suffix"):
+                amount *= 1000
+            markers = {
+                (match.group("currency") or "").lower(),
+                (match.group("unit") or "").lower(),
+            } - {""}
+            amounts.append(
+                (
+                    round(amount, 2),
+                    bool(markers & DOLLAR_MARKERS),
+                    bool(markers - DOLLAR_MARKERS),
+                )
+            )
+            spans.append(match.span())
+
+        for start, end in reversed(spans):
+            text = text[:start] + " " + text[end:]
+        return amounts, text
+
+    def _find_date(self, text: str, today: date) -> Tuple[date, str, bool]:
+        """
+        Returns (date, text without the date phrase, whether the date was understood)
+        Defaults to today when the message has no date phrase.
+        """
+        for pattern, resolve in DATE_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                resolved = resolve(match, today)
+                if resolved:
+                    return resolved, text[: match.start()] + text[match.end() :], True
+                return today, text, False
+        return today, text, not UNKNOWN_DATE_WORDS.search(text)
+
+    def _find_category(self, text: str) -> Tuple[Optional[str], Optional[str]]:
+        for category, words in CATEGORY_KEYWORDS.items():
+            word = _contains(text, words)
+            if word:
+                return category, word
+        return None, None
+
+    def _find_description(self, text: str, category_word: Optional[str]) -> str:
+        match = re.search(
+            r"\b(?:on|for|at|from)\s+(?:a |an |the |my )?([a-z][\w' &-]*)", text
+        )
+        if not match:
+            return category_word or ""
+        words = [
+            word
+            for word in match.group(1).split()
+            if word not in INCOME_WORDS + EXPENSE_WORDS + ["on", "for", "at", "from"]
+        ]
+        return " ".join(words) or category_word or ""
@@ -0,0 +1,503 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages timed per message. "db" is the time spent in SQL queries,
+# which overlaps the other stages
+STAGE_PARSE = "parse"
+STAGE_MEDIA = "media"
+STAGE_TRANSCRIPTION = "transcription"
+STAGE_INTENT = "intent"
+STAGE_EXTRACTION = "extraction"
+STAGE_ANSWER = "answer"
+STAGE_DB = "db"
+STAGE_SEND = "send"
+# Webhook waiting for the worker's answer to reply inline
+STAGE_REPLY_WAIT = "reply_wait"
+
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_DUPLICATE = "duplicate"
+OUTCOME_DEFERRED = "deferred"
+OUTCOME_SHED = "shed"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms with labels, kept in this process and
+    rendered in the Prometheus text format. Collectors added with
+    add_collector are called on each render to set values that are read
+    from elsewhere (scheduler queues, cache counters).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (kind, help, buckets)
+        self._values = defaultdict(dict)  # name -> {labels: value or Histogram}
+        self._collectors = []
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help, None)
+
+    def gauge(self, name: str, help: str):
+        self._meta[name] = ("gauge", help, None)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, tuple(buckets))
+
+    def add_collector(self, collector: Callable[["MetricsRegistry"], None]):
+        self._collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][self._key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = Histogram(self._meta[name][2] or LATENCY_BUCKETS)
+            values[key].observe(value)
+
+    def value(self, name: str, **labels):
+        """Current value (or Histogram) of a series, None if never set"""
+        with self._lock:
+            return self._values[name].get(self._key(labels))
+
+    def series(self, name: str) -> dict:
+        """{labels dict as a sorted tuple of pairs: value or Histogram} of a metric"""
+        with self._lock:
+            return dict(self._values.get(name, {}))
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> str:
+        for collector in list(self._collectors):
+            try:
+                collector(self)
+            except Exception:
+                logger.exception("Metrics collector failed")
+
+        lines = []
+        with self._lock:
+            for name, (kind, help, buckets) in sorted(self._meta.items()):
+                series = self._values.get(name)
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    if kind == "histogram":
+                        lines.extend(self._render_histogram(name, key, value))
+                    else:
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, name, key, histogram: Histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else f"{bound:g}"
+            yield f"{name}_bucket{self._labels(key + (('le', le),))} {cumulative}"
+        yield f"{name}_sum{self._labels(key)} {histogram.sum:g}"
+        yield f"{name}_count{self._labels(key)} {histogram.count}"
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def _labels(self, key: tuple) -> str:
+        if not key:
+            return ""
+        escaped = (
+            (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in key
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+registry = MetricsRegistry()
+registry.histogram(
+    "copilot_stage_seconds",
+    "Time spent per pipeline stage of a message",
+)
+registry.histogram(
+    "copilot_message_seconds",
+    "Time to handle a webhook request or a queued message",
+)
+registry.counter("copilot_messages_total", "Handled webhook requests and messages")
+registry.histogram(
+    "copilot_db_queries_per_message",
+    "SQL queries per webhook request or message",
+    COUNT_BUCKETS,
+)
+registry.histogram(
+    "copilot_gemini_calls_per_message",
+    "Gemini calls per webhook request or message",
+    COUNT_BUCKETS,
+)
+registry.counter("copilot_gemini_calls_total", "Gemini calls by method and outcome")
+registry.histogram(
+    "copilot_gemini_call_seconds", "Gemini call latency, retries included"
+)
+registry.counter("copilot_gemini_tokens_total", "Gemini tokens by method and kind")
+registry.gauge("copilot_gemini_active_calls", "Gemini calls holding a scheduler slot")
+registry.gauge(
+    "copilot_gemini_queued_calls", "Gemini calls waiting for a slot, per lane"
+)
+registry.counter(
+    "copilot_gemini_shed_calls_total", "Gemini calls shed by the scheduler"
+)
+registry.gauge(
+    "copilot_gemini_circuit_open", "1 while a method's circuit is not closed"
+)
+registry.counter("copilot_gemini_cache_lookups_total", "Gemini response cache lookups")
+registry.counter("copilot_replies_total", "Replies queued for users, by outcome")
+registry.counter(
+    "copilot_outbound_queued_total", "Outbound message parts queued for sending"
+)
+registry.counter("copilot_outbound_messages_total", "Outbound send attempts by outcome")
+registry.histogram(
+    "copilot_outbound_send_seconds", "Twilio REST latency of outbound sends"
+)
+registry.counter(
+    "copilot_outbound_status_total", "Twilio status callbacks by delivery status"
+)
+registry.counter(
+    "copilot_slow_messages_total", "Messages slower than the profiling threshold"
+)
+
+
+class MessageTrace:
+    """
+    Stage timings and counters of one webhook request or queued message,
+    recorded with its intent and outcome once it's finished. Also wraps the
+    thread's DB connection to count and time its queries.
+    """
+
+    def __init__(self, kind: str, message_sid: str = ""):
+        self.kind = kind
+        self.message_sid = message_sid
+        self.intent = "unknown"
+        self.outcome = OUTCOME_OK
+        self.stages = defaultdict(float)
+        self.db_queries = 0
+        self.gemini_calls = 0
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.add(STAGE_DB, time.perf_counter() - started)
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        labels = {"kind": self.kind, "intent": self.intent, "outcome": self.outcome}
+        for stage, seconds in self.stages.items():
+            registry.observe("copilot_stage_seconds", seconds, stage=stage, **labels)
+        registry.observe("copilot_message_seconds", self.elapsed, **labels)
+        registry.inc("copilot_messages_total", **labels)
+        registry.observe(
+            "copilot_db_queries_per_message",
+            self.db_queries,
+            kind=self.kind,
+            intent=self.intent,
+        )
+        registry.observe(
+            "copilot_gemini_calls_per_message",
+            self.gemini_calls,
+            kind=self.kind,
+            intent=self.intent,
+        )
+
+
+_current_trace = contextvars.ContextVar("copilot_message_trace", default=None)
+
+
+def current_trace() -> Optional[MessageTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_message(kind: str, message_sid: str = ""):
+    """
+    Trace a webhook request ("webhook") or a queued message ("worker") run
+    by this thread; spans and annotate calls within it (and in contexts
+    copied from it) are recorded on the trace
+    """
+    message_trace = MessageTrace(kind, message_sid)
+    token = _current_trace.set(message_trace)
+    profile = slow_profiler.start()
+    try:
+        with connection.execute_wrapper(message_trace):
+            yield message_trace
+    except BaseException:
+        if message_trace.outcome == OUTCOME_OK:
+            message_trace.outcome = OUTCOME_ERROR
+        raise
+    finally:
+        _current_trace.reset(token)
+        message_trace.finish()
+        slow_profiler.stop(profile, message_trace)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage of the current trace (a no-op outside of traces)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        message_trace = _current_trace.get()
+        if message_trace is not None:
+            message_trace.add(stage, time.perf_counter() - started)
+
+
+def traced(stage: str):
+    """Decorator running the function in a span"""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def annotate(intent: Optional[str] = None, outcome: Optional[str] = None):
+    """Set the intent and/or outcome labels of the current trace"""
+    message_trace = _current_trace.get()
+    if message_trace is not None:
+        if intent:
+            message_trace.intent = intent
+        if outcome:
+            message_trace.outcome = outcome
+
+
+def record_gemini_call(method: Optional[str], seconds: float, outcome: str, usage=None):
+    """Count a Gemini call (and its tokens) globally and on the current trace"""
+    method = method or "default"
+    registry.inc("copilot_gemini_calls_total", method=method, outcome=outcome)
+    registry.observe("copilot_gemini_call_seconds", seconds, method=method)
+    for kind, attribute in (
+        ("prompt", "prompt_token_count"),
+        ("output", "candidates_token_count"),
+    ):
+        tokens = getattr(usage, attribute, None)
+        if tokens:
+            registry.inc(
+                "copilot_gemini_tokens_total", tokens, method=method, kind=kind
+            )
+    message_trace = _current_trace.get()
+    if message_trace is not None:
+        message_trace.gemini_calls += 1
+
+
+class SlowMessageProfiler:
+    """
+    Opt-in profiling of slow messages: with COPILOT_PROFILE_SLOW_SECONDS set,
+    a share (COPILOT_PROFILE_SAMPLE_RATE) of traces run under cProfile and/or
+    tracemalloc (COPILOT_PROFILE_MODE), and those slower than the threshold
+    are written to COPILOT_PROFILE_DIR: a .prof file for pstats/snakeviz and
+    a .txt summary. tracemalloc is process-wide, so with concurrent workers
+    its allocation diff includes the other threads' allocations.
+    """
+
+    def __init__(
+        self,
+        threshold: Optional[float] = None,
+        mode: Optional[str] = None,
+        directory: Optional[str] = None,
+        sample_rate: Optional[float] = None,
+    ):
+        self.threshold = threshold
+        self.mode = mode
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self._configured = False
+
+    def _configure(self):
+        if self._configured:
+            return
+        if self.threshold is None:
+            self.threshold = getattr(settings, "COPILOT_PROFILE_SLOW_SECONDS", None)
+        self.mode = self.mode or getattr(settings, "COPILOT_PROFILE_MODE", "cprofile")
+        self.directory = self.directory or getattr(
+            settings,
+            "COPILOT_PROFILE_DIR",
+            os.path.join(tempfile.gettempdir(), "copilot-profiles"),
+        )
+        if self.sample_rate is None:
+            self.sample_rate = getattr(settings, "COPILOT_PROFILE_SAMPLE_RATE", 1.0)
+        self._configured = True
+
+    @property
+    def enabled(self) -> bool:
+        self._configure()
+        return self.threshold is not None
+
+    def start(self) -> Optional[dict]:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        profile = {}
+        if "cprofile" in self.mode:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                profile["cprofile"] = profiler
+            except ValueError:
+                # Another profiler is active on this thread
+                pass
+        if "tracemalloc" in self.mode:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            profile["tracemalloc"] = tracemalloc.take_snapshot()
+        return profile
+
+    def stop(self, profile: Optional[dict], message_trace: MessageTrace):
+        if profile is None:
+            return
+        profiler = profile.get("cprofile")
+        if profiler is not None:
+            profiler.disable()
+        if message_trace.elapsed < self.threshold:
+            return
+
+        registry.inc("copilot_slow_messages_total", kind=message_trace.kind)
+        try:
+            path = self.write(profile, message_trace)
+            logger.warning(
+                "Slow %s %s (%s, %.2fs), profile written to %s",
+                message_trace.kind,
+                message_trace.message_sid,
+                message_trace.intent,
+                message_trace.elapsed,
+                path,
+            )
+        except OSError:
+            logger.exception("Could not write the profile of a slow message")
+
+    def write(self, profile: dict, message_trace: MessageTrace) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = (
+            f"{message_trace.kind}-{message_trace.message_sid or int(time.time())}-"
+            f"{int(message_trace.elapsed * 1000)}ms"
+        )
+        path = os.path.join(self.directory, name)
+
+        summary = io.StringIO()
+        summary.write(
+            f"{message_trace.kind} {message_trace.message_sid} intent="
+            f"{message_trace.intent} outcome={message_trace.outcome} "
+            f"{message_trace.elapsed:.3f}s, {message_trace.db_queries} queries, "
+            f"{message_trace.gemini_calls} Gemini calls\n"
+        )
+        for stage, seconds in sorted(message_trace.stages.items()):
+            summary.write(f"  {stage}: {seconds:.3f}s\n")
+
+        profiler = profile.get("cprofile")
+        if profiler is not None:
+            profiler.dump_stats(path + ".prof")
+            summary.write("\n")
+            stats = pstats.Stats(profiler, stream=summary)
+            stats.sort_stats("cumulative").print_stats(40)
+
+        before = profile.get("tracemalloc")
+        if before is not None:
+            summary.write("\nTop allocations during the message:\n")
+            after = tracemalloc.take_snapshot()
+            for stat in after.compare_to(before, "lineno")[:25]:
+                summary.write(f"  {stat}\n")
+
+        with open(path + ".txt", "w") as file:
+            file.write(summary.getvalue())
+        return path + ".txt"
+
+
+slow_profiler = SlowMessageProfiler()
+
+
+def serve_metrics(port: int, host: str = "") -> ThreadingHTTPServer:
+    """
+    Serve /metrics on a background thread, for processes without the web
+    app (e.g. manage.py run_workers)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            content = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    return server
@@ -0,0 +1,141 @@
+import logging
+import time
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from copilot.models import OutboundMessage, QueuedJob
+from copilot.services.job_queue import JobQueue, PermanentError
+from copilot.services.metrics import registry
+from copilot.services.twilio_api import get_twilio_service
+
+logger = logging.getLogger(__name__)
+
+# Longest body Twilio accepts for a WhatsApp message
+MAX_BODY_LENGTH = 1600
+
+# Where long replies are preferably split, best first
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def split_message(text: str, limit: int = MAX_BODY_LENGTH) -> List[str]:
+    """
+    Split a reply into parts of at most `limit` characters, at paragraph,
+    line, sentence or word boundaries when one falls in the second half of
+    the part, otherwise mid-word
+    """
+    text = (text or "").strip()
+    parts = []
+    while len(text) > limit:
+        cut = limit
+        for separator in SPLIT_SEPARATORS:
+            position = text.rfind(separator, 0, limit)
+            if position > limit // 2:
+                cut = position + len(separator)
+                break
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+class OutboundQueue(JobQueue):
+    """
+    JobQueue of OutboundMessage rows that keeps the order per destination:
+    a message is only handed out once every earlier message to the same
+    number is sent or failed for good, so retries never reorder a reply
+    """
+
+    def __init__(self):
+        super().__init__(
+            OutboundMessage,
+            max_attempts=getattr(settings, "COPILOT_OUTBOUND_MAX_ATTEMPTS", 5),
+            retry_backoff=getattr(settings, "COPILOT_OUTBOUND_RETRY_BACKOFF", 2.0),
+            lease_seconds=getattr(settings, "COPILOT_OUTBOUND_LEASE_SECONDS", 60),
+        )
+
+    def claim(self, batch_size: int = 50):
+        # Wider than the default: the oldest due messages may all be blocked
+        # behind an earlier one to the same number
+        return super().claim(batch_size)
+
+    def can_claim(self, job) -> bool:
+        return not OutboundMessage.objects.filter(
+            to=job.to,
+            pk__lt=job.pk,
+            status__in=(QueuedJob.STATUS_PENDING, QueuedJob.STATUS_RUNNING),
+        ).exists()
+
+
+outbound_queue = OutboundQueue()
+
+
+def enqueue_reply(to: str, body: str, reply_to: str = "") -> List[OutboundMessage]:
+    """
+    Queue a reply for the outbound workers, split into WhatsApp-sized parts
+    Args:
+        to: Bare WhatsApp number of the recipient
+        body: Reply text
+        reply_to: MessageSid of the answered message, if any
+    Returns:
+        Created OutboundMessage objects, in sending order
+    """
+    parts = split_message(body)
+    with db_transaction.atomic():
+        messages = [
+            outbound_queue.enqueue(
+                to=to, body=part, part=index, parts=len(parts), reply_to=reply_to
+            )
+            for index, part in enumerate(parts, start=1)
+        ]
+    registry.inc("copilot_outbound_queued_total", len(messages))
+    return messages
+
+
+def status_callback_url(message: OutboundMessage) -> Optional[str]:
+    """COPILOT_TWILIO_STATUS_CALLBACK_URL for a message, None if not configured"""
+    url = getattr(settings, "COPILOT_TWILIO_STATUS_CALLBACK_URL", None)
+    if not url:
+        return None
+    return f"{url}{'&' if '?' in url else '?'}outbound={message.pk}"
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and network errors are worth retrying"""
+    status = getattr(error, "status", None)
+    return status is None or status == 429 or status >= 500
+
+
+def send_outbound_job(job: OutboundMessage):
+    """
+    Worker entry point: send a queued message over the Twilio REST API
+    Args:
+        job: Claimed OutboundMessage
+    Raises:
+        The Twilio error for retryable failures, PermanentError otherwise
+    """
+    started = time.perf_counter()
+    try:
+        sent = get_twilio_service().create_message(
+            job.to, job.body, status_callback=status_callback_url(job)
+        )
+    except Exception as e:
+        outcome = "retry" if is_retryable(e) else "failed"
+        registry.inc("copilot_outbound_messages_total", outcome=outcome)
+        registry.observe("copilot_outbound_send_seconds", time.perf_counter() - started)
+        if outcome == "failed":
+            raise PermanentError(str(e)) from e
+        raise
+
+    registry.inc("copilot_outbound_messages_total", outcome="sent")
+    registry.observe("copilot_outbound_send_seconds", time.perf_counter() - started)
+    # Only set if no status callback got here first
+    OutboundMessage.objects.filter(pk=job.pk, delivery_status="").update(
+        delivery_status=sent.status or ""
+    )
+    OutboundMessage.objects.filter(pk=job.pk).update(
+        twilio_sid=sent.sid or "", sent_at=timezone.now()
+    )
@@ -0,0 +1,136 @@
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class BucketBusy(Exception):
+    """The lock of a bucket could not be taken in time"""
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `capacity` saved
+    up. The state is a plain (tokens, updated) tuple so it can live in a
+    shared cache.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+    @property
+    def refill_seconds(self) -> int:
+        """Time after which an untouched bucket is full again"""
+        return int(self.capacity / self.rate) + 1
+
+    def take(
+        self, state: Optional[tuple], now: float, tokens: float = 1
+    ) -> Tuple[float, tuple]:
+        """
+        Take tokens if available
+        Args:
+            state: (tokens, updated) of the bucket, None for a full one
+            now: Current time.time()
+        Returns:
+            (0 if taken, otherwise seconds until enough tokens are available;
+            the new state)
+        """
+        available, updated = state or (self.capacity, now)
+        available = min(self.capacity, available + max(now - updated, 0) * self.rate)
+        if available >= tokens:
+            return 0, (available - tokens, now)
+        return (tokens - available) / self.rate, (available, now)
+
+
+class RateLimiter:
+    """
+    Token-bucket limits on message processing, per sender and overall, so one
+    chatty sender cannot use up the Gemini capacity of everyone else.
+    Buckets live in a Django cache (COPILOT_RATE_LIMIT_CACHE_ALIAS), each
+    updated under a short cache.add lock, so with a shared backend the limits
+    hold across every worker process and survive restarts. On a
+    process-local backend (LocMemCache) each process has its own buckets.
+    """
+
+    def __init__(
+        self,
+        sender_rate: Optional[float] = None,
+        sender_burst: Optional[float] = None,
+        global_rate: Optional[float] = None,
+        global_burst: Optional[float] = None,
+        alias: Optional[str] = None,
+        lock_wait: float = 1.0,
+        lock_timeout: int = 5,
+    ):
+        sender_rate = sender_rate or (
+            getattr(settings, "COPILOT_SENDER_RATE_PER_MINUTE", 10) / 60
+        )
+        sender_burst = sender_burst or getattr(settings, "COPILOT_SENDER_BURST", 5)
+        global_rate = global_rate or (
+            getattr(settings, "COPILOT_GLOBAL_RATE_PER_MINUTE", 300) / 60
+        )
+        global_burst = global_burst or getattr(settings, "COPILOT_GLOBAL_BURST", 50)
+        self.sender_bucket = TokenBucket(sender_rate, sender_burst)
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.alias = alias or getattr(
+            settings, "COPILOT_RATE_LIMIT_CACHE_ALIAS", "idempotency"
+        )
+        self.lock_wait = lock_wait
+        self.lock_timeout = lock_timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, scope: str) -> str:
+        return f"rate_limit:{scope}"
+
+    def acquire(self, sender: str) -> float:
+        """
+        Take one token from the sender's bucket and the global bucket
+        Returns:
+            0 if the message may be processed now, otherwise seconds to wait
+        """
+        sender_key = self.key(f"sender:{sender}")
+        global_key = self.key("global")
+        now = time.time()
+        try:
+            with self._locked(sender_key):
+                wait, sender_state = self.sender_bucket.take(
+                    self.cache.get(sender_key), now
+                )
+                if wait:
+                    return wait
+                with self._locked(global_key):
+                    wait, global_state = self.global_bucket.take(
+                        self.cache.get(global_key), now
+                    )
+                    if wait:
+                        # The sender's token is only spent with a global one
+                        return wait
+                    self.cache.set(
+                        global_key, global_state, self.global_bucket.refill_seconds
+                    )
+                self.cache.set(
+                    sender_key, sender_state, self.sender_bucket.refill_seconds
+                )
+                return 0
+        except BucketBusy:
+            return self.lock_wait
+
+    @contextmanager
+    def _locked(self, key: str):
+        """Hold a bucket's lock, BucketBusy if it isn't free within lock_wait"""
+        lock = f"{key}:lock"
+        deadline = time.monotonic() + self.lock_wait
+        while not self.cache.add(lock, True, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                raise BucketBusy(key)
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            self.cache.delete(lock)
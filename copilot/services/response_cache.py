@@ -0,0 +1,96 @@
+import hashlib
+import threading
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+
+# Sentinel so a cached empty string is still a hit
+MISSING = object()
+
+
+def media_digest(media_path: str) -> str:
+    """
+    SHA-256 of a stored media file, so the same photo sent twice (under a new
+    Twilio URL and local path) maps to the same cache key
+    """
+    digest = hashlib.sha256()
+    with default_storage.open(media_path, "rb") as media_file:
+        for chunk in iter(lambda: media_file.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_body(body: Optional[str]) -> str:
+    """Collapse whitespace so trivially different resends share a key"""
+    return " ".join((body or "").split())
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of Gemini responses.
+    Keys are a hash of the calling method, the prompt, the normalized message
+    body, the media digests, (for date-sensitive prompts) the date and the
+    conversational context the prompt was sent with.
+    Storage is a Django cache (COPILOT_GEMINI_CACHE_ALIAS) so it can be shared
+    across workers; its size bound and eviction come from that cache's
+    configuration (MAX_ENTRIES for the LRU local-memory backend).
+    """
+
+    def __init__(self, alias: Optional[str] = None, ttls: Optional[dict] = None):
+        self.alias = alias or getattr(settings, "COPILOT_GEMINI_CACHE_ALIAS", "gemini")
+        self.ttls = (
+            ttls
+            if ttls is not None
+            else getattr(settings, "COPILOT_GEMINI_CACHE_TTLS", {})
+        )
+        self._lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def ttl(self, method: str) -> int:
+        """Seconds responses of `method` are kept, 0 disables caching"""
+        return self.ttls.get(method, self.ttls.get("default", 0))
+
+    def make_key(
+        self,
+        method: str,
+        prompt: str,
+        body: Optional[str],
+        media_digests: Iterable[str] = (),
+        date: Optional[str] = None,
+        context: Optional[str] = None,
+    ) -> str:
+        digest = hashlib.sha256()
+        parts = (method, prompt, normalize_body(body), *media_digests, date or "")
+        for part in parts + ((context,) if context else ()):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return f"gemini:{method}:{digest.hexdigest()}"
+
+    def get(self, method: str, key: str):
+        """Returns the cached response or MISSING"""
+        value = self.cache.get(key, MISSING)
+        with self._lock:
+            if value is MISSING:
+                self._misses[method] += 1
+            else:
+                self._hits[method] += 1
+        return value
+
+    def set(self, method: str, key: str, value: str):
+        self.cache.set(key, value, self.ttl(method))
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process, per method"""
+        with self._lock:
+            return {
+                method: {"hits": self._hits[method], "misses": self._misses[method]}
+                for method in sorted(set(self._hits) | set(self._misses))
+            }
@@ -0,0 +1,325 @@
+import csv
+import os
+import re
+import time
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional
+
+from copilot.constants import TRANSACTION_CATEGORIES
+from copilot.services.local_parser import CATEGORY_KEYWORDS, INCOME_CATEGORIES
+
+STATEMENT_FORMATS = ("csv", "ofx", "qif")
+
+# Header names tried, in order, when a CSV column is not mapped explicitly
+CSV_COLUMNS = {
+    "date": ["date", "transaction date", "posted date", "posting date", "booking date"],
+    "amount": ["amount", "transaction amount", "value"],
+    "debit": ["debit", "withdrawal", "withdrawals", "money out"],
+    "credit": ["credit", "deposit", "deposits", "money in"],
+    "description": ["description", "payee", "name", "merchant", "memo", "details"],
+    "type": ["type", "transaction type"],
+    "category": ["category"],
+}
+
+DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%m/%d/%Y",
+    "%m/%d/%y",
+    "%d/%m/%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+    "%Y%m%d",
+    "%b %d, %Y",
+    "%d %b %Y",
+]
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class StatementError(ValueError):
+    pass
+
+
+def detect_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension not in STATEMENT_FORMATS:
+        raise StatementError(f"Unsupported statement format: {path}")
+    return extension
+
+
+def parse_date(value: str, date_format: Optional[str] = None) -> date:
+    value = value.strip()
+    for candidate in [date_format] if date_format else DATE_FORMATS:
+        try:
+            return datetime.strptime(value, candidate).date()
+        except ValueError:
+            continue
+    raise StatementError(f"Unrecognized date: {value!r}")
+
+
+def parse_amount(value: str) -> Optional[float]:
+    """'1,234.50', '(12.00)', '$-5' -> float, None for an empty cell"""
+    value = (value or "").strip().replace(",", "").replace("$", "")
+    if not value:
+        return None
+    negative = value.startswith("(") and value.endswith(")")
+    try:
+        amount = float(value.strip("()"))
+    except ValueError:
+        raise StatementError(f"Unrecognized amount: {value!r}")
+    return -amount if negative else amount
+
+
+def guess_category(description: str, type: str, category: str = "") -> str:
+    """Source category when it is one of ours, else a keyword match, else misc"""
+    category = (category or "").strip().lower()
+    if category in TRANSACTION_CATEGORIES:
+        return category
+    text = (description or "").lower()
+    for candidate, words in CATEGORY_KEYWORDS.items():
+        if (candidate in INCOME_CATEGORIES) != (type == "income"):
+            continue
+        if any(re.search(r"\b" + re.escape(word) + r"\b", text) for word in words):
+            return candidate
+    return "misc"
+
+
+def make_row(
+    posted: date, amount: float, description: str, type: str = "", category: str = ""
+) -> dict:
+    """Transaction fields of a statement line, negative amounts are expenses"""
+    type = (type or "").strip().lower()
+    if type not in ("income", "expense"):
+        type = "expense" if amount < 0 else "income"
+    description = " ".join((description or "").split())
+    return {
+        "type": type,
+        "category": guess_category(description, type, category),
+        "year": posted.year,
+        "month": posted.month,
+        "day": posted.day,
+        "date": posted,
+        "amount": abs(amount),
+        "description": description,
+    }
+
+
+def parse_csv(
+    path: str, columns: Optional[Dict[str, str]] = None, date_format: str = None
+) -> Iterator[dict]:
+    """
+    Stream a CSV export row by row
+    Args:
+        path: CSV file with a header line
+        columns: {field: header} overrides of CSV_COLUMNS, fields are date,
+            amount (or debit/credit), description, type and category
+        date_format: strptime format of the date column, guessed if not given
+    """
+    with open(path, newline="", encoding="utf-8-sig") as statement:
+        reader = csv.DictReader(statement)
+        mapping = _map_csv_columns(reader.fieldnames or [], columns or {})
+        if "date" not in mapping or not (
+            "amount" in mapping or "debit" in mapping or "credit" in mapping
+        ):
+            raise StatementError(
+                f"{path}: date and amount columns are required, found {reader.fieldnames}"
+            )
+        for line in reader:
+            amount = None
+            if "amount" in mapping:
+                amount = parse_amount(line[mapping["amount"]])
+            if amount is None:
+                debit = parse_amount(line.get(mapping.get("debit"), ""))
+                credit = parse_amount(line.get(mapping.get("credit"), ""))
+                if debit is None and credit is None:
+                    continue
+                amount = (credit or 0) - abs(debit or 0)
+            yield make_row(
+                parse_date(line[mapping["date"]], date_format),
+                amount,
+                line.get(mapping.get("description"), ""),
+                line.get(mapping.get("type"), ""),
+                line.get(mapping.get("category"), ""),
+            )
+
+
+def _map_csv_columns(fieldnames: List[str], overrides: Dict[str, str]) -> dict:
+    headers = {name.strip().lower(): name for name in fieldnames}
+    mapping = {}
+    for field, candidates in CSV_COLUMNS.items():
+        if field in overrides:
+            if overrides[field] not in fieldnames:
+                raise StatementError(f"Column {overrides[field]!r} not in {fieldnames}")
+            mapping[field] = overrides[field]
+            continue
+        for candidate in candidates:
+            if candidate in headers:
+                mapping[field] = headers[candidate]
+                break
+    return mapping
+
+
+def parse_ofx(path: str, date_format: str = None) -> Iterator[dict]:
+    """Stream the <STMTTRN> records of an OFX (SGML or XML) export"""
+    record = None
+    for tag, value in _ofx_tags(path):
+        if tag == "STMTTRN":
+            record = {}
+        elif tag == "/STMTTRN" and record is not None:
+            if "TRNAMT" in record and "DTPOSTED" in record:
+                yield make_row(
+                    # DTPOSTED is YYYYMMDD[HHMMSS[.XXX]][[TZ]]
+                    parse_date(record["DTPOSTED"][:8], date_format or "%Y%m%d"),
+                    parse_amount(record["TRNAMT"]),
+                    " ".join(
+                        part
+                        for part in (record.get("NAME"), record.get("MEMO"))
+                        if part
+                    ),
+                )
+            record = None
+        elif record is not None and value:
+            record[tag] = value
+
+
+def _ofx_tags(path: str) -> Iterator[tuple]:
+    """(tag, value) pairs of an OFX file, read in chunks whatever its line layout"""
+    with open(path, encoding="utf-8", errors="replace") as statement:
+        pending = ""
+        for chunk in iter(lambda: statement.read(READ_CHUNK_SIZE), ""):
+            pieces = (pending + chunk).split("<")
+            pending = pieces.pop()
+            for piece in pieces:
+                tag, _, value = piece.partition(">")
+                if tag:
+                    yield tag.strip().upper(), value.strip()
+        tag, _, value = pending.partition(">")
+        if tag:
+            yield tag.strip().upper(), value.strip()
+
+
+def parse_qif(path: str, date_format: str = None) -> Iterator[dict]:
+    """Stream the records of a QIF export (D date, T amount, P payee, M memo, L category)"""
+    record = {}
+    with open(path, encoding="utf-8", errors="replace") as statement:
+        for line in statement:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("!"):
+                continue
+            code, value = line[0], line[1:].strip()
+            if code == "^":
+                if "D" in record and ("T" in record or "U" in record):
+                    yield make_row(
+                        parse_date(_qif_date(record["D"]), date_format),
+                        parse_amount(record.get("T") or record["U"]),
+                        " ".join(
+                            part for part in (record.get("P"), record.get("M")) if part
+                        ),
+                        category=record.get("L", ""),
+                    )
+                record = {}
+            else:
+                record.setdefault(code, value)
+
+
+def _qif_date(value: str) -> str:
+    """Quicken writes 1/ 5'24 for 01/05/2024"""
+    value = value.replace(" ", "")
+    if "'" in value:
+        head, year = value.split("'", 1)
+        value = f"{head}/{2000 + int(year) if len(year) <= 2 else year}"
+    return value
+
+
+def parse_statement(path: str, **options) -> Iterator[dict]:
+    parsers = {"csv": parse_csv, "ofx": parse_ofx, "qif": parse_qif}
+    statement_format = detect_format(path)
+    if statement_format != "csv":
+        options.pop("columns", None)
+    return parsers[statement_format](path, **options)
+
+
+def fingerprint(row: dict) -> tuple:
+    """Identity of a statement line across imports: date, amount and description"""
+    return (
+        row["date"],
+        round(float(row["amount"]), 2),
+        " ".join((row["description"] or "").lower().split()),
+    )
+
+
+def import_statement(
+    path: str,
+    family_id: str,
+    user_id: str,
+    chunk_size: int = 1000,
+    columns: Optional[Dict[str, str]] = None,
+    date_format: Optional[str] = None,
+    dry_run: bool = False,
+) -> dict:
+    """
+    Parse one statement and insert its rows with chunked bulk_create.
+    The file is parsed twice: a first pass validates every line, so a bad
+    line fails the file before anything is inserted, the second inserts in
+    one database transaction. Lines already imported for the family
+    (same fingerprint) are skipped, so importing a file again is a no-op;
+    identical lines within a file are kept as long as the family has fewer
+    of them. Known lines are looked up per chunk on the chunk's dates, so
+    memory depends on the file, not on the family's history.
+    Runs in a pool worker process, so it uses its own database connection and
+    does not touch TransactionSummary (refreshed once by the caller).
+    Returns:
+        {"path", "rows", "skipped", "seconds"} of this file
+    """
+    # Deferred so the module can be imported before django.setup() in workers
+    from django.db import transaction as db_transaction
+
+    from copilot.models import Transaction
+
+    started = time.perf_counter()
+    options = dict(columns=columns, date_format=date_format)
+    if not any(True for _ in parse_statement(path, **options)):
+        return {"path": path, "rows": 0, "skipped": 0, "seconds": 0.0}
+
+    totals = {"rows": 0, "skipped": 0}
+    # Lines of this file so far and those inserted, by fingerprint
+    seen, inserted = Counter(), Counter()
+
+    def import_chunk(chunk: list):
+        # Only the family's rows on the chunk's dates, never its whole history
+        on_dates = (
+            Transaction.objects.for_family(family_id)
+            .filter(date__in={row["date"] for row in chunk})
+            .values("date", "amount", "description")
+        )
+        stored = Counter(fingerprint(row) for row in on_dates.iterator())
+        batch = []
+        for row in chunk:
+            key = fingerprint(row)
+            seen[key] += 1
+            # Rows inserted by earlier chunks are in the table too
+            existing = stored[key] - (0 if dry_run else inserted[key])
+            if seen[key] <= existing:
+                totals["skipped"] += 1
+                continue
+            inserted[key] += 1
+            batch.append(Transaction(familyId=family_id, userId=user_id, **row))
+        totals["rows"] += _flush(Transaction, batch, dry_run)
+
+    with db_transaction.atomic():
+        chunk = []
+        for row in parse_statement(path, **options):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                import_chunk(chunk)
+                chunk = []
+        if chunk:
+            import_chunk(chunk)
+    return dict(path=path, seconds=time.perf_counter() - started, **totals)
+
+
+def _flush(model, batch: list, dry_run: bool) -> int:
+    if batch and not dry_run:
+        model.objects.bulk_create(batch)
+    return len(batch)
@@ -1,17 +1,18 @@
+import logging
 import mimetypes
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
-import requests
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
 from dotenv import load_dotenv
-from PIL import Image
-from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 
 from ..datamodels.twilio_message import TwilioMedia, TwilioMessage
@@ -19,6 +20,23 @@ from ..datamodels.twilio_message import TwilioMedia, TwilioMessage
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+_twilio_service = None
+_twilio_service_lock = threading.Lock()
+
+
+def get_twilio_service() -> "TwilioService":
+    """Process-wide TwilioService, built on first use"""
+    global _twilio_service
+    if _twilio_service is None:
+        with _twilio_service_lock:
+            if _twilio_service is None:
+                _twilio_service = TwilioService()
+    return _twilio_service
+
 
 class TwilioService:
     """
@@ -27,42 +45,105 @@ class TwilioService:
     """
 
     def __init__(self):
+        # The REST client and requests are only needed once the service is used
+        import requests
+        from requests.adapters import HTTPAdapter
+
         self.account_sid = os.getenv("TWILIO_ACCOUNT_SID")
         self.auth_token = os.getenv("TWILIO_AUTH_TOKEN")
         self.whatsapp_number = os.getenv("TWILIO_WHATSAPP_NUMBER")
-        self.client = Client(self.account_sid, self.auth_token)
+        self.client = self.create_client()
         self.media_storage_path = "whatsapp_media"
 
+        # Media downloads share keep-alive connections and a bounded thread pool
+        download_workers = getattr(settings, "COPILOT_MEDIA_DOWNLOAD_WORKERS", 4)
+        self.session = requests.Session()
+        self.session.auth = (self.account_sid, self.auth_token)
+        adapter = HTTPAdapter(
+            pool_connections=download_workers, pool_maxsize=download_workers
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.media_executor = ThreadPoolExecutor(
+            max_workers=download_workers, thread_name_prefix="media-download"
+        )
+
+    def create_client(self):
+        """
+        Twilio REST client, built by the callable named in
+        COPILOT_TWILIO_CLIENT_FACTORY (called with the account SID and auth
+        token) if set, e.g. to talk to the load test's fake Twilio server
+        """
+        factory = getattr(settings, "COPILOT_TWILIO_CLIENT_FACTORY", None)
+        if factory:
+            return import_string(factory)(self.account_sid, self.auth_token)
+
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        # One keep-alive connection per outbound worker thread
+        http_client = TwilioHttpClient(
+            pool_connections=True,
+            timeout=getattr(settings, "COPILOT_TWILIO_TIMEOUT", 10),
+        )
+        pool_size = getattr(settings, "COPILOT_OUTBOUND_CONCURRENCY", 4)
+        http_client.session.mount(
+            "https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
+        return Client(self.account_sid, self.auth_token, http_client=http_client)
+
     def format_whatsapp_number(self, phone_number: str) -> str:
         """Format phone number for WhatsApp"""
         return f"whatsapp:{phone_number}"
 
-    def _download_media(self, media_url: str) -> Tuple[Optional[bytes], Optional[str]]:
+    def _download_media(self, media_url: str) -> Tuple[Optional[File], Optional[str]]:
         """
-        Download media from Twilio URL using authentication
-        Returns: Tuple of (content_bytes, filename)
+        Stream media from Twilio URL using authentication into a temporary file
+        Downloads larger than COPILOT_MEDIA_MAX_BYTES are aborted.
+        Returns: Tuple of (file, filename); the caller closes the file
         """
+        max_bytes = getattr(settings, "COPILOT_MEDIA_MAX_BYTES", 16 * 1024 * 1024)
         try:
-            response = requests.get(
-                media_url, auth=(self.account_sid, self.auth_token), stream=True
-            )
-            if response.status_code == 200:
+            with self.session.get(
+                media_url,
+                stream=True,
+                timeout=(
+                    getattr(settings, "COPILOT_MEDIA_CONNECT_TIMEOUT", 5),
+                    getattr(settings, "COPILOT_MEDIA_READ_TIMEOUT", 30),
+                ),
+            ) as response:
+                if response.status_code != 200:
+                    return None, None
+                if int(response.headers.get("Content-Length") or 0) > max_bytes:
+                    logger.warning("Media too large, skipping: %s", media_url)
+                    return None, None
+
                 # Get filename from URL or Content-Disposition header
                 filename = os.path.basename(urlparse(media_url).path)
                 content_disposition = response.headers.get("Content-Disposition")
                 if content_disposition and "filename=" in content_disposition:
                     filename = content_disposition.split("filename=")[1].strip('"')
-                return response.content, filename
-            return None, None
-        except Exception as e:
-            print(f"Error downloading media: {str(e)}")
+
+                # Small files stay in memory, larger ones spill to disk
+                buffer = tempfile.SpooledTemporaryFile(max_size=MEDIA_CHUNK_SIZE * 16)
+                size = 0
+                for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        buffer.close()
+                        logger.warning("Media too large, skipping: %s", media_url)
+                        return None, None
+                    buffer.write(chunk)
+                buffer.seek(0)
+                return File(buffer), filename
+        except Exception:
+            logger.exception("Error downloading media %s", media_url)
             return None, None
 
-    def _save_media(
-        self, content: bytes, filename: str, message_sid: str
-    ) -> Optional[str]:
+    def _save_media(self, content, filename: str, message_sid: str) -> Optional[str]:
         """
-        Save media content to Django storage
+        Save media content (bytes or a file, copied in chunks) to Django storage
         Returns: Saved file path or None
         """
         try:
@@ -73,10 +154,12 @@ class TwilioService:
             )
 
             # Save file using Django's storage
-            file_path = default_storage.save(relative_path, ContentFile(content))
+            if not isinstance(content, File):
+                content = ContentFile(content)
+            file_path = default_storage.save(relative_path, content)
             return file_path
-        except Exception as e:
-            print(f"Error saving media: {str(e)}")
+        except Exception:
+            logger.exception("Error saving media %s", filename)
             return None
 
     def _get_file_extension(self, content_type: str) -> str:
@@ -114,7 +197,7 @@ class TwilioService:
                 if media_url and content_type:
                     # Download and save media
                     content, original_filename = self._download_media(media_url)
-                    if content:
+                    if content is not None:
                         # Get extension and create filename
                         extension = self._get_file_extension(content_type)
                         base_filename = (
@@ -125,7 +208,10 @@ class TwilioService:
                         filename = f"{base_filename}{extension}"
 
                         # Save the media file
-                        saved_path = self._save_media(content, filename, message_sid)
+                        with content:
+                            saved_path = self._save_media(
+                                content, filename, message_sid
+                            )
 
                         # Create TwilioMedia object with local path
                         media_items.append(
@@ -160,8 +246,8 @@ class TwilioService:
 
             return message
 
-        except Exception as e:
-            print(f"Error processing incoming message: {str(e)}")
+        except Exception:
+            logger.exception("Error processing incoming message")
             error_message = TwilioMessage(
                 message_sid=request_data.get("MessageSid", "error"),
                 body=request_data.get("Body", ""),
@@ -177,6 +263,24 @@ class TwilioService:
             )
             return error_message
 
+    def create_message(
+        self, to_phone: str, body: str, status_callback: Optional[str] = None
+    ):
+        """
+        Send a text message over the REST API, raising its errors
+        (twilio.base.exceptions.TwilioRestException carries the HTTP status)
+        :param status_callback: URL Twilio posts the delivery status to
+        Returns: Twilio message resource
+        """
+        params = {
+            "body": body,
+            "from_": self.format_whatsapp_number(self.whatsapp_number),
+            "to": self.format_whatsapp_number(to_phone),
+        }
+        if status_callback:
+            params["status_callback"] = status_callback
+        return self.client.messages.create(**params)
+
     def send_message(
         self,
         to_phone: str,
@@ -241,12 +345,18 @@ class TwilioService:
                 status=twilio_message.status,
             )
 
-        except Exception as e:
-            print(f"Error sending message: {str(e)}")
+        except Exception:
+            logger.exception("Error sending message to %s", to_phone)
             return None
 
-    def parse_incoming_message(self, request_data: dict) -> TwilioMessage:
-        """Parse incoming webhook data into TwilioMessage object"""
+    def parse_incoming_message(
+        self, request_data: dict, download_media: bool = True
+    ) -> TwilioMessage:
+        """
+        Parse incoming webhook data into TwilioMessage object
+        :param download_media: Download media right away; when False the media
+            items are returned without local_path (see download_message_media)
+        """
         try:
             # Extract basic message info
             message_sid = request_data.get("MessageSid", "")
@@ -264,20 +374,11 @@ class TwilioService:
                 content_type = request_data.get(f"MediaContentType{i}")
 
                 if media_url and content_type:
-                    # Download and save media
-                    local_path = self._save_incoming_media(
-                        media_url, content_type, message_sid
-                    )
-
                     media_items.append(
-                        TwilioMedia(
-                            url=media_url,
-                            content_type=content_type,
-                            local_path=local_path,
-                        )
+                        TwilioMedia(url=media_url, content_type=content_type)
                     )
 
-            return TwilioMessage(
+            message = TwilioMessage(
                 message_sid=message_sid,
                 body=body,
                 senderNumber=senderNumber,
@@ -287,25 +388,48 @@ class TwilioService:
                 direction="inbound",
                 timestamp=timestamp,
             )
+            if download_media:
+                self.download_message_media(message)
+            return message
 
-        except Exception as e:
-            print(f"Error parsing message: {str(e)}")
+        except Exception:
+            logger.exception("Error parsing message")
             raise
 
+    def download_message_media(self, message: TwilioMessage) -> TwilioMessage:
+        """
+        Download and save any media of the message that is not stored locally
+        yet, concurrently on the service's bounded download pool
+        """
+        pending = [media for media in message.media if not media.local_path]
+        futures = [
+            self.media_executor.submit(
+                self._save_incoming_media,
+                media.url,
+                media.content_type,
+                message.message_sid,
+            )
+            for media in pending
+        ]
+        for media, future in zip(pending, futures):
+            media.local_path = future.result()
+        return message
+
     def _save_incoming_media(
         self, media_url: str, content_type: str, message_sid: str
     ) -> Optional[str]:
         """Download and save media file, return local path"""
         try:
             content, _ = self._download_media(media_url)
-            if content:
+            if content is not None:
                 extension = self._get_file_extension(content_type)
                 filename = f"{message_sid}_{datetime.now().timestamp()}{extension}"
 
-                return self._save_media(content, filename, message_sid)
+                with content:
+                    return self._save_media(content, filename, message_sid)
             return None
-        except Exception as e:
-            print(f"Error saving media: {str(e)}")
+        except Exception:
+            logger.exception("Error saving media %s", media_url)
             return None
 
     def get_message_history(self, limit: int = 10) -> List[dict]:
@@ -330,10 +454,16 @@ class TwilioService:
                 for msg in messages
                 if msg.from_.startswith("whatsapp:") or msg.to.startswith("whatsapp:")
             ]
-        except Exception as e:
-            print(f"Error retrieving messages: {str(e)}")
+        except Exception:
+            logger.exception("Error retrieving messages")
             return []
 
+    def create_empty_response(self) -> str:
+        """
+        Create an empty TwiML response that acknowledges the webhook without replying
+        """
+        return str(MessagingResponse())
+
     def create_response(self, message: str, media_urls: List[str] = None) -> str:
         """
         Create a TwiML response for incoming WhatsApp messages
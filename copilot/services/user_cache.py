@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+
+
+class UserCache:
+    """
+    Bounded LRU + TTL cache of User lookups by WhatsApp number.
+    Unknown numbers are not cached, so a user registered by another worker is
+    found right away. Entries are dropped by User.save/delete in this process;
+    other worker processes see changes once the TTL expires.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_size = max_size or getattr(settings, "COPILOT_USER_CACHE_SIZE", 10000)
+        self.ttl = (
+            ttl if ttl is not None else getattr(settings, "COPILOT_USER_CACHE_TTL", 300)
+        )
+        self._entries = OrderedDict()  # {number: (expires_at, user)}
+        self._lock = threading.Lock()
+
+    def get_user(self, number: str):
+        """
+        Resolve a number to its User (None if unregistered), hitting the
+        database only on a cache miss
+        """
+        with self._lock:
+            entry = self._entries.get(number)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(number)
+                return entry[1]
+
+        from copilot.models import User
+
+        user = User.objects.filter(number=number).first()
+        if user is not None:
+            self.set(number, user)
+        return user
+
+    def set(self, number: str, user):
+        with self._lock:
+            self._entries[number] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(number)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, number: str = None, user_pk=None):
+        """Drop the entry of a number and any entry holding the user with user_pk"""
+        with self._lock:
+            self._entries.pop(number, None)
+            if user_pk is not None:
+                for key, (_, user) in list(self._entries.items()):
+                    if user.pk == user_pk:
+                        del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
@@ -1,3 +1,1827 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from datetime import date, datetime, timedelta
+from io import BytesIO, StringIO
 
-# Create your tests here.
+import PIL.Image
+
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from copilot.constants import REPLY_ASK_NAME, REPLY_NOT_PROCESSED, REPLY_WELCOME
+from copilot.datamodels.intent_result import IntentResult
+from copilot.datamodels.summary import YearlySummary
+from copilot.datamodels.twilio_message import TwilioMedia, TwilioMessage
+from copilot.models import (
+    DescriptionNgram,
+    InvalidTransaction,
+    MessageJob,
+    OutboundMessage,
+    QueuedJob,
+    Transaction,
+    TransactionSummary,
+    User,
+)
+from copilot.services.analytics import CHARS_PER_TOKEN, AnalyticsEngine
+from copilot.services import date_ranges, description_search
+from copilot.services.call_policy import (
+    CallPolicy,
+    CallTimeout,
+    CircuitBreaker,
+    CircuitOpen,
+    ResilientCaller,
+)
+from copilot.services.gemini_api import GeminiService
+from copilot.services.inline_reply import InlineReplyBroker
+from copilot.services.idempotency import IdempotencyStore, MessageInProgress
+from copilot.services.job_queue import Deferred, JobQueue, PermanentError
+from copilot.services.llm_scheduler import LLMScheduler, SchedulerSaturated
+from copilot.services.local_parser import LocalParser
+from copilot.services.outbound import OutboundQueue, split_message
+from copilot.services.rate_limit import RateLimiter, TokenBucket
+from copilot.services.response_cache import MISSING, ResponseCache
+from copilot.services.statement_import import (
+    StatementError,
+    import_statement,
+    parse_statement,
+)
+
+# Fixed reference date of the parser tests (a Saturday)
+TODAY = date(2026, 10, 17)
+
+
+def make_message(body, message_sid="SM1", sender="+15550100000"):
+    """Text-only inbound TwilioMessage"""
+    return TwilioMessage(
+        message_sid=message_sid,
+        body=body,
+        senderNumber=f"whatsapp:{sender}",
+        sender=sender,
+        recipient="+15550100999",
+        media=[],
+        direction="inbound",
+        timestamp="",
+    )
+
+
+class LocalParserTests(SimpleTestCase):
+    def setUp(self):
+        self.parser = LocalParser()
+
+    def parse(self, text):
+        return self.parser.parse(text, today=TODAY)
+
+    def assertConfident(self, result):
+        self.assertGreaterEqual(result.confidence, 0.8)
+
+    def assertNotConfident(self, result):
+        self.assertLess(result.confidence, 0.8)
+
+    def test_expense(self):
+        result = self.parse("spent $12 on coffee")
+        self.assertEqual(result.intent, "CREATE_TRANSACTION")
+        self.assertConfident(result)
+        self.assertEqual(result.payload["type"], "expense")
+        self.assertEqual(result.payload["category"], "dining")
+        self.assertEqual(result.payload["amount"], 12.0)
+        self.assertEqual(result.payload["description"], "coffee")
+        self.assertEqual(
+            (result.payload["year"], result.payload["month"], result.payload["day"]),
+            (2026, 10, 17),
+        )
+
+    def test_income(self):
+        result = self.parse("got $2,000 salary")
+        self.assertEqual(result.intent, "CREATE_TRANSACTION")
+        self.assertConfident(result)
+        self.assertEqual(result.payload["type"], "income")
+        self.assertEqual(result.payload["category"], "salary")
+        self.assertEqual(result.payload["amount"], 2000.0)
+
+    def test_relative_and_absolute_dates(self):
+        cases = {
+            "paid $40 for groceries yesterday": (2026, 10, 16),
+            "spent $15 at starbucks on march 3": (2026, 3, 3),
+            "spent $8 on lunch 2 days ago": (2026, 10, 15),
+            # A date later in the year means last year
+            "spent $20 on gas on dec 30": (2025, 12, 30),
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                payload = self.parse(text).payload
+                self.assertEqual(
+                    (payload["year"], payload["month"], payload["day"]), expected
+                )
+
+    def test_date_numbers_are_not_amounts(self):
+        result = self.parse("spent $25 on uber on 10/3")
+        self.assertEqual(result.intent, "CREATE_TRANSACTION")
+        self.assertEqual(result.payload["amount"], 25.0)
+        self.assertEqual((result.payload["month"], result.payload["day"]), (10, 3))
+
+    def test_several_amounts(self):
+        result = self.parse("spent $10 on lunch and $5 on coffee")
+        self.assertEqual(result.intent, "MULTIPLE_TRANSACTIONS")
+        self.assertNotConfident(result)
+
+    def test_analytics_question(self):
+        for text in ("how much did I spend on food?", "what did I spend this month"):
+            with self.subTest(text=text):
+                result = self.parse(text)
+                self.assertEqual(result.intent, "ANALYTICS_REQUEST")
+                self.assertIsNone(result.payload)
+
+    def test_questions_without_question_mark(self):
+        result = self.parse("did I spend $50 on gas")
+        self.assertNotEqual(result.intent, "CREATE_TRANSACTION")
+
+    def test_plans_are_not_transactions(self):
+        for text in (
+            "Need to pay $500 rent tomorrow",
+            "planning to spend $200 on shoes",
+            "remind me to pay $100 rent on 3rd",
+            "I will buy a $30 gift next week",
+        ):
+            with self.subTest(text=text):
+                result = self.parse(text)
+                self.assertNotEqual(result.intent, "CREATE_TRANSACTION")
+                self.assertNotConfident(result)
+
+    def test_unresolved_dates_lower_the_confidence(self):
+        for text in ("spent $30 on gas on 3rd", "spent $20 on lunch in march"):
+            with self.subTest(text=text):
+                self.assertNotConfident(self.parse(text))
+
+    def test_foreign_currency_lowers_the_confidence(self):
+        self.assertNotConfident(self.parse("spent €30 on lunch"))
+
+    def test_income_word_with_an_expense_category_is_ambiguous(self):
+        for text in (
+            "I got a $50 parking ticket",
+            "got $30 uber",
+            "received $40 electricity bill",
+            "got $12 lunch",
+        ):
+            with self.subTest(text=text):
+                self.assertNotConfident(self.parse(text))
+
+    def test_amount_without_currency_marker_is_not_confident(self):
+        for text in ("spent 5 on coffee", "paid 40 for groceries yesterday"):
+            with self.subTest(text=text):
+                result = self.parse(text)
+                self.assertEqual(result.intent, "CREATE_TRANSACTION")
+                self.assertNotConfident(result)
+
+    def test_counts_are_not_amounts(self):
+        result = self.parse("spent 5 hours at the gym")
+        self.assertNotEqual(result.intent, "CREATE_TRANSACTION")
+        self.assertNotConfident(result)
+
+    def test_update_and_delete(self):
+        self.assertEqual(
+            self.parse("change the coffee to $5").intent, "UPDATE_TRANSACTION"
+        )
+        self.assertEqual(
+            self.parse("delete the uber ride").intent, "DELETE_TRANSACTION"
+        )
+        self.assertNotConfident(self.parse("delete the uber ride"))
+
+    def test_names(self):
+        for text in ("my name is Sam", "Hi, call me Sam"):
+            with self.subTest(text=text):
+                result = self.parse(text)
+                self.assertEqual(result.intent, "INPUT_NAME")
+                self.assertEqual(result.payload, {"name": "Sam"})
+                self.assertConfident(result)
+
+    def test_ambiguous_name_stays_below_the_degraded_threshold(self):
+        result = self.parse("I am broke")
+        self.assertEqual(result.intent, "INPUT_NAME")
+        self.assertLess(result.confidence, 0.5)
+
+    def test_other(self):
+        for text in ("", "hello there", "thanks!"):
+            with self.subTest(text=text):
+                result = self.parse(text)
+                self.assertEqual(result.intent, "OTHER")
+                self.assertEqual(result.confidence, 0.0)
+
+
+class TransactionRollupTests(TestCase):
+    family_id = "family-1"
+
+    def create(self, **fields):
+        values = dict(
+            familyId=self.family_id,
+            userId="user-1",
+            type="expense",
+            category="dining",
+            year=2026,
+            month=10,
+            day=3,
+            amount=12.5,
+            description="coffee",
+        )
+        values.update(fields)
+        transaction = Transaction(**values)
+        transaction.save()
+        return transaction
+
+    def monthly(self, year=2026, month=10):
+        data = TransactionSummary.objects.get(familyId=self.family_id).data
+        if not isinstance(data, YearlySummary):
+            data = YearlySummary.from_dict(data)
+        return data.get_monthly_summary(year, month)
+
+    def test_save_adds_to_the_summary(self):
+        self.create()
+        self.create(type="income", category="salary", amount=1000)
+        monthly = self.monthly()
+        self.assertEqual((monthly.income, monthly.expense), (1000, 12.5))
+        self.assertEqual(monthly.categories["dining"], {"income": 0, "expense": 12.5})
+
+    def test_update_moves_the_amount(self):
+        transaction = self.create()
+        transaction.amount = 20
+        transaction.month = 9
+        transaction.category = "shopping"
+        transaction.save()
+        self.assertEqual(self.monthly(month=10).expense, 0)
+        self.assertNotIn("dining", self.monthly(month=10).categories)
+        september = self.monthly(month=9)
+        self.assertEqual(september.expense, 20)
+        self.assertEqual(september.categories["shopping"]["expense"], 20)
+
+    def test_delete_removes_the_amount(self):
+        kept = self.create(amount=5)
+        self.create().delete()
+        self.assertEqual(self.monthly().expense, 5)
+        kept.delete()
+        self.assertEqual(self.monthly().expense, 0)
+
+    def test_bulk_create(self):
+        Transaction.objects.bulk_create_with_summaries(
+            [
+                Transaction(
+                    familyId=self.family_id,
+                    userId="user-1",
+                    type=type,
+                    category="misc",
+                    year=2026,
+                    month=10,
+                    day=1,
+                    amount=amount,
+                    description="",
+                )
+                for type, amount in (("expense", 3), ("Expense", 4), ("income", 10))
+            ]
+        )
+        monthly = self.monthly()
+        self.assertEqual((monthly.income, monthly.expense), (10, 7))
+
+    def test_type_is_normalized(self):
+        transaction = self.create(type=" Expense ")
+        self.assertEqual(transaction.type, "expense")
+        self.assertEqual(self.monthly().expense, 12.5)
+
+    def test_unknown_type_is_rejected(self):
+        with self.assertRaises(InvalidTransaction):
+            self.create(type="transfer")
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_verify_and_rebuild(self):
+        self.create()
+        call_command("rebuild_summaries", "--verify", stdout=StringIO())
+
+        # Rows changed behind the rollup's back (e.g. a raw import)
+        Transaction.objects.filter(familyId=self.family_id).update(amount=99)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_summaries", "--verify", stdout=StringIO())
+        self.assertEqual(self.monthly().expense, 12.5)
+
+        call_command("rebuild_summaries", stdout=StringIO())
+        self.assertEqual(self.monthly().expense, 99)
+        call_command("rebuild_summaries", "--verify", stdout=StringIO())
+
+
+class StatementImportTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as statement:
+            statement.write(content)
+        return path
+
+    def test_csv(self):
+        path = self.write(
+            "statement.csv",
+            "Posted Date,Description,Debit,Credit\n"
+            "01/05/2026,Coffee  Shop,12.50,\n"
+            "01/06/2026,Payroll,,2000\n",
+        )
+        rows = list(parse_statement(path))
+        self.assertEqual(
+            [(row["date"], row["type"], row["amount"]) for row in rows],
+            [(date(2026, 1, 5), "expense", 12.5), (date(2026, 1, 6), "income", 2000)],
+        )
+        self.assertEqual(rows[0]["description"], "Coffee Shop")
+        self.assertEqual(rows[0]["category"], "dining")
+
+    def test_ofx_and_qif(self):
+        ofx = self.write(
+            "statement.ofx",
+            "<OFX><STMTTRN><TRNAMT>-42.10<DTPOSTED>20260107120000"
+            "<NAME>Uber</STMTTRN></OFX>",
+        )
+        qif = self.write("statement.qif", "!Type:Bank\nD1/ 8'26\nT-9.99\nPNetflix\n^\n")
+        (ofx_row,) = parse_statement(ofx)
+        (qif_row,) = parse_statement(qif)
+        self.assertEqual((ofx_row["date"], ofx_row["amount"]), (date(2026, 1, 7), 42.1))
+        self.assertEqual((qif_row["date"], qif_row["amount"]), (date(2026, 1, 8), 9.99))
+
+    def test_errors(self):
+        cases = {
+            "statement.txt": "Date,Amount\n2026-01-05,1\n",
+            "missing.csv": "Date,Description\n2026-01-05,Coffee\n",
+            "date.csv": "Date,Amount\nyesterday,1\n",
+            "amount.csv": "Date,Amount\n2026-01-05,twelve\n",
+        }
+        for name, content in cases.items():
+            with self.subTest(name=name):
+                with self.assertRaises(StatementError):
+                    list(parse_statement(self.write(name, content)))
+
+    def test_bad_line_imports_nothing(self):
+        path = self.write(
+            "statement.csv",
+            "Date,Amount,Description\n2026-01-05,-12.50,Coffee\n2026-01-06,abc,Bad\n",
+        )
+        with self.assertRaises(StatementError):
+            import_statement(path, "family-1", "user-1", chunk_size=1)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_import_again_skips_known_lines(self):
+        path = self.write(
+            "statement.csv",
+            "Date,Amount,Description\n"
+            "2026-01-05,-12.50,Coffee\n"
+            "2026-01-05,-12.50,Coffee\n"
+            "2026-01-06,2000,Payroll\n",
+        )
+        first = import_statement(path, "family-1", "user-1", chunk_size=2)
+        self.assertEqual((first["rows"], first["skipped"]), (3, 0))
+        again = import_statement(path, "family-1", "user-1")
+        self.assertEqual((again["rows"], again["skipped"]), (0, 3))
+        self.assertEqual(Transaction.objects.count(), 3)
+        # Other families import the same lines
+        other = import_statement(path, "family-2", "user-2")
+        self.assertEqual(other["rows"], 3)
+
+    def test_identical_lines_across_chunks(self):
+        two = self.write(
+            "two.csv", "Date,Amount,Description\n" + "2026-01-05,-3,Tea\n" * 2
+        )
+        three = self.write(
+            "three.csv", "Date,Amount,Description\n" + "2026-01-05,-3,Tea\n" * 3
+        )
+        self.assertEqual(
+            import_statement(two, "family-1", "user-1", chunk_size=1)["rows"], 2
+        )
+        again = import_statement(two, "family-1", "user-1", chunk_size=1)
+        self.assertEqual((again["rows"], again["skipped"]), (0, 2))
+        # The family has two of these lines, the third one is new
+        more = import_statement(three, "family-1", "user-1", chunk_size=1)
+        self.assertEqual((more["rows"], more["skipped"]), (1, 2))
+        self.assertEqual(Transaction.objects.count(), 3)
+
+
+class IdempotencyStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = IdempotencyStore(wait_timeout=0.2, poll_interval=0.01)
+        self.store.cache.clear()
+
+    def test_mark_received_once(self):
+        self.assertTrue(self.store.mark_received("SM1"))
+        self.assertFalse(self.store.mark_received("SM1"))
+        self.assertTrue(self.store.mark_received("SM2"))
+
+    def test_duplicate_reuses_the_reply(self):
+        self.assertIsNone(self.store.acquire("SM1"))
+        self.store.finish("SM1", "Added")
+        self.assertEqual(
+            self.store.acquire("SM1"),
+            {"state": "done", "reply": "Added", "sent": False},
+        )
+        self.store.mark_sent("SM1", "Added")
+        self.assertTrue(self.store.acquire("SM1")["sent"])
+
+    def test_duplicate_waits_for_a_running_execution(self):
+        self.assertIsNone(self.store.acquire("SM1"))
+        with self.assertRaises(MessageInProgress):
+            self.store.acquire("SM1")
+
+    def test_release_lets_a_retry_start_over(self):
+        self.assertIsNone(self.store.acquire("SM1"))
+        self.store.release("SM1")
+        self.assertIsNone(self.store.acquire("SM1"))
+
+    def test_expired_lease_can_be_taken_over(self):
+        store = IdempotencyStore(lease=1, wait_timeout=0, poll_interval=0.01)
+        # The first execution's worker dies without finishing or releasing
+        self.assertIsNone(store.acquire("SM1"))
+        with self.assertRaises(MessageInProgress):
+            store.acquire("SM1")
+        time.sleep(1.1)
+        self.assertIsNone(store.acquire("SM1"))
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.queue = JobQueue(MessageJob, max_attempts=2, retry_backoff=60)
+
+    def enqueue(self, message_sid="SM1", delay=0):
+        return self.queue.enqueue(
+            delay=delay, message_sid=message_sid, sender="+15550100000"
+        )
+
+    def test_claim_hands_a_job_out_once(self):
+        job = self.enqueue()
+        claimed = self.queue.claim()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual((claimed.status, claimed.attempts), ("running", 1))
+        self.assertIsNone(self.queue.claim())
+
+    def test_claim_skips_delayed_jobs_and_takes_the_oldest(self):
+        self.enqueue("SM-later", delay=60)
+        first = self.enqueue("SM-first")
+        self.enqueue("SM-second")
+        self.assertEqual(self.queue.claim().pk, first.pk)
+
+    def test_expired_lease_is_claimable_again(self):
+        job = self.enqueue()
+        self.queue.claim()
+        # The worker died, its lease ran out
+        MessageJob.objects.filter(pk=job.pk).update(
+            locked_until=timezone.now() - timedelta(seconds=1)
+        )
+        claimed = self.queue.claim()
+        self.assertEqual((claimed.pk, claimed.attempts), (job.pk, 2))
+
+    def test_deferred_does_not_use_up_an_attempt(self):
+        job = self.enqueue()
+
+        def handler(job):
+            raise Deferred(30)
+
+        self.assertTrue(self.queue.run_once(handler))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.deferrals), ("pending", 0, 1))
+        self.assertGreater(job.available_at, timezone.now() + timedelta(seconds=20))
+        self.assertIsNone(self.queue.claim())
+
+    def test_deferred_too_often_fails(self):
+        queue = JobQueue(MessageJob, max_deferrals=2)
+        job = self.enqueue()
+        failed = []
+        queue.on_failed = failed.append
+
+        def handler(job):
+            raise Deferred(0)
+
+        for _ in range(2):
+            queue.run_once(handler)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.deferrals), ("pending", 2))
+
+        with self.assertLogs("copilot.services.job_queue", "WARNING"):
+            queue.run_once(handler)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual([failed_job.pk for failed_job in failed], [job.pk])
+
+        queue.replay(MessageJob.objects.filter(pk=job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.deferrals), ("pending", 0))
+
+    def test_errors_are_retried_with_backoff_then_fail(self):
+        job = self.enqueue()
+
+        def handler(job):
+            raise RuntimeError("boom")
+
+        with self.assertLogs("copilot.services.job_queue", "ERROR"):
+            self.queue.run_once(handler)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("pending", 1))
+        self.assertIn("boom", job.last_error)
+
+        MessageJob.objects.filter(pk=job.pk).update(available_at=timezone.now())
+        with self.assertLogs("copilot.services.job_queue", "ERROR"):
+            self.queue.run_once(handler)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+
+    def test_permanent_error_fails_right_away(self):
+        job = self.enqueue()
+
+        def handler(job):
+            raise PermanentError("invalid number")
+
+        with self.assertLogs("copilot.services.job_queue", "WARNING"):
+            self.queue.run_once(handler)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 1))
+
+    def test_complete(self):
+        job = self.enqueue()
+        self.queue.run_once(lambda job: None)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "done")
+        self.assertFalse(self.queue.run_once(lambda job: None))
+
+
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.queue = OutboundQueue()
+
+    def enqueue(self, to, body):
+        return self.queue.enqueue(to=to, body=body)
+
+    def test_messages_to_a_number_go_out_in_order(self):
+        first = self.enqueue("+15550100001", "first")
+        second = self.enqueue("+15550100001", "second")
+        other = self.enqueue("+15550100002", "other")
+
+        self.assertEqual(self.queue.claim().pk, first.pk)
+        # The second message waits for the first, other numbers don't
+        self.assertEqual(self.queue.claim().pk, other.pk)
+        self.assertIsNone(self.queue.claim())
+
+        # Still blocked while the first is retried
+        claimed = OutboundMessage.objects.get(pk=first.pk)
+        self.queue.fail(claimed, "timeout")
+        self.assertIsNone(self.queue.claim())
+
+        OutboundMessage.objects.filter(pk=first.pk).update(status=QueuedJob.STATUS_DONE)
+        self.assertEqual(self.queue.claim().pk, second.pk)
+
+    def test_failed_message_does_not_block_the_next(self):
+        first = self.enqueue("+15550100001", "first")
+        second = self.enqueue("+15550100001", "second")
+        self.queue.fail(self.queue.claim(), "invalid", retry=False)
+        self.assertEqual(OutboundMessage.objects.get(pk=first.pk).status, "failed")
+        self.assertEqual(self.queue.claim().pk, second.pk)
+
+
+class SplitMessageTests(SimpleTestCase):
+    def test_short_message_is_one_part(self):
+        self.assertEqual(split_message("  Added  "), ["Added"])
+        self.assertEqual(split_message(""), [])
+
+    def test_parts_stay_within_the_limit(self):
+        text = " ".join(f"word{i}" for i in range(1000))
+        parts = split_message(text, limit=100)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        self.assertEqual(" ".join(parts), text)
+
+    def test_prefers_paragraph_boundaries(self):
+        text = "a" * 60 + "\n\n" + "b " * 30
+        self.assertEqual(split_message(text, limit=80)[0], "a" * 60)
+
+    def test_long_word_is_cut(self):
+        self.assertEqual(
+            split_message("x" * 250, limit=100), ["x" * 100] * 2 + ["x" * 50]
+        )
+
+
+@override_settings(COPILOT_INLINE_REPLY_SAME_PROCESS=True)
+class InlineReplyBrokerTests(SimpleTestCase):
+    def setUp(self):
+        self.broker = InlineReplyBroker(deadline=1, poll_interval=0.01)
+        self.broker.cache.clear()
+
+    def test_answer_offered_while_waiting_goes_inline(self):
+        self.assertTrue(self.broker.register("SM1"))
+        self.assertTrue(self.broker.offer("SM1", "Added"))
+        self.assertEqual(self.broker.wait("SM1"), "Added")
+
+    def test_webhook_that_gave_up_leaves_the_answer_to_rest(self):
+        self.assertTrue(self.broker.register("SM1"))
+        self.assertIsNone(self.broker.wait("SM1", timeout=0))
+        self.assertFalse(self.broker.offer("SM1", "Added"))
+
+    def test_any_answer_text_goes_inline(self):
+        self.assertTrue(self.broker.register("SM1"))
+        self.assertTrue(self.broker.offer("SM1", "rest"))
+        self.assertEqual(self.broker.wait("SM1"), "rest")
+
+    def test_no_waiter_means_rest(self):
+        self.assertFalse(self.broker.offer("SM1", "Added"))
+
+    def test_one_waiter_per_message(self):
+        self.assertTrue(self.broker.register("SM1"))
+        self.assertFalse(self.broker.register("SM1"))
+
+    def test_disabled(self):
+        broker = InlineReplyBroker(deadline=0)
+        self.assertFalse(broker.register("SM1"))
+        self.assertFalse(broker.offer("SM1", "Added"))
+
+    @override_settings(COPILOT_INLINE_REPLY_SAME_PROCESS=False)
+    def test_disabled_on_a_process_local_cache(self):
+        # The test settings use LocMemCache, which workers can't see
+        broker = InlineReplyBroker(deadline=1)
+        self.assertFalse(broker.enabled)
+        self.assertFalse(broker.register("SM1"))
+
+
+class WhatsAppWebhookTests(TestCase):
+    def post(self, message_sid="SM1", body="spent $12 on coffee"):
+        return self.client.post(
+            "/whatsapp",
+            {
+                "MessageSid": message_sid,
+                "From": "whatsapp:+15550100000",
+                "To": "whatsapp:+15550100999",
+                "Body": body,
+                "NumMedia": "0",
+            },
+        )
+
+    def setUp(self):
+        caches["idempotency"].clear()
+
+    def test_acknowledges_without_waiting_on_a_process_local_cache(self):
+        started = time.monotonic()
+        response = self.post()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b"<Message>", response.content)
+        self.assertEqual(MessageJob.objects.filter(message_sid="SM1").count(), 1)
+
+    def test_single_message_is_claimable_within_a_second(self):
+        self.post()
+        job = MessageJob.objects.get()
+        self.assertLess(job.available_at, timezone.now() + timedelta(seconds=1))
+
+    def test_duplicate_delivery_is_queued_once(self):
+        self.post()
+        self.post()
+        self.assertEqual(MessageJob.objects.filter(message_sid="SM1").count(), 1)
+
+    @override_settings(
+        COPILOT_INLINE_REPLY_SAME_PROCESS=True, COPILOT_DEBOUNCE_WINDOW=0
+    )
+    def test_answer_ready_in_time_is_returned_inline(self):
+        from copilot import views
+
+        broker = InlineReplyBroker(deadline=2, poll_interval=0.01)
+        enqueue_message = views.enqueue_message
+
+        def enqueue_and_answer(twilio_message):
+            # As if a worker answered right after the job was queued
+            job = enqueue_message(twilio_message)
+            self.assertTrue(broker.offer(job.message_sid, "Added coffee"))
+            return job
+
+        with mock.patch.object(views, "inline_replies", broker), mock.patch.object(
+            views, "enqueue_message", enqueue_and_answer
+        ):
+            response = self.post()
+        self.assertIn(b"Added coffee", response.content)
+
+
+@override_settings(COPILOT_DEBOUNCE_WINDOW=0)
+class MessageWorkerTests(TestCase):
+    sender = "+15550100000"
+
+    def setUp(self):
+        caches["idempotency"].clear()
+
+    def post(self, message_sid, body):
+        self.client.post(
+            "/whatsapp",
+            {
+                "MessageSid": message_sid,
+                "From": f"whatsapp:{self.sender}",
+                "To": "whatsapp:+15550100999",
+                "Body": body,
+                "NumMedia": "0",
+            },
+        )
+
+    def send(self, message_sid, body):
+        """Deliver a message to the webhook and let a worker process it"""
+        from copilot.views import message_queue, process_message_job
+
+        self.post(message_sid, body)
+        self.assertTrue(message_queue.run_once(process_message_job))
+        return OutboundMessage.objects.get(reply_to=message_sid).body
+
+    def test_unregistered_sender_is_asked_for_a_name_then_registered(self):
+        self.assertEqual(self.send("SM1", "spent $12 on coffee"), REPLY_ASK_NAME)
+        self.assertFalse(Transaction.objects.exists())
+
+        self.assertEqual(
+            self.send("SM2", "my name is Sam"), REPLY_WELCOME.format(name="Sam")
+        )
+        user = User.objects.get(number=self.sender)
+        self.assertEqual(user.name, "Sam")
+
+        self.send("SM3", "spent $12 on coffee")
+        transaction = Transaction.objects.get()
+        self.assertEqual(
+            (transaction.userId, transaction.amount), (str(user.userId), 12)
+        )
+
+    def test_failed_extraction_is_answered(self):
+        from copilot import views
+
+        user = User(name="Sam", number=self.sender)
+        user.save()
+        twilio_message = make_message("change the coffee", sender=self.sender)
+        gemini_service = mock.Mock()
+        gemini_service.extract_transaction_update_details.return_value = None
+        with mock.patch.object(
+            views, "get_gemini_service", return_value=gemini_service
+        ):
+            for handler in (views.update_transaction, views.delete_transaction):
+                with self.subTest(handler=handler.__name__):
+                    self.assertEqual(
+                        handler(twilio_message, user=user), REPLY_NOT_PROCESSED
+                    )
+        self.assertEqual(
+            views.update_transaction(twilio_message, {"search": {}}, user=user),
+            REPLY_NOT_PROCESSED,
+        )
+
+    @override_settings(COPILOT_JOB_MAX_ATTEMPTS=1)
+    def test_job_that_failed_for_good_is_answered(self):
+        from copilot import views
+
+        self.post("SM1", "spent $12 on coffee")
+        with mock.patch.object(
+            views, "handle_message", side_effect=RuntimeError("boom")
+        ), self.assertLogs("copilot", "WARNING"):
+            views.MessageQueue().run_once(views.process_message_job)
+        self.assertEqual(MessageJob.objects.get().status, "failed")
+        self.assertEqual(
+            OutboundMessage.objects.get(reply_to="SM1").body, REPLY_NOT_PROCESSED
+        )
+
+
+class LLMSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = LLMScheduler(
+            concurrency=1,
+            max_queue={"background": 1},
+            max_wait={"analytics": 0.02},
+        )
+
+    def wait_queued(self, lane, depth):
+        for _ in range(200):
+            if self.scheduler.stats()["lanes"][lane]["queued"] == depth:
+                return
+            time.sleep(0.005)
+        self.fail(f"{lane} never had {depth} queued calls")
+
+    def test_lanes_in_priority_order(self):
+        granted = []
+
+        def call(lane, tag):
+            self.scheduler.run(lane, granted.append, tag)
+
+        self.scheduler.acquire("interactive")
+        threads = []
+        for lane, tag, depth in (
+            ("background", "background", 1),
+            ("interactive", "interactive-1", 1),
+            ("interactive", "interactive-2", 2),
+        ):
+            threads.append(threading.Thread(target=call, args=(lane, tag)))
+            threads[-1].start()
+            self.wait_queued(lane, depth)
+        self.scheduler.release("interactive")
+        for thread in threads:
+            thread.join(1)
+
+        self.assertEqual(granted, ["interactive-1", "interactive-2", "background"])
+        stats = self.scheduler.stats()
+        self.assertEqual(stats["active"], 0)
+        self.assertEqual(stats["lanes"]["interactive"]["completed"], 3)
+        self.assertGreater(stats["lanes"]["background"]["wait_seconds_max"], 0)
+
+    def test_full_lane_rejects(self):
+        self.scheduler.acquire("interactive")
+        thread = threading.Thread(target=self.scheduler.run, args=("background", dict))
+        thread.start()
+        self.wait_queued("background", 1)
+        with self.assertRaisesMessage(SchedulerSaturated, "1 calls queued"):
+            self.scheduler.acquire("background")
+        self.scheduler.release("interactive")
+        thread.join(1)
+        self.assertEqual(self.scheduler.stats()["lanes"]["background"]["rejected"], 1)
+
+    def test_wait_times_out(self):
+        with self.scheduler.slot("interactive"):
+            with self.assertRaisesMessage(SchedulerSaturated, "no slot within"):
+                self.scheduler.acquire("analytics")
+        stats = self.scheduler.stats()
+        self.assertEqual(stats["lanes"]["analytics"]["timed_out"], 1)
+        self.assertEqual(stats["lanes"]["analytics"]["queued"], 0)
+        # The abandoned ticket doesn't block the queue
+        self.assertEqual(self.scheduler.run("analytics", lambda: "ok"), "ok")
+
+    def test_non_blocking_lease(self):
+        release = self.scheduler.lease("interactive", blocking=False)
+        with self.assertRaisesMessage(SchedulerSaturated, "no free slot"):
+            self.scheduler.lease("interactive", blocking=False)
+        release()
+        self.assertEqual(self.scheduler.stats()["lanes"]["interactive"]["submitted"], 1)
+        with self.assertRaises(ValueError):
+            self.scheduler.acquire("batch")
+
+
+@override_settings(
+    COPILOT_GEMINI_CALL_POLICIES={"default": {"timeout": 0.05, "retries": 0}}
+)
+class GeminiConcurrencyTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = LLMScheduler(concurrency=1, max_wait={"interactive": 0.05})
+        self.caller = ResilientCaller()
+        self.hung = threading.Event()
+        self.addCleanup(self.hung.set)
+
+    def call(self, fn, method="identify_intent"):
+        return self.caller.call(
+            method,
+            fn,
+            lease=lambda blocking=True: self.scheduler.lease("interactive", blocking),
+        )
+
+    def test_timed_out_request_keeps_its_slot_until_it_finishes(self):
+        with self.assertRaises(CallTimeout):
+            self.call(self.hung.wait)
+        # The abandoned request is still in flight
+        self.assertEqual(self.scheduler.stats()["active"], 1)
+        with self.assertRaises(SchedulerSaturated):
+            self.call(lambda: "ok")
+
+        self.hung.set()
+        for _ in range(100):
+            if not self.scheduler.stats()["active"]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.call(lambda: "ok"), "ok")
+
+    def first_hangs(self):
+        """API call whose first request hangs and whose hedge answers"""
+        requests = iter([self.hung.wait, lambda: "hedged"])
+        return lambda: next(requests)()
+
+    @override_settings(
+        COPILOT_GEMINI_CALL_POLICIES={
+            "default": {"timeout": 1, "retries": 0, "hedge_after": 0.02}
+        }
+    )
+    def test_hedge_only_with_a_free_slot(self):
+        with self.assertRaises(CallTimeout):
+            self.call(self.first_hangs())
+        stats = self.caller.stats()["identify_intent"]
+        self.assertEqual((stats.get("hedges", 0), stats["hedges_skipped"]), (0, 1))
+
+        # One slot is still held by the request abandoned above
+        self.scheduler.concurrency = 3
+        self.assertEqual(self.call(self.first_hangs()), "hedged")
+        self.assertEqual(self.caller.stats()["identify_intent"]["hedges"], 1)
+
+
+class GeminiMediaTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            MEDIA_ROOT=directory.name,
+            COPILOT_GEMINI_CLIENT_FACTORY="copilot.loadtest.fake_gemini.create_client",
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.gemini_service = GeminiService()
+
+    def media(self, name, content_type, content):
+        return TwilioMedia(
+            url="",
+            content_type=content_type,
+            local_path=default_storage.save(name, ContentFile(content)),
+        )
+
+    def test_image_is_decoded_once(self):
+        image = BytesIO()
+        PIL.Image.new("RGB", (2, 2)).save(image, "PNG")
+        media = self.media("receipt.png", "image/png", image.getvalue())
+        decoded = self.gemini_service.media_content(media)
+        self.assertEqual(decoded.size, (2, 2))
+        self.assertIs(self.gemini_service.media_content(media), decoded)
+        self.assertIsNone(self.gemini_service.toBytes(media.local_path, "audio/ogg"))
+
+    def test_voice_message_without_transcript(self):
+        media = self.media("note.ogg", "audio/ogg", b"not audio")
+        with mock.patch.object(
+            self.gemini_service, "convert_speech_to_text", return_value=None
+        ):
+            self.assertEqual(
+                self.gemini_service.media_content(media), "Voice Message: "
+            )
+
+
+class IntentResultTests(SimpleTestCase):
+    def test_create_transaction_payload_is_coerced(self):
+        result = IntentResult.from_dict(
+            {
+                "intent": " create_transaction ",
+                "payload": {
+                    "type": "expense",
+                    "category": "pets",
+                    "amount": "12.5",
+                    "day": "3",
+                    "month": 10,
+                    "year": 2026,
+                },
+            }
+        )
+        self.assertEqual(result.intent, "CREATE_TRANSACTION")
+        self.assertEqual(
+            result.payload,
+            {
+                "type": "expense",
+                "category": "misc",
+                "amount": 12.5,
+                "day": 3,
+                "month": 10,
+                "year": 2026,
+                "description": "",
+            },
+        )
+
+    def test_invalid_responses(self):
+        for data in (
+            [],
+            {"intent": "SING"},
+            {"intent": "INPUT_NAME", "payload": {"name": " "}},
+            {"intent": "CREATE_TRANSACTION", "payload": {"amount": 5}},
+            {"intent": "CREATE_TRANSACTION", "payload": "spent $5"},
+            {"intent": "UPDATE_TRANSACTION", "payload": {"updates": {}}},
+            {"intent": "MULTIPLE_TRANSACTIONS", "payload": {"transactions": [{}]}},
+        ):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    IntentResult.from_dict(data)
+
+    def test_invalid_transactions_are_dropped(self):
+        valid = {"amount": 3, "day": 1, "month": 10, "year": 2026}
+        result = IntentResult.from_dict(
+            {
+                "intent": "MULTIPLE_TRANSACTIONS",
+                "payload": {"transactions": [valid, {"amount": "x"}, "coffee"]},
+            }
+        )
+        self.assertEqual(len(result.payload["transactions"]), 1)
+
+
+class ResolveIntentTests(SimpleTestCase):
+    def resolve(self, body, gemini_service):
+        from copilot.views import resolve_intent
+
+        return resolve_intent(make_message(body), gemini_service)
+
+    def test_confident_local_parse_skips_gemini(self):
+        gemini_service = mock.Mock()
+        result = self.resolve("spent $12 on coffee", gemini_service)
+        self.assertEqual(result.intent, "CREATE_TRANSACTION")
+        gemini_service.classify_and_extract.assert_not_called()
+
+    def test_combined_call(self):
+        gemini_service = mock.Mock()
+        gemini_service.classify_and_extract.return_value = IntentResult(
+            intent="ANALYTICS_REQUEST", payload={}
+        )
+        result = self.resolve("am I doing ok", gemini_service)
+        self.assertEqual(result.intent, "ANALYTICS_REQUEST")
+        gemini_service.send_message.assert_not_called()
+
+    def test_invalid_combined_response_falls_back_to_two_calls(self):
+        gemini_service = mock.Mock()
+        gemini_service.classify_and_extract.side_effect = ValueError("bad JSON")
+        gemini_service.send_message.return_value = " analytics_request\n"
+        with self.assertLogs("copilot.views", "WARNING"):
+            result = self.resolve("am I doing ok", gemini_service)
+        self.assertEqual(result.intent, "ANALYTICS_REQUEST")
+        # The details are extracted later by the intent handler
+        self.assertIsNone(result.payload)
+
+    @override_settings(COPILOT_INTENT_MODE="two_call")
+    def test_two_call_mode(self):
+        gemini_service = mock.Mock()
+        gemini_service.send_message.return_value = "OTHER"
+        self.assertEqual(self.resolve("hello there", gemini_service).intent, "OTHER")
+        gemini_service.classify_and_extract.assert_not_called()
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ResponseCache(ttls={"default": 0, "identify_intent": 60})
+        self.cache.cache.clear()
+
+    def test_key(self):
+        key = self.cache.make_key("identify_intent", "Classify", " spent  $5\n")
+        self.assertEqual(
+            key, self.cache.make_key("identify_intent", "Classify", "spent $5")
+        )
+        for other in (
+            self.cache.make_key("extract_user_name", "Classify", "spent $5"),
+            self.cache.make_key("identify_intent", "Extract", "spent $5"),
+            self.cache.make_key("identify_intent", "Classify", "spent $6"),
+            self.cache.make_key("identify_intent", "Classify", "spent $5", ["ab"]),
+            self.cache.make_key(
+                "identify_intent", "Classify", "spent $5", date="2026-10-17"
+            ),
+            self.cache.make_key(
+                "identify_intent", "Classify", "spent $5", context="user: hi"
+            ),
+        ):
+            self.assertNotEqual(key, other)
+
+    def test_ttl_per_method(self):
+        self.assertEqual(self.cache.ttl("identify_intent"), 60)
+        self.assertEqual(self.cache.ttl("answer_analytical_query"), 0)
+
+        key = self.cache.make_key("identify_intent", "Classify", "")
+        self.assertIs(self.cache.get("identify_intent", key), MISSING)
+        # An empty response is a hit too
+        self.cache.set("identify_intent", key, "")
+        self.assertEqual(self.cache.get("identify_intent", key), "")
+        self.assertEqual(
+            self.cache.stats(), {"identify_intent": {"hits": 1, "misses": 1}}
+        )
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttls={"identify_intent": 1})
+        key = cache.make_key("identify_intent", "Classify", "hi")
+        cache.set("identify_intent", key, "OTHER")
+        self.assertEqual(cache.get("identify_intent", key), "OTHER")
+        time.sleep(1.1)
+        self.assertIs(cache.get("identify_intent", key), MISSING)
+
+    @override_settings(
+        COPILOT_GEMINI_CLIENT_FACTORY="copilot.loadtest.fake_gemini.create_client"
+    )
+    def test_send_message_reuses_cached_responses(self):
+        gemini_service = GeminiService()
+        gemini_service.response_cache = self.cache
+        response = mock.Mock(text="OTHER")
+        with mock.patch.object(
+            gemini_service, "generate", return_value=response
+        ) as generate:
+            for body in ("hello there", "hello  there"):
+                self.assertEqual(
+                    gemini_service.send_message(
+                        "Classify", make_message(body), cache_method="identify_intent"
+                    ),
+                    "OTHER",
+                )
+            self.assertEqual(generate.call_count, 1)
+            # Methods without a TTL are not cached
+            for _ in range(2):
+                gemini_service.send_message(
+                    "Answer", make_message("hi"), cache_method="answer_analytical_query"
+                )
+            self.assertEqual(generate.call_count, 3)
+
+
+def save_transaction(**fields):
+    """Saved expense of family-1, fields override the defaults"""
+    values = dict(
+        familyId="family-1",
+        userId="user-1",
+        type="expense",
+        category="dining",
+        year=2026,
+        month=10,
+        day=3,
+        amount=12.5,
+        description="coffee",
+    )
+    values.update(fields)
+    transaction = Transaction(**values)
+    transaction.save()
+    return transaction
+
+
+class FindTransactionTests(TestCase):
+    def setUp(self):
+        self.user = User(name="Sam", number="+15550100000")
+        self.user.save()
+        self.family_id = self.user.familyId
+
+    def add(self, **fields):
+        return save_transaction(familyId=self.family_id, **fields)
+
+    def find(self, **search):
+        from copilot.views import find_latest_transaction
+
+        return find_latest_transaction(self.user, search)
+
+    def test_latest_exact_match(self):
+        self.add(amount=12.5, day=1)
+        latest = self.add(amount=12.99, day=2)
+        self.add(amount=13, day=5)
+        save_transaction(familyId="other-family", amount=12, day=9)
+        # Amounts match on their whole-dollar part
+        self.assertEqual(self.find(amount=12).pk, latest.pk)
+        self.assertEqual(self.find(amount="12.5").pk, latest.pk)
+
+    def test_dates(self):
+        september = self.add(month=9, day=30)
+        october = self.add(month=10, day=3)
+        self.add(year=2025, month=10, day=3)
+        self.assertEqual(self.find(year=2026, month=9).pk, september.pk)
+        self.assertEqual(self.find(year=2026, month=10, day=3).pk, october.pk)
+        # A day of any month
+        self.assertEqual(self.find(day=30).pk, september.pk)
+        self.assertIsNone(self.find(year=2026, month=11))
+
+    def test_needs_a_search_criterion(self):
+        self.add()
+        with self.assertLogs("copilot.views", "INFO"):
+            self.assertIsNone(self.find())
+            self.assertIsNone(self.find(type="expense", category="dining"))
+            self.assertIsNone(self.find(amount=None, description=""))
+
+    def test_description(self):
+        coffee = self.add(description="Starbucks coffee", day=1)
+        self.add(description="Lunch at Chipotle", day=2)
+        self.assertEqual(self.find(description="coffe").pk, coffee.pk)
+        # Gemini sends several one-word candidates when there is no amount
+        self.assertEqual(self.find(description=["tea", "coffee"]).pk, coffee.pk)
+        self.assertIsNone(self.find(description="parking"))
+
+    def test_matching_filters(self):
+        self.add(type="income", category="salary", amount=2000)
+        expense = self.add(amount=2000)
+        matching = Transaction.objects.for_family(self.family_id).matching(
+            {"type": "expense", "amount": 2000, "description": "latte coffee"}
+        )
+        self.assertEqual([transaction.pk for transaction in matching], [expense.pk])
+
+
+class DescriptionSearchTests(TestCase):
+    def test_words_and_ngrams(self):
+        self.assertEqual(
+            description_search.words(["Tea", "Caffè-latte!"]),
+            ["tea", "caff", "latte"],
+        )
+        self.assertEqual(description_search.words(None), [])
+        grams = description_search.ngrams("Starbucks")
+        self.assertEqual(len(grams), 9)
+        self.assertTrue({" st", "sta", "ks "} <= grams)
+        # Short words still have one n-gram
+        self.assertEqual(description_search.ngrams("a"), {" a "})
+
+    def test_rank_matches(self):
+        old = save_transaction(description="coffee", year=2026, month=6, day=1)
+        recent = save_transaction(description="coffee", day=15)
+        close = save_transaction(description="coffee", day=15, amount=4)
+        fuzzy = save_transaction(description="coffe shop", day=16)
+        save_transaction(description="parking", day=16)
+
+        ranked = description_search.rank_matches(
+            Transaction.objects.all(), "coffee", amount=4, today=TODAY
+        )
+        # The amount breaks ties, and a recent near match beats an exact
+        # match from months ago
+        self.assertEqual(
+            [transaction.pk for transaction in ranked],
+            [close.pk, recent.pk, fuzzy.pk, old.pk],
+        )
+        strict = description_search.rank_matches(
+            Transaction.objects.all(), ["tea", "coffee"], min_similarity=1
+        )
+        self.assertNotIn(fuzzy, strict)
+        self.assertEqual(len(strict), 3)
+
+    def test_candidate_ids(self):
+        coffee = save_transaction(description="Starbucks coffee")
+        latte = save_transaction(description="latte")
+        save_transaction(familyId="family-2", description="coffee")
+
+        candidates = DescriptionNgram.objects.candidate_ids
+        self.assertEqual(candidates("family-1", ["coffee"]), [coffee.pk])
+        # The best overlap of any term counts, most shared first
+        self.assertEqual(
+            candidates("family-1", ["latte", "coffees"]), [latte.pk, coffee.pk]
+        )
+        self.assertEqual(
+            candidates("family-1", ["latte", "coffees"], limit=1), [latte.pk]
+        )
+        self.assertEqual(candidates("family-1", ["parking"]), [])
+        self.assertEqual(candidates("family-1", []), [])
+
+    def test_index_follows_the_transactions(self):
+        transaction = save_transaction(description="coffee")
+        transaction.description = "parking"
+        transaction.save()
+        candidates = DescriptionNgram.objects.candidate_ids
+        self.assertEqual(candidates("family-1", ["coffee"]), [])
+        self.assertEqual(candidates("family-1", ["parking"]), [transaction.pk])
+        transaction.delete()
+        self.assertFalse(DescriptionNgram.objects.exists())
+
+    def test_rebuild_description_index(self):
+        coffee = save_transaction(description="coffee")
+        other = save_transaction(familyId="family-2", description="coffee")
+        DescriptionNgram.objects.all().delete()
+        out = StringIO()
+        call_command(
+            "rebuild_description_index", family=["family-1"], batch_size=1, stdout=out
+        )
+        self.assertIn("Indexed the descriptions of 1 transactions", out.getvalue())
+        self.assertEqual(
+            DescriptionNgram.objects.candidate_ids("family-1", ["coffee"]), [coffee.pk]
+        )
+        self.assertEqual(
+            DescriptionNgram.objects.candidate_ids("family-2", ["coffee"]), []
+        )
+
+        call_command("rebuild_description_index", stdout=out)
+        self.assertEqual(
+            DescriptionNgram.objects.candidate_ids("family-2", ["coffee"]), [other.pk]
+        )
+
+
+class ResolveSearchDatesTests(SimpleTestCase):
+    today = datetime(2026, 10, 17)
+
+    def resolve(self, search):
+        return GeminiService.resolve_search_dates(
+            None, {"search": search, "updates": {}}, self.today
+        )["search"]
+
+    def test_relative_days(self):
+        self.assertEqual(
+            self.resolve({"day": "<yesterday's day>"}),
+            {"year": 2026, "month": 10, "day": 16},
+        )
+        self.assertEqual(
+            self.resolve({"day": "<today-7>", "amount": 5}),
+            {"year": 2026, "month": 10, "day": 10, "amount": 5},
+        )
+
+    def test_missing_date_parts_are_dropped(self):
+        self.assertEqual(
+            self.resolve({"year": "<year>", "month": "", "day": None, "amount": 5}),
+            {"amount": 5},
+        )
+        self.assertEqual(self.resolve({"month": 9}), {"month": 9})
+
+
+class AnalyticsDigestTests(TestCase):
+    def setUp(self):
+        save_transaction(type="income", category="salary", amount=3000, day=1)
+        save_transaction(description="Starbucks coffee", amount=5, day=2)
+        save_transaction(category="shopping", description="shoes", amount=80, day=4)
+        save_transaction(
+            category="transport", description="uber", amount=20, month=9, day=20
+        )
+
+    def digest(self, question, token_budget=1500):
+        return AnalyticsEngine(token_budget=token_budget).build_digest(
+            "family-1", question, today=TODAY
+        )
+
+    def test_sections(self):
+        digest = self.digest("how much did I spend on coffee this month?")
+        self.assertIn("2026 so far: income 3000.00, expense 105.00", digest)
+        self.assertIn("10-2026: 3000.00, 85.00", digest)
+        self.assertIn("09-2026: 0.00, 20.00", digest)
+        self.assertIn("starbucks coffee: 5.00 in 1 transactions", digest)
+
+    def test_expense_and_income_categories_are_separate(self):
+        lines = self.digest("how am I doing").splitlines()
+        expense = lines.index(
+            "Category expense totals (this month, last 12 months, all time):"
+        )
+        income = lines.index(
+            "Category income totals (this month, last 12 months, all time):"
+        )
+        self.assertIn("salary: 3000.00, 3000.00, 3000.00", lines[income + 1 :])
+        self.assertNotIn("salary: 3000.00, 3000.00, 3000.00", lines[expense:income])
+        self.assertIn("shopping: 80.00, 80.00, 80.00", lines[expense:income])
+
+    def test_relevant_rows_come_first(self):
+        rows = self.digest("what did I spend on uber").split("Relevant transactions")[1]
+        self.assertIn("uber", rows.splitlines()[1])
+
+    def test_budget(self):
+        for day in range(1, 29):
+            save_transaction(description=f"groceries run number {day}", day=day)
+        for budget in (60, 120, 400):
+            with self.subTest(budget=budget):
+                digest = self.digest("how much on groceries", token_budget=budget)
+                self.assertLessEqual(len(digest), budget * CHARS_PER_TOKEN)
+        # A small budget keeps the totals and drops the rows
+        digest = self.digest("how much on groceries", token_budget=60)
+        self.assertIn("All-time totals", digest)
+        self.assertNotIn("Relevant transactions", digest)
+
+    def test_question_ranges(self):
+        engine = AnalyticsEngine()
+        self.assertEqual(
+            engine._question_ranges("in december", ["in", "december"], TODAY),
+            [(date(2025, 12, 1), date(2026, 1, 1))],
+        )
+        self.assertEqual(
+            engine._question_ranges("last 2 weeks", ["last", "2", "weeks"], TODAY),
+            [(date(2026, 10, 4), date(2026, 10, 18))],
+        )
+
+
+class MultipleTransactionsTests(TestCase):
+    def setUp(self):
+        self.user = User(name="Sam", number="+15550100000")
+        self.user.save()
+
+    def item(self, **fields):
+        values = dict(
+            type="expense",
+            category="dining",
+            amount=5,
+            day=3,
+            month=10,
+            year=2026,
+            description="coffee",
+        )
+        values.update(fields)
+        return values
+
+    def monthly(self, family_id, month=10):
+        data = TransactionSummary.objects.get(familyId=family_id).data
+        if not isinstance(data, YearlySummary):
+            data = YearlySummary.from_dict(data)
+        return data.get_monthly_summary(2026, month)
+
+    def test_create_transactions(self):
+        from copilot.views import create_transactions
+
+        items = [
+            self.item(),
+            self.item(amount=7.5, description="bagel"),
+            self.item(type="income", category="salary", amount=100, month=9),
+        ]
+        reply = create_transactions(
+            make_message("receipt"), {"transactions": items}, user=self.user
+        )
+        self.assertTrue(reply.startswith("Added 3 transactions:"))
+        self.assertEqual(Transaction.objects.count(), 3)
+        self.assertEqual(self.monthly(self.user.familyId).expense, 12.5)
+        self.assertEqual(self.monthly(self.user.familyId, month=9).income, 100)
+        # Indexed for the fuzzy description search
+        self.assertEqual(
+            len(
+                Transaction.objects.description_matches(
+                    self.user.familyId, {"description": "bagel"}
+                )
+            ),
+            1,
+        )
+
+    def test_extracts_when_no_details_are_given(self):
+        from copilot import views
+
+        gemini_service = mock.Mock()
+        gemini_service.extract_multiple_transactions.return_value = [self.item()]
+        with mock.patch.object(
+            views, "get_gemini_service", return_value=gemini_service
+        ):
+            reply = views.create_transactions(make_message("receipt"), user=self.user)
+        self.assertTrue(reply.startswith("Added 1 transactions:"))
+
+    def test_invalid_type_inserts_nothing(self):
+        from copilot.views import create_transactions
+
+        items = [self.item(), self.item(type="transfer")]
+        with self.assertLogs("copilot.views", "INFO"):
+            reply = create_transactions(
+                make_message("receipt"), {"transactions": items}, user=self.user
+            )
+        self.assertIn("income or an expense", reply)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_bulk_deltas_per_family(self):
+        Transaction.objects.bulk_create_with_summaries(
+            [
+                Transaction(
+                    familyId=family_id, userId="user-1", **self.item(amount=amount)
+                )
+                for family_id, amount in (
+                    ("family-1", 3),
+                    ("family-2", 4),
+                    ("family-1", 5),
+                )
+            ]
+        )
+        self.assertEqual(self.monthly("family-1").expense, 8)
+        self.assertEqual(self.monthly("family-2").expense, 4)
+        self.assertEqual(self.monthly("family-1").categories["dining"]["expense"], 8)
+
+
+class ChatContextTests(TestCase):
+    def setUp(self):
+        from copilot.services.chat_context import ChatContextBuilder
+
+        self.summarizer = mock.Mock(return_value="They talked about coffee.")
+        self.builder = ChatContextBuilder(
+            max_turns=2, token_budget=50, summarizer=self.summarizer
+        )
+        self.builder.cache.clear()
+
+    def record(self, count, start=0):
+        self.builder.record_turns(
+            "user-1", [("user", f"message {i}", "") for i in range(start, count)]
+        )
+
+    def test_short_history_is_not_summarized(self):
+        self.record(3)
+        self.summarizer.assert_not_called()
+        context = self.builder.render("user-1")
+        self.assertTrue(context.startswith("Summary of the earlier conversation:"))
+        self.assertIn("user: message 0", context)
+        self.assertTrue(context.endswith("user: message 1\nuser: message 2"))
+
+    def test_compacts_past_the_window(self):
+        self.record(8)
+        self.summarizer.assert_called_once()
+        summary, lines, max_chars = self.summarizer.call_args.args
+        self.assertEqual(summary, "")
+        self.assertEqual(lines, [f"user: message {i}" for i in range(6)])
+        self.assertEqual(max_chars, self.builder.summary_chars)
+
+        state = self.builder.get_summary("user-1")
+        self.assertEqual(state["summary"], "They talked about coffee.")
+        context = self.builder.render("user-1")
+        self.assertIn("They talked about coffee.", context)
+        self.assertNotIn("message 5", context)
+        self.assertTrue(context.endswith("user: message 6\nuser: message 7"))
+        self.assertLessEqual(len(context), 50 * CHARS_PER_TOKEN)
+
+    def test_compaction_resumes_from_the_cursor(self):
+        self.record(8)
+        self.record(14, start=8)
+        self.assertEqual(self.summarizer.call_count, 2)
+        summary, lines, _ = self.summarizer.call_args.args
+        self.assertEqual(summary, "They talked about coffee.")
+        self.assertEqual(lines, [f"user: message {i}" for i in range(6, 12)])
+
+    def test_skips_while_another_worker_holds_the_lock(self):
+        self.builder.cache.add(self.builder.key("user-1", "lock"), True)
+        self.record(8)
+        self.summarizer.assert_not_called()
+        self.assertEqual(self.builder.get_summary("user-1")["through"], None)
+        # The pending turns still make it into the rendered summary
+        self.assertIn("message 5", self.builder.render("user-1"))
+
+        self.builder.cache.delete(self.builder.key("user-1", "lock"))
+        self.builder.compact("user-1")
+        self.summarizer.assert_called_once()
+
+    def test_keeps_recent_lines_when_summarizing_fails(self):
+        self.summarizer.side_effect = RuntimeError("unavailable")
+        with self.assertLogs("copilot.services.chat_context", "WARNING"):
+            self.record(8)
+        summary = self.builder.get_summary("user-1")["summary"]
+        self.assertLessEqual(len(summary), self.builder.summary_chars)
+        self.assertTrue(summary.endswith("user: message 5"))
+        self.assertNotIn("message 0", summary)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(
+            sender_rate=1,
+            sender_burst=2,
+            global_rate=10,
+            global_burst=3,
+            alias="default",
+        )
+        self.limiter.cache.clear()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=4)
+        wait, state = bucket.take(None, now=100)
+        self.assertEqual((wait, state), (0, (3, 100)))
+        wait, state = bucket.take((0.5, 100), now=100)
+        self.assertEqual(wait, 0.25)
+        # Refills at `rate`, never past the capacity
+        self.assertEqual(bucket.take((0.5, 100), now=100.25)[0], 0)
+        self.assertEqual(bucket.take((0, 100), now=200, tokens=4)[1], (0, 200))
+        self.assertEqual(bucket.take((0, 100), now=200, tokens=5)[0], 0.5)
+        self.assertEqual(bucket.refill_seconds, 3)
+
+    def test_sender_burst(self):
+        with mock.patch("time.time", return_value=1000):
+            self.assertEqual(self.limiter.acquire("+1"), 0)
+            self.assertEqual(self.limiter.acquire("+1"), 0)
+            self.assertEqual(self.limiter.acquire("+1"), 1)
+            # Other senders have buckets of their own
+            self.assertEqual(self.limiter.acquire("+2"), 0)
+        with mock.patch("time.time", return_value=1001):
+            self.assertEqual(self.limiter.acquire("+1"), 0)
+
+    def test_global_limit_keeps_sender_tokens(self):
+        with mock.patch("time.time", return_value=1000):
+            for sender in ("+1", "+2", "+3"):
+                self.assertEqual(self.limiter.acquire(sender), 0)
+            self.assertAlmostEqual(self.limiter.acquire("+4"), 0.1)
+        with mock.patch("time.time", return_value=1000.2):
+            # +4 was not charged for the refused message, its burst is intact
+            self.assertEqual(self.limiter.acquire("+4"), 0)
+            self.assertEqual(self.limiter.acquire("+4"), 0)
+
+    def test_busy_bucket(self):
+        self.limiter.lock_wait = 0.01
+        self.limiter.cache.add(self.limiter.key("sender:+1") + ":lock", True)
+        self.assertEqual(self.limiter.acquire("+1"), 0.01)
+        self.assertEqual(self.limiter.acquire("+2"), 0)
+
+
+@override_settings(COPILOT_DEBOUNCE_WINDOW=0.75, COPILOT_DEBOUNCE_MAX_WINDOW=5)
+class DebounceTests(TestCase):
+    def enqueue(self, body, message_sid, sender="+15550100000"):
+        from copilot.views import enqueue_message
+
+        return enqueue_message(make_message(body, message_sid, sender))
+
+    def test_burst_is_coalesced(self):
+        first = self.enqueue("coffee", "SM1")
+        with self.assertLogs("copilot.views", "INFO"):
+            self.assertEqual(self.enqueue("5 dollars", "SM2"), first)
+        self.enqueue("hello", "SM3", sender="+15550100001")
+
+        self.assertEqual(MessageJob.objects.count(), 2)
+        job = MessageJob.objects.get(message_sid="SM1")
+        message = TwilioMessage.from_dict(job.payload)
+        self.assertEqual(message.body, "coffee\n5 dollars")
+        self.assertEqual(message.merged_sids, ["SM2"])
+        # The window restarts with each message
+        self.assertGreater(job.available_at, first.available_at)
+
+    def test_max_window(self):
+        first = self.enqueue("coffee", "SM1")
+        created_at = timezone.now() - timedelta(seconds=4.9)
+        MessageJob.objects.filter(pk=first.pk).update(created_at=created_at)
+        with self.assertLogs("copilot.views", "INFO"):
+            self.enqueue("5 dollars", "SM2")
+        job = MessageJob.objects.get(pk=first.pk)
+        self.assertEqual(job.available_at, created_at + timedelta(seconds=5))
+
+    def test_claimed_job_is_not_merged_into(self):
+        first = self.enqueue("coffee", "SM1")
+
+        def claim(other):
+            # A worker claims the job between the lookup and the update
+            MessageJob.objects.filter(pk=first.pk).update(
+                status=MessageJob.STATUS_RUNNING, attempts=1
+            )
+
+        with mock.patch.object(TwilioMessage, "merge", side_effect=claim):
+            second = self.enqueue("5 dollars", "SM2")
+        self.assertNotEqual(second.pk, first.pk)
+        self.assertEqual(TwilioMessage.from_dict(second.payload).body, "5 dollars")
+        self.assertEqual(
+            TwilioMessage.from_dict(MessageJob.objects.get(pk=first.pk).payload).body,
+            "coffee",
+        )
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            CallPolicy(breaker_min_calls=4, breaker_cooldown=0.02)
+        )
+
+    def open(self):
+        for ok in (True, False, True):
+            self.breaker.record(ok)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        with self.assertLogs("copilot.services.call_policy", "WARNING"):
+            self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_opens_at_the_error_rate(self):
+        self.open()
+        self.assertFalse(self.breaker.allow())
+        self.assertGreater(self.breaker.retry_after(), 0)
+
+    def test_successful_probe_closes(self):
+        self.open()
+        time.sleep(0.02)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # One probe per cooldown
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+        # The failures before the probe are forgotten
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens(self):
+        self.open()
+        time.sleep(0.02)
+        self.assertTrue(self.breaker.allow())
+        with self.assertLogs("copilot.services.call_policy", "WARNING"):
+            self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_backoff_is_capped(self):
+        policy = CallPolicy(backoff=0.5, backoff_max=3)
+        with mock.patch("random.uniform", side_effect=lambda low, high: high):
+            delays = [policy.backoff_delay(attempt) for attempt in range(4)]
+        self.assertEqual(delays, [0.5, 1, 2, 3])
+
+
+@override_settings(
+    COPILOT_GEMINI_CALL_POLICIES={
+        "default": {"timeout": 1, "retries": 2, "backoff": 0},
+        "answer_analytical_query": {"breaker_min_calls": 2, "breaker_threshold": 1},
+    }
+)
+class ResilientCallerTests(SimpleTestCase):
+    def setUp(self):
+        self.caller = ResilientCaller()
+
+    def flaky(self, *outcomes):
+        """API call raising or returning each of `outcomes` in turn"""
+        outcomes = iter(outcomes)
+
+        def fn():
+            outcome = next(outcomes)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return mock.Mock(side_effect=fn)
+
+    def test_retries_retryable_errors(self):
+        fn = self.flaky(ConnectionError(), ConnectionError(), "ok")
+        with self.assertLogs("copilot.services.call_policy", "INFO"):
+            self.assertEqual(self.caller.call("identify_intent", fn), "ok")
+        stats = self.caller.stats()["identify_intent"]
+        self.assertEqual((stats["retries"], stats["calls"]), (2, 1))
+
+    def test_other_errors_are_raised_right_away(self):
+        fn = self.flaky(ValueError("bad request"), "ok")
+        with self.assertRaises(ValueError):
+            self.caller.call("identify_intent", fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_open_circuit_short_circuits(self):
+        fn = self.flaky(*[ConnectionError()] * 3)
+        with self.assertLogs("copilot.services.call_policy", "INFO"):
+            with self.assertRaises(ConnectionError):
+                self.caller.call("answer_analytical_query", fn)
+        # The breaker opened on the second failure, no third attempt
+        self.assertEqual(fn.call_count, 2)
+        with self.assertRaises(CircuitOpen):
+            self.caller.call("answer_analytical_query", fn)
+        self.assertEqual(fn.call_count, 2)
+        stats = self.caller.stats()["answer_analytical_query"]
+        self.assertEqual((stats["short_circuited"], stats["circuit"]), (1, "open"))
+
+    @override_settings(
+        COPILOT_GEMINI_CALL_POLICIES={
+            "default": {"timeout": 1, "retries": 0, "hedge_after": 0.02}
+        }
+    )
+    def test_slow_request_is_hedged(self):
+        slow = threading.Event()
+        self.addCleanup(slow.set)
+        requests = iter([lambda: slow.wait() and "slow", lambda: "hedged"])
+        self.assertEqual(
+            self.caller.call("identify_intent", lambda: next(requests)()), "hedged"
+        )
+        self.assertEqual(self.caller.stats()["identify_intent"]["hedges"], 1)
+
+
+class DateRangesTests(SimpleTestCase):
+    def test_transaction_date(self):
+        self.assertEqual(date_ranges.transaction_date(2026, 4, 31), date(2026, 4, 30))
+        self.assertEqual(
+            date_ranges.transaction_date("2024", "2", None), date(2024, 2, 1)
+        )
+        self.assertEqual(date_ranges.transaction_date(2024, 2, 0), date(2024, 2, 1))
+        self.assertIsNone(date_ranges.transaction_date(2026, 13, 1))
+        self.assertIsNone(date_ranges.transaction_date(None, 10, 1))
+
+    def test_shift_month(self):
+        self.assertEqual(date_ranges.shift_month(2026, 12, 1), (2027, 1))
+        self.assertEqual(date_ranges.shift_month(2026, 1, -1), (2025, 12))
+        self.assertEqual(date_ranges.shift_month(2026, 10, -22), (2024, 12))
+
+    def test_ranges_are_half_open(self):
+        self.assertEqual(
+            date_ranges.month_range(2026, 12), (date(2026, 12, 1), date(2027, 1, 1))
+        )
+        self.assertEqual(
+            date_ranges.quarter_range(2026, 4), (date(2026, 10, 1), date(2027, 1, 1))
+        )
+        self.assertEqual(
+            date_ranges.year_range(2026), (date(2026, 1, 1), date(2027, 1, 1))
+        )
+        # TODAY is a Saturday
+        self.assertEqual(
+            date_ranges.week_range(TODAY, weeks=2),
+            (date(2026, 10, 12), date(2026, 10, 26)),
+        )
+        self.assertEqual(
+            date_ranges.last_days(7, TODAY), (date(2026, 10, 11), date(2026, 10, 18))
+        )
+
+    def test_search_range(self):
+        self.assertEqual(
+            date_ranges.search_range(2026, 10, 17),
+            (date(2026, 10, 17), date(2026, 10, 18)),
+        )
+        self.assertEqual(
+            date_ranges.search_range(2026, 2), (date(2026, 2, 1), date(2026, 3, 1))
+        )
+        self.assertEqual(
+            date_ranges.search_range(2026), (date(2026, 1, 1), date(2027, 1, 1))
+        )
+        # Criteria that don't pin down a range
+        self.assertIsNone(date_ranges.search_range(month=10))
+        self.assertIsNone(date_ranges.search_range(2026, day=3))
+        self.assertIsNone(date_ranges.search_range(2026, 2, 30))
+
+
+class BackfillTransactionDatesTests(TestCase):
+    def setUp(self):
+        self.dated = [save_transaction(day=day) for day in (1, 2, 3)] + [
+            save_transaction(familyId="family-2", month=4, day=31)
+        ]
+        self.invalid = save_transaction()
+        Transaction.objects.update(date=None)
+        Transaction.objects.filter(pk=self.invalid.pk).update(month=13)
+
+    def backfill(self, **options):
+        out = StringIO()
+        call_command("backfill_transaction_dates", stdout=out, **options)
+        return out.getvalue()
+
+    def dates(self):
+        return dict(Transaction.objects.values_list("pk", "date"))
+
+    def test_backfill(self):
+        versions = dict(TransactionSummary.objects.values_list("familyId", "version"))
+        out = self.backfill(batch_size=2)
+        self.assertIn("Filled the date of 4 transactions, 1 have an invalid", out)
+        dates = self.dates()
+        self.assertEqual(
+            [dates[transaction.pk] for transaction in self.dated],
+            [
+                date(2026, 10, 1),
+                date(2026, 10, 2),
+                date(2026, 10, 3),
+                date(2026, 4, 30),
+            ],
+        )
+        self.assertIsNone(dates[self.invalid.pk])
+        # The rollups are left alone
+        self.assertEqual(
+            dict(TransactionSummary.objects.values_list("familyId", "version")),
+            versions,
+        )
+        # Nothing left to fill
+        self.assertIn("Filled the date of 0 transactions", self.backfill())
+
+    def test_dry_run_and_family(self):
+        out = self.backfill(dry_run=True)
+        self.assertIn("Would fill the date of 4 transactions", out)
+        self.assertEqual(set(self.dates().values()), {None})
+
+        self.backfill(family=["family-2"])
+        self.assertEqual(
+            Transaction.objects.exclude(date=None).get().pk, self.dated[-1].pk
+        )
@@ -8,6 +8,13 @@ urlpatterns = [
     path(
         "whatsapp", views.whatsapp_webhook, name="whatsapp_webhook"
     ),  # Ensure trailing slash
+    path(
+        "whatsapp/status",
+        views.twilio_status_callback,
+        name="twilio_status_callback",
+    ),
     path("hello/", views.hello_world, name="hello_world"),
     path("gemini/test", views.test_gemini, name="test_gemini"),
+    path("gemini/stats", views.gemini_stats, name="gemini_stats"),
+    path("metrics", views.metrics, name="metrics"),
 ]
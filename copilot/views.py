@@ -1,25 +1,85 @@
-import io
 import json
-from difflib import SequenceMatcher
+import logging
+import time
+from datetime import timedelta
 
-from django.core.files.storage import default_storage
+from django.conf import settings
 from django.http import HttpResponse, JsonResponse
-from django.shortcuts import render
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
-from PIL import Image
 
-from copilot.constants import INTENTS, PROMPT_CLASSIFY_MESSAGE
+from copilot.constants import (
+    INTENTS,
+    PROMPT_CLASSIFY_MESSAGE,
+    REPLY_ASK_NAME,
+    REPLY_BUSY,
+    REPLY_NOT_PROCESSED,
+    REPLY_WELCOME,
+)
+from copilot.datamodels.intent_result import IntentResult
 from copilot.datamodels.twilio_message import TwilioMessage
-from copilot.models import Transaction, User
+from copilot.models import (
+    InvalidTransaction,
+    MessageJob,
+    OutboundMessage,
+    Transaction,
+    User,
+)
+
+from .services.analytics import AnalyticsEngine
+from .services.chat_context import chat_context
+from .services.gemini_api import GeminiService, get_gemini_service
+from .services.idempotency import IdempotencyStore
+from .services.job_queue import Deferred, JobQueue
+from .services.call_policy import CircuitOpen
+from .services.llm_scheduler import LLMUnavailable, SchedulerSaturated
+from .services.local_parser import LocalParser
+from .services.metrics import (
+    CONTENT_TYPE,
+    OUTCOME_DEFERRED,
+    OUTCOME_DUPLICATE,
+    OUTCOME_SHED,
+    STAGE_INTENT,
+    STAGE_MEDIA,
+    STAGE_PARSE,
+    STAGE_REPLY_WAIT,
+    STAGE_SEND,
+    annotate,
+    registry,
+    span,
+    trace_message,
+)
+from .services.inline_reply import InlineReplyBroker
+from .services.outbound import enqueue_reply, split_message
+from .services.rate_limit import RateLimiter
+from .services.twilio_api import get_twilio_service
+from .services.user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+
+class MessageQueue(JobQueue):
+    """
+    JobQueue of MessageJob rows that answers the sender when their message
+    failed for good, so nobody is left without a reply
+    """
+
+    def __init__(self):
+        super().__init__(MessageJob)
 
-from .services.gemini_api import GeminiService
-from .services.twilio_api import TwilioService
+    def on_failed(self, job: MessageJob):
+        logger.warning("Failed %s, telling %s", job, job.sender)
+        send_reply(TwilioMessage.from_dict(job.payload), REPLY_NOT_PROCESSED)
 
-SAMPLE_IMAGE_URL = "https://picsum.photos/200/300"
 
-twilio_service = TwilioService()
-gemini_service = GeminiService()
+# Services are built on first use (get_gemini_service, get_twilio_service)
+message_queue = MessageQueue()
+local_parser = LocalParser()
+analytics_engine = AnalyticsEngine()
+idempotency_store = IdempotencyStore()
+rate_limiter = RateLimiter()
+inline_replies = InlineReplyBroker()
 
 
 @csrf_exempt
@@ -28,47 +88,363 @@ def whatsapp_webhook(request):
     """
     Handle incoming WhatsApp messages using TwilioService
     Endpoint: /whatsapp/
+    The message is persisted as a MessageJob for the background workers
+    (manage.py run_workers). If they answer within
+    COPILOT_INLINE_REPLY_DEADLINE seconds of the request, the answer is
+    returned inline as TwiML; otherwise the request is acknowledged with an
+    empty response and the answer is sent over the REST API later.
     """
 
-    # Parse incoming message
-    twilio_message = twilio_service.parse_incoming_message(request.POST)
-    print(f"Received message from {twilio_message.sender}: {twilio_message.body}")
-
-    # Identify intent of the message
-    intent = identify_intent(twilio_message, gemini_service)
-    print("Identified intent:", intent)
-
-    # print(
-    #     "speech-to-text:",
-    #     gemini_service.convert_speech_to_text(
-    #         default_storage.path(twilio_message.media[0].local_path)
-    #     ),
-    # )
-    answer = None
-    if intent == "INPUT_NAME" and not check_user_exists(twilio_message.sender):
-        answer = create_user(twilio_message)
-    elif intent == "CREATE_TRANSACTION":
-        answer = create_transaction(twilio_message)
-    elif intent == "UPDATE_TRANSACTION":
-        answer = update_transaction(twilio_message)
-    elif intent == "DELETE_TRANSACTION":
-        answer = delete_transaction(twilio_message)
-    elif intent == "ANALYTICS_REQUEST":
-        answer = answer_analytical_query(twilio_message)
-    elif intent == "MULTIPLE_TRANSACTIONS":
-        pass
-    else:
-        answer = answer_miscellaneous_query(twilio_message)
-
-    print(f"Answer: {answer}")
-
-    twilio_service.send_message(twilio_message.sender, answer)
+    started = time.monotonic()
+    reply = None
+    with trace_message("webhook") as message_trace:
+        # Parse incoming message, media is downloaded later by the worker
+        with span(STAGE_PARSE):
+            twilio_message = get_twilio_service().parse_incoming_message(
+                request.POST, download_media=False
+            )
+        message_trace.message_sid = twilio_message.message_sid
+        logger.info(
+            "Received message %s from %s",
+            twilio_message.message_sid,
+            twilio_message.sender,
+        )
+
+        # Twilio retries slow deliveries, queue each MessageSid once
+        if idempotency_store.mark_received(twilio_message.message_sid):
+            # Registered before the job exists, so no answer can come first
+            waiting = inline_replies.register(twilio_message.message_sid)
+            job = enqueue_message(twilio_message)
+            if waiting:
+                remaining = inline_replies.deadline - (time.monotonic() - started)
+                # Debounced jobs start too late, and a message coalesced into
+                # another one's job is answered to that one's request
+                if job.message_sid != twilio_message.message_sid or (
+                    job.available_at > timezone.now() + timedelta(seconds=remaining)
+                ):
+                    remaining = 0
+                with span(STAGE_REPLY_WAIT):
+                    reply = inline_replies.wait(twilio_message.message_sid, remaining)
+        else:
+            logger.info("Ignoring duplicate delivery of %s", twilio_message.message_sid)
+            annotate(outcome=OUTCOME_DUPLICATE)
+
+    twilio_service = get_twilio_service()
     return HttpResponse(
-        content=twilio_service.create_response(intent, media_urls=[SAMPLE_IMAGE_URL]),
+        content=(
+            twilio_service.create_response(reply)
+            if reply
+            else twilio_service.create_empty_response()
+        ),
         content_type="text/xml",
     )
 
 
+def enqueue_message(twilio_message: TwilioMessage) -> MessageJob:
+    """
+    Persist an incoming message for the background workers. Messages of a
+    sender arriving within COPILOT_DEBOUNCE_WINDOW seconds are coalesced
+    into one job, processed once the sender pauses (at most
+    COPILOT_DEBOUNCE_MAX_WINDOW seconds after the first message)
+    Args:
+        twilio_message: Parsed TwilioMessage
+    Returns:
+        Created or merged-into MessageJob object
+    """
+    window = getattr(settings, "COPILOT_DEBOUNCE_WINDOW", 0.75)
+    if window > 0:
+        job = merge_into_pending_job(twilio_message, window)
+        if job is not None:
+            logger.info("Coalesced %s into %s", twilio_message.message_sid, job)
+            return job
+    return message_queue.enqueue(
+        delay=window,
+        message_sid=twilio_message.message_sid,
+        sender=twilio_message.sender,
+        payload=twilio_message.to_dict(),
+    )
+
+
+def merge_into_pending_job(twilio_message: TwilioMessage, window: float):
+    """
+    Append a message to its sender's job that is still waiting out the
+    debounce window. The update is conditional on the job being unchanged
+    and unclaimed, so a worker claiming it concurrently wins and the message
+    gets a job of its own
+    Returns:
+        Merged-into MessageJob object or None
+    """
+    max_window = getattr(settings, "COPILOT_DEBOUNCE_MAX_WINDOW", 5)
+    for _ in range(3):
+        now = timezone.now()
+        job = (
+            MessageJob.objects.filter(
+                sender=twilio_message.sender,
+                status=MessageJob.STATUS_PENDING,
+                attempts=0,
+                available_at__gt=now,
+            )
+            .order_by("-created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        pending = TwilioMessage.from_dict(job.payload)
+        pending.merge(twilio_message)
+        available_at = min(
+            now + timedelta(seconds=window),
+            job.created_at + timedelta(seconds=max_window),
+        )
+        merged = MessageJob.objects.filter(
+            pk=job.pk,
+            status=MessageJob.STATUS_PENDING,
+            attempts=0,
+            updated_at=job.updated_at,
+        ).update(payload=pending.to_dict(), available_at=available_at, updated_at=now)
+        if merged:
+            return job
+    return None
+
+
+def process_message_job(job: MessageJob):
+    """
+    Worker entry point: process a queued message
+    Args:
+        job: Claimed MessageJob
+    Raises:
+        Deferred when the sender or the worker is over its rate limit
+    """
+    with trace_message("worker", job.message_sid):
+        wait = rate_limiter.acquire(job.sender)
+        if wait:
+            logger.info(
+                "Rate limited %s, deferring %s for %.1fs", job.sender, job, wait
+            )
+            annotate(outcome=OUTCOME_DEFERRED)
+            raise Deferred(wait)
+        process_message(TwilioMessage.from_dict(job.payload))
+
+
+def process_message(twilio_message: TwilioMessage):
+    """
+    Run the full pipeline for a message and send the reply. A MessageSid is
+    handled once (see IdempotencyStore): duplicates reuse the first reply,
+    waiting for it while the first execution is still running, and only
+    send it if the first execution could not
+    Args:
+        twilio_message: TwilioMessage to process
+    Returns:
+        Answer sent to the user
+    """
+    message_sid = twilio_message.message_sid
+    previous = idempotency_store.acquire(message_sid)
+    if previous is not None:
+        logger.info("Message %s already processed, reusing its reply", message_sid)
+        annotate(outcome=OUTCOME_DUPLICATE)
+        if not previous["sent"]:
+            send_reply(twilio_message, previous["reply"])
+        return previous["reply"]
+
+    # Handlers may rewrite the body, keep it for the chat history
+    body = twilio_message.body
+    try:
+        answer = handle_message(twilio_message)
+    except Exception:
+        idempotency_store.release(message_sid)
+        raise
+    idempotency_store.finish(message_sid, answer)
+    send_reply(twilio_message, answer)
+    # After the reply, a conversation summary call doesn't delay it
+    record_chat_turns(twilio_message, body, answer)
+    return answer
+
+
+def send_reply(twilio_message: TwilioMessage, answer):
+    """
+    Hand the answer to the message's webhook request if it is still waiting
+    (inline TwiML reply, see InlineReplyBroker), otherwise queue it for the
+    outbound workers (see copilot.services.outbound), which send it over the
+    Twilio REST API
+    """
+    if not answer:
+        # The handler could not act on the message (e.g. nothing to update),
+        # still answer so the user and a waiting webhook aren't left hanging
+        registry.inc("copilot_replies_total", outcome="empty")
+        answer = REPLY_NOT_PROCESSED
+    answer = str(answer)
+    with span(STAGE_SEND):
+        # Replies longer than one WhatsApp message go over REST, in order
+        if len(split_message(answer)) == 1 and inline_replies.offer(
+            twilio_message.message_sid, answer
+        ):
+            outcome = "inline"
+        else:
+            enqueue_reply(
+                twilio_message.sender, answer, reply_to=twilio_message.message_sid
+            )
+            outcome = "queued"
+    registry.inc("copilot_replies_total", outcome=outcome)
+    idempotency_store.mark_sent(twilio_message.message_sid, answer)
+
+
+# Intents that need the sender's account
+USER_INTENTS = (
+    "CREATE_TRANSACTION",
+    "UPDATE_TRANSACTION",
+    "DELETE_TRANSACTION",
+    "ANALYTICS_REQUEST",
+    "MULTIPLE_TRANSACTIONS",
+)
+
+
+def handle_message(twilio_message: TwilioMessage):
+    """
+    Media download, intent identification and intent handler of a message
+    Args:
+        twilio_message: TwilioMessage to process
+    Returns:
+        Answer for the user
+    """
+    with span(STAGE_MEDIA):
+        get_twilio_service().download_message_media(twilio_message)
+    if getattr(settings, "COPILOT_EAGER_MEDIA_DECODING", True):
+        get_gemini_service().prepare_media(twilio_message)
+
+    # Resolve the sender once and hand the user to the handlers
+    user = fetchUser(twilio_message)
+    if user:
+        twilio_message.context = chat_context.render(user.userId)
+
+    try:
+        # Identify intent of the message (and its details in combined mode)
+        with span(STAGE_INTENT):
+            result = resolve_intent(twilio_message, get_gemini_service())
+        intent = result.intent
+        annotate(intent=intent)
+        logger.info("Identified intent of %s: %s", twilio_message.message_sid, intent)
+
+        answer = None
+        if intent == "INPUT_NAME" and check_user_exists(
+            twilio_message.sender, user=user
+        ):
+            answer = create_user(twilio_message, result.payload, user=user)
+        elif intent in USER_INTENTS and user is None:
+            # Nothing to record or analyze before the sender registers
+            answer = REPLY_ASK_NAME
+        elif intent == "CREATE_TRANSACTION":
+            answer = create_transaction(twilio_message, result.payload, user=user)
+        elif intent == "UPDATE_TRANSACTION":
+            answer = update_transaction(twilio_message, result.payload, user=user)
+        elif intent == "DELETE_TRANSACTION":
+            answer = delete_transaction(twilio_message, result.payload, user=user)
+        elif intent == "ANALYTICS_REQUEST":
+            answer = answer_analytical_query(twilio_message, user=user)
+        elif intent == "MULTIPLE_TRANSACTIONS":
+            answer = create_transactions(twilio_message, result.payload, user=user)
+        else:
+            answer = answer_miscellaneous_query(twilio_message)
+    except SchedulerSaturated as e:
+        # Gemini is overloaded, shed this message with a friendly reply
+        logger.warning("Shedding message %s: %s", twilio_message.message_sid, e)
+        annotate(outcome=OUTCOME_SHED)
+        answer = REPLY_BUSY
+    except CircuitOpen as e:
+        # Gemini is failing, reply once its circuit lets calls through again
+        logger.warning("Deferring message %s: %s", twilio_message.message_sid, e)
+        annotate(outcome=OUTCOME_DEFERRED)
+        raise Deferred(max(e.retry_after, 1))
+
+    logger.debug("Answer to %s: %s", twilio_message.message_sid, answer)
+    return answer
+
+
+def record_chat_turns(twilio_message: TwilioMessage, body: str, answer):
+    """
+    Store the message and its answer and update the sender's chat context
+    Args:
+        twilio_message: Handled TwilioMessage
+        body: Body of the message as received
+        answer: Answer sent to the user
+    """
+    try:
+        # Cached, and set by now if the message registered the sender
+        user = fetchUser(twilio_message)
+        if not user:
+            return
+        if isinstance(answer, Transaction):
+            answer = (
+                f"{answer.type} of {answer.amount} for {answer.category} on "
+                f"{answer.month}/{answer.day}/{answer.year}: {answer.description}"
+            )
+        attachment = ",".join(media.content_type for media in twilio_message.media)
+        chat_context.record_turns(
+            user.userId,
+            [
+                ("user", body, attachment),
+                ("copilot", str(answer) if answer is not None else "", ""),
+            ],
+        )
+    except Exception:
+        logger.exception("Error recording chat turns")
+
+
+@require_GET
+def gemini_stats(request):
+    """
+    Gemini scheduler, call policy and response cache counters of this process
+    Endpoint: /gemini/stats
+    """
+    gemini_service = get_gemini_service()
+    return JsonResponse(
+        {
+            "scheduler": gemini_service.scheduler.stats(),
+            "calls": gemini_service.caller.stats(),
+            "response_cache": gemini_service.response_cache.stats(),
+        }
+    )
+
+
+@csrf_exempt
+@require_POST
+def twilio_status_callback(request):
+    """
+    Record the delivery status Twilio posts for an outbound message
+    Endpoint: /whatsapp/status (COPILOT_TWILIO_STATUS_CALLBACK_URL)
+    """
+    status = request.POST.get("MessageStatus", "")
+    try:
+        outbound_id = int(request.GET.get("outbound", ""))
+    except ValueError:
+        outbound_id = None
+    updated = OutboundMessage.objects.record_status(
+        status,
+        outbound_id=outbound_id,
+        twilio_sid=request.POST.get("MessageSid", ""),
+        error_code=request.POST.get("ErrorCode", ""),
+    )
+    registry.inc("copilot_outbound_status_total", status=status or "unknown")
+    if status in ("failed", "undelivered"):
+        logger.warning(
+            "Message %s %s (error %s)",
+            request.POST.get("MessageSid"),
+            status,
+            request.POST.get("ErrorCode"),
+        )
+    elif not updated:
+        logger.debug("Ignored status %s of %s", status, request.POST.get("MessageSid"))
+    return HttpResponse(status=204)
+
+
+@require_GET
+def metrics(request):
+    """
+    Pipeline metrics of this process in the Prometheus text format
+    Endpoint: /metrics
+    Worker processes serve their own (manage.py run_workers --metrics-port)
+    """
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
 @csrf_exempt
 def test_gemini(request):
     """
@@ -77,7 +453,7 @@ def test_gemini(request):
     POST: /gemini/test/ - Test queries with images
     """
     try:
-        gemini_service = GeminiService()
+        gemini_service = get_gemini_service()
 
         if request.method == "GET":
             # Test simple text query
@@ -110,6 +486,47 @@ def hello_world(request):
     return HttpResponse("Hello, World!")
 
 
+def resolve_intent(
+    twilio_message: TwilioMessage, gemini_service: GeminiService
+) -> IntentResult:
+    """
+    Identify the intent of a TwilioMessage. Text-only messages are first run
+    through the local rule-based parser and only sent to Gemini when its
+    confidence is below COPILOT_LOCAL_PARSER_THRESHOLD.
+    Gemini is used according to COPILOT_INTENT_MODE:
+    "combined" classifies and extracts the intent details in one Gemini call,
+    falling back to "two_call" (identify_intent now, extraction later in the
+    intent handler) if the combined response is invalid
+    Returns an IntentResult, whose payload is None when not yet extracted
+    """
+    local_result = None
+    if not twilio_message.has_media:
+        local_result = local_parser.parse(twilio_message.body)
+        if local_result.confidence >= getattr(
+            settings, "COPILOT_LOCAL_PARSER_THRESHOLD", 0.8
+        ):
+            logger.debug("Parsed locally: %s", local_result)
+            return local_result
+
+    try:
+        if getattr(settings, "COPILOT_INTENT_MODE", "combined") == "combined":
+            try:
+                return gemini_service.classify_and_extract(twilio_message)
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                logger.warning("Invalid combined classification, falling back: %s", e)
+
+        return IntentResult(intent=identify_intent(twilio_message, gemini_service))
+    except CircuitOpen:
+        # Degraded mode: settle for a less confident local parse if it is complete
+        if local_result is not None and local_result.payload is not None:
+            if local_result.confidence >= getattr(
+                settings, "COPILOT_DEGRADED_PARSER_THRESHOLD", 0.5
+            ):
+                logger.info("Gemini unavailable, using local parse: %s", local_result)
+                return local_result
+        raise
+
+
 def identify_intent(
     twilio_message: TwilioMessage, gemini_service: GeminiService
 ) -> str:
@@ -117,118 +534,151 @@ def identify_intent(
     Identify the intent of a TwilioMessage using Gemini API
     Returns one of the predefined INTENTS
     """
-    try:
-        # Replace placeholder in prompt with actual message
-        prompt = PROMPT_CLASSIFY_MESSAGE + (
-            "Message: " + twilio_message.body if (not twilio_message.body) else ""
-        )
-        response = gemini_service.send_message(prompt, twilio_message)
+    # Replace placeholder in prompt with actual message
+    prompt = PROMPT_CLASSIFY_MESSAGE + (
+        "Message: " + twilio_message.body if (not twilio_message.body) else ""
+    )
+    # Call errors propagate (after the call policy's retries) rather than
+    # being mistaken for an OTHER intent
+    response = gemini_service.send_message(
+        prompt, twilio_message, cache_method="identify_intent"
+    )
 
-        # Clean and validate the response
-        intent = response.strip().upper()
-        if intent in INTENTS:
-            return intent.strip().upper()
+    if response is None:
+        logger.warning("Empty intent response")
+        return "OTHER"
 
-        return intent
+    # Clean and validate the response
+    intent = response.strip().upper()
+    if intent in INTENTS:
+        return intent.strip().upper()
 
-    except Exception as e:
-        print(f"Error identifying intent: {str(e)}")
-        return "OTHER"
+    return intent
 
 
 def fetchUser(twilio_message: TwilioMessage):
     """
-    Fetch user details
+    Fetch user details (cached per sender number, see UserCache)
     Args:
         twilio_message: TwilioMessage object containing user details
     Returns:
-        User object
+        User object or None
     """
-    try:
-        user = User.objects.get(number=twilio_message.sender)
-        return user
-    except User.DoesNotExist:
-        return None
+    return user_cache.get_user(twilio_message.sender)
 
 
-def create_transaction(twilio_message: TwilioMessage):
+def create_transaction(
+    twilio_message: TwilioMessage, jsonData: dict = None, user: User = None
+):
     """
     Create a new transaction record
     Args:
         twilio_message: TwilioMessage containing transaction details
+        jsonData: Already extracted transaction details, if any
+        user: Already resolved sender, if any
     Returns:
         Created transaction object
     """
     try:
-        user = fetchUser(twilio_message)
+        user = user or fetchUser(twilio_message)
         if user:
-            jsonData = gemini_service.extract_transaction_details(twilio_message)
-            if jsonData:
-                # Initialize transaction with required fields
-                transaction = Transaction(
-                    familyId=user.familyId,
-                    userId=user.userId,
-                    type=jsonData.get("type", "expense"),
-                    category=jsonData.get("category", "misc"),
-                    year=int(jsonData.get("year")),
-                    month=int(jsonData.get("month")),
-                    day=int(jsonData.get("day")),
-                    amount=float(jsonData.get("amount", 0.0)),
-                    description=jsonData.get("description", ""),
+            if jsonData is None:
+                jsonData = get_gemini_service().extract_transaction_details(
+                    twilio_message
                 )
+            if jsonData:
+                transaction = build_transaction(user, jsonData)
                 transaction.save()
                 return transaction
         return None
-    except Exception as e:
-        print(f"Error creating transaction: {str(e)}")
+    except LLMUnavailable:
+        raise
+    except InvalidTransaction as e:
+        logger.info("Invalid transaction details %s: %s", jsonData, e)
+        return str(e)
+    except Exception:
+        logger.exception("Error creating transaction")
+        return None
+
+
+def create_transactions(
+    twilio_message: TwilioMessage, details: dict = None, user: User = None
+):
+    """
+    Create all transactions of a message with one extraction call, one bulk
+    insert and one summary update
+    Args:
+        twilio_message: TwilioMessage containing the transactions
+        details: Already extracted {"transactions": [...]} payload, if any
+        user: Already resolved sender, if any
+    Returns:
+        Reply listing the created transactions
+    """
+    try:
+        user = user or fetchUser(twilio_message)
+        if not user:
+            return None
+        if details is None:
+            items = get_gemini_service().extract_multiple_transactions(twilio_message)
+        else:
+            items = details["transactions"]
+        transactions = Transaction.objects.bulk_create_with_summaries(
+            [build_transaction(user, item) for item in items]
+        )
+        return f"Added {len(transactions)} transactions:\n" + "\n".join(
+            str(transaction) for transaction in transactions
+        )
+    except LLMUnavailable:
+        raise
+    except InvalidTransaction as e:
+        logger.info("Invalid transaction details: %s", e)
+        return str(e)
+    except Exception:
+        logger.exception("Error creating transactions")
         return None
 
 
-def update_transaction(twilio_message: TwilioMessage):
+def build_transaction(user: User, jsonData: dict) -> Transaction:
+    """Unsaved Transaction of the user's family from extracted details"""
+    return Transaction(
+        familyId=user.familyId,
+        userId=user.userId,
+        type=jsonData.get("type", "expense"),
+        category=jsonData.get("category", "misc"),
+        year=int(jsonData.get("year")),
+        month=int(jsonData.get("month")),
+        day=int(jsonData.get("day")),
+        amount=float(jsonData.get("amount", 0.0)),
+        description=jsonData.get("description", ""),
+    )
+
+
+def update_transaction(
+    twilio_message: TwilioMessage, data: dict = None, user: User = None
+):
     """
-    Update the latest transaction matching amount and type for a user's family
-    using brute force search
+    Update the latest transaction matching the search criteria for a user's family
     Args:
         twilio_message: TwilioMessage containing search criteria and update details
+        data: Already extracted search criteria and update details, if any
+        user: Already resolved sender, if any
     Returns:
         Updated transaction object
     """
 
-    user = fetchUser(twilio_message)
+    user = user or fetchUser(twilio_message)
     if user:
-        data = gemini_service.extract_transaction_update_details(twilio_message)
-
-        # Get all transactions for the family
-        all_transactions = Transaction.objects.all()
-        family_transactions = all_transactions.filter(familyId=user.familyId)
-
-        print(f"Found {len(family_transactions)} transactions for family")
-        # Search criteria
-        search_type = data["search"].get("type", "expense")
-        search_amount = int(data["search"].get("amount", 0))
-
-        print(f"Searching for type: {search_type}, amount: {search_amount}")
-
-        # Filter matching transactions
-        matching_transactions = []
-        for transaction in family_transactions:
-            print(f"Checking transaction: {transaction}")
-            if search_amount == int(transaction.amount):
-                if search_type and transaction.type == search_type:
-                    matching_transactions.append(transaction)
-
-        print("Matching transactions:", matching_transactions)
-        for t in matching_transactions:
-            print(
-                f"ID: {t.id}, Type: {t.type}, Amount: {t.amount}, Date: {t.year}-{t.month}-{t.day}"
-            )
-        # Get the latest matching transaction
-        if matching_transactions:
-            latest_transaction = max(
-                matching_transactions, key=lambda x: (x.year, x.month, x.day)
+        if data is None:
+            data = get_gemini_service().extract_transaction_update_details(
+                twilio_message
             )
+        if not data or not isinstance(data.get("updates"), dict):
+            logger.info("No update details extracted: %s", data)
+            return REPLY_NOT_PROCESSED
 
-            print(f"Found transaction to update: {latest_transaction.id}")
+        latest_transaction = find_latest_transaction(user, data.get("search") or {})
+        if latest_transaction:
+            logger.debug("Found transaction to update: %s", latest_transaction.id)
             # Apply updates to the latest transaction
             for field, value in data["updates"].items():
                 if field in ["year", "month", "day"]:
@@ -236,94 +686,126 @@ def update_transaction(twilio_message: TwilioMessage):
                 elif field == "amount":
                     value = float(value)
                 setattr(latest_transaction, field, value)
-            latest_transaction.save()
+            try:
+                latest_transaction.save()
+            except InvalidTransaction as e:
+                logger.info("Invalid transaction update %s: %s", data["updates"], e)
+                return str(e)
             return latest_transaction
     return None
 
 
-def delete_transaction(twilio_message: TwilioMessage):
+def delete_transaction(
+    twilio_message: TwilioMessage, data: dict = None, user: User = None
+):
     """
-    Update the latest transaction matching amount and type for a user's family
-    using brute force search
+    Delete the latest transaction matching the search criteria for a user's family
     Args:
-        twilio_message: TwilioMessage containing search criteria and update details
+        twilio_message: TwilioMessage containing search criteria
+        data: Already extracted search criteria and update details, if any
+        user: Already resolved sender, if any
     Returns:
-        Updated transaction object
+        Deleted transaction object
     """
 
-    user = fetchUser(twilio_message)
+    user = user or fetchUser(twilio_message)
     if user:
-        data = gemini_service.extract_transaction_update_details(twilio_message)
-
-        # Get all transactions for the family
-        all_transactions = Transaction.objects.all()
-        family_transactions = all_transactions.filter(familyId=user.familyId)
-
-        print(f"Found {len(family_transactions)} transactions for family")
-        # Search criteria
-        search_type = data["search"].get("type", "expense")
-        search_amount = int(data["search"].get("amount", 0))
-
-        print(f"Searching for type: {search_type}, amount: {search_amount}")
-
-        # Filter matching transactions
-        matching_transactions = []
-        for transaction in family_transactions:
-            print(f"Checking transaction: {transaction}")
-            if search_amount == int(transaction.amount):
-                if search_type and transaction.type == search_type:
-                    matching_transactions.append(transaction)
-
-        print("Matching transactions:", matching_transactions)
-        for t in matching_transactions:
-            print(
-                f"ID: {t.id}, Type: {t.type}, Amount: {t.amount}, Date: {t.year}-{t.month}-{t.day}"
-            )
-        # Get the latest matching transaction
-        if matching_transactions:
-            latest_transaction = max(
-                matching_transactions, key=lambda x: (x.year, x.month, x.day)
+        if data is None:
+            data = get_gemini_service().extract_transaction_update_details(
+                twilio_message
             )
+        if not data:
+            logger.info("No search criteria extracted")
+            return REPLY_NOT_PROCESSED
 
+        latest_transaction = find_latest_transaction(user, data.get("search") or {})
+        if latest_transaction:
+            logger.debug("Found transaction to delete: %s", latest_transaction.id)
             latest_transaction.delete()
             return latest_transaction
     return None
 
 
-def check_user_exists(phone_number: str) -> bool:
+# Search criteria that single out a transaction (an explicit date counts)
+SEARCH_CRITERIA = ("amount", "description", "year", "month", "day")
+
+
+def find_latest_transaction(user: User, search: dict):
+    """
+    Find the family transaction the search criteria refer to: the best fuzzy
+    description match if a description is given (see
+    TransactionQuerySet.description_matches), otherwise (or if nothing is
+    similar enough) the latest exact match of a single indexed query.
+    Nothing is found without an amount, description or date to search by
+    Args:
+        user: User whose family transactions are searched
+        search: Search criteria extracted by Gemini
+    Returns:
+        Transaction object or None
+    """
+    logger.debug("Searching for: %s", search)
+    # Type and category alone would pick an arbitrary recent transaction
+    if not any(search.get(field) for field in SEARCH_CRITERIA):
+        logger.info("No search criteria to find a transaction by: %s", search)
+        return None
+    if search.get("description"):
+        matches = Transaction.objects.description_matches(
+            user.familyId, search, limit=1
+        )
+        if matches:
+            return matches[0]
+    return (
+        Transaction.objects.for_family(user.familyId)
+        .matching(search)
+        .latest_first()
+        .first()
+    )
+
+
+def check_user_exists(phone_number: str, user: User = None) -> bool:
     """
     Check if user needs to provide name (True if user doesn't exist or has no name)
     Args:
         phone_number: Phone number to check
+        user: Already resolved user of that number, if any
     Returns:
         True if user registration is needed, False if user exists with name
     """
-    try:
-        user = User.objects.get(number=phone_number)
-        return not user.name  # True if name is empty/None, False if name exists
-    except User.DoesNotExist:
+    user = user or user_cache.get_user(phone_number)
+    if user is None:
         return True  # True if user doesn't exist
+    return not user.name  # True if name is empty/None, False if name exists
 
 
-def create_user(twilio_message: TwilioMessage):
+def create_user(twilio_message: TwilioMessage, details: dict = None, user: User = None):
     """
-    Create a new user record
+    Create a new user record, or name the sender's unnamed one
     Args:
         twilio_message: TwilioMessage object containing user details
+        details: Already extracted {"name": ...}, if any
+        user: Already resolved sender without a name, if any
     Returns:
-        Created user object
+        Welcome reply for the user
     """
     try:
         # Extract user's name using gemini service
-        extractedName = gemini_service.extract_user_name(twilio_message).strip()
-        print(f"Extracted name: {extractedName}")
-        user = User(
-            name=extractedName,
-            number=twilio_message.sender,
-        ).save()
-        return user
-    except Exception as e:
-        print(f"Error creating user: {str(e)}")
+        if details:
+            extractedName = details["name"]
+        else:
+            extractedName = (
+                get_gemini_service().extract_user_name(twilio_message).strip()
+            )
+        logger.debug("Extracted name: %s", extractedName)
+        if not extractedName:
+            return REPLY_ASK_NAME
+        user = user or User(number=twilio_message.sender)
+        user.name = extractedName
+        user.save()
+        return REPLY_WELCOME.format(name=user.name)
+    except LLMUnavailable:
+        raise
+    except Exception:
+        logger.exception("Error creating user")
         return None
 
 
@@ -332,23 +814,19 @@ def answer_miscellaneous_query(twilio_message: TwilioMessage):
     Answer miscellaneous queries using Gemini API
     Endpoint: /answer/
     """
-    return gemini_service.answer_miscellaneous_query(twilio_message)
+    return get_gemini_service().answer_miscellaneous_query(twilio_message)
 
 
-def answer_analytical_query(twilio_message: TwilioMessage):
+def answer_analytical_query(twilio_message: TwilioMessage, user: User = None):
     """
     Process analytical queries using Gemini API
     Endpoint: /analytics/
     """
-    # Get all transactions for the family
-    user = fetchUser(twilio_message)
-    all_transactions = Transaction.objects.all()
-    family_transactions = all_transactions.filter(familyId=user.familyId)
-
-    # Convert transactions to CSV format
-    csv_data = "id,type,category,year,month,day,amount,description\n"
-    for transaction in family_transactions:
-        csv_data += f"{transaction.id},{transaction.type},{transaction.category},{transaction.year},{transaction.month},{transaction.day},{transaction.amount},{transaction.description}\n"
-    print("CSV Data:\n", csv_data)
-    twilio_message.body = twilio_message.body + "\n" + csv_data
-    return gemini_service.answer_analytical_query(twilio_message)
+    user = user or fetchUser(twilio_message)
+    if user is None:
+        return REPLY_ASK_NAME
+
+    # Send Gemini a bounded digest instead of every family transaction
+    digest = analytics_engine.build_digest(user.familyId, twilio_message.body)
+    twilio_message.body = twilio_message.body + "\n" + digest
+    return get_gemini_service().answer_analytical_query(twilio_message)
@@ -131,8 +131,293 @@ STATIC_URL = "/static/"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# Point "gemini" at a shared backend (Redis, Memcached) to share cached Gemini
+# responses across workers; the local-memory backend evicts least recently
+# used entries beyond MAX_ENTRIES.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "gemini": {
+        "BACKEND": os.getenv(
+            "COPILOT_GEMINI_CACHE_BACKEND",
+            "django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": os.getenv("COPILOT_GEMINI_CACHE_LOCATION", "gemini-responses"),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.getenv("COPILOT_GEMINI_CACHE_MAX_ENTRIES", "5000")),
+        },
+    },
+    # Must be shared by the web and worker processes in production
+    "idempotency": {
+        "BACKEND": os.getenv(
+            "COPILOT_IDEMPOTENCY_CACHE_BACKEND",
+            "django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": os.getenv("COPILOT_IDEMPOTENCY_CACHE_LOCATION", "idempotency"),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(
+                os.getenv("COPILOT_IDEMPOTENCY_CACHE_MAX_ENTRIES", "50000")
+            ),
+        },
+    },
+}
+
 # Default file storage
 DEFAULT_FILE_STORAGE = "django.core.files.storage.FileSystemStorage"
 
 # URL Settings
 APPEND_SLASH = True
+
+# Background message workers (manage.py run_workers)
+COPILOT_WORKER_CONCURRENCY = int(os.getenv("COPILOT_WORKER_CONCURRENCY", "4"))
+COPILOT_WORKER_POLL_INTERVAL = float(os.getenv("COPILOT_WORKER_POLL_INTERVAL", "1.0"))
+COPILOT_JOB_MAX_ATTEMPTS = int(os.getenv("COPILOT_JOB_MAX_ATTEMPTS", "3"))
+# Seconds before the first retry, doubled on every further attempt
+COPILOT_JOB_RETRY_BACKOFF = float(os.getenv("COPILOT_JOB_RETRY_BACKOFF", "5"))
+# A running job whose worker died becomes claimable again after this many seconds
+COPILOT_JOB_LEASE_SECONDS = int(os.getenv("COPILOT_JOB_LEASE_SECONDS", "300"))
+# A job put back this many times (rate limit, Gemini circuit open) fails instead
+COPILOT_JOB_MAX_DEFERRALS = int(os.getenv("COPILOT_JOB_MAX_DEFERRALS", "30"))
+
+# Seconds after receiving a message during which the webhook request waits
+# for the workers' answer to return it inline as TwiML (no REST call); later
+# answers are sent over REST. Holds a web thread that long, 0 disables.
+# Twilio gives up on webhooks after 15 seconds. Needs an idempotency cache
+# shared by the web and worker processes (COPILOT_IDEMPOTENCY_CACHE_BACKEND),
+# inline replies are off with the default LocMemCache.
+COPILOT_INLINE_REPLY_DEADLINE = float(os.getenv("COPILOT_INLINE_REPLY_DEADLINE", "5"))
+
+# Outbound replies (copilot.services.outbound): sending threads per worker
+# process (also the Twilio connection pool size) and their poll interval, attempts and first retry
+# delay in seconds for rate limits and server errors, REST timeout, and the
+# public URL of the status callback endpoint (/whatsapp/status, unset: no
+# delivery tracking)
+COPILOT_OUTBOUND_CONCURRENCY = int(os.getenv("COPILOT_OUTBOUND_CONCURRENCY", "4"))
+COPILOT_OUTBOUND_POLL_INTERVAL = float(
+    os.getenv("COPILOT_OUTBOUND_POLL_INTERVAL", "0.25")
+)
+COPILOT_OUTBOUND_MAX_ATTEMPTS = int(os.getenv("COPILOT_OUTBOUND_MAX_ATTEMPTS", "5"))
+COPILOT_OUTBOUND_RETRY_BACKOFF = float(os.getenv("COPILOT_OUTBOUND_RETRY_BACKOFF", "2"))
+COPILOT_OUTBOUND_LEASE_SECONDS = int(os.getenv("COPILOT_OUTBOUND_LEASE_SECONDS", "60"))
+COPILOT_TWILIO_TIMEOUT = float(os.getenv("COPILOT_TWILIO_TIMEOUT", "10"))
+COPILOT_TWILIO_STATUS_CALLBACK_URL = (
+    os.getenv("COPILOT_TWILIO_STATUS_CALLBACK_URL") or None
+)
+
+# "combined": one Gemini call classifies the message and extracts its details
+# "two_call": classify first, then extract in the intent handler
+COPILOT_INTENT_MODE = os.getenv("COPILOT_INTENT_MODE", "combined")
+
+# Text messages parsed locally with at least this confidence (0-1) skip Gemini,
+# set above 1 to always use Gemini
+COPILOT_LOCAL_PARSER_THRESHOLD = float(
+    os.getenv("COPILOT_LOCAL_PARSER_THRESHOLD", "0.8")
+)
+
+# Gemini response cache: Django cache alias and seconds to keep each method's
+# responses ("default" applies to methods not listed, 0 disables caching)
+COPILOT_GEMINI_CACHE_ALIAS = "gemini"
+COPILOT_GEMINI_CACHE_TTLS = {
+    "default": 0,
+    "identify_intent": 24 * 60 * 60,
+    "classify_and_extract": 24 * 60 * 60,
+    "extract_user_name": 24 * 60 * 60,
+    "extract_transaction_details": 24 * 60 * 60,
+    "extract_transaction_update_details": 24 * 60 * 60,
+    "extract_multiple_transactions": 24 * 60 * 60,
+    "answer_miscellaneous_query": 24 * 60 * 60,
+    "answer_analytical_query": 5 * 60,
+    "convert_speech_to_text": 7 * 24 * 60 * 60,
+}
+
+# Analytical queries: estimated token budget of the finance digest sent to
+# Gemini and how many recent months it covers in detail
+COPILOT_ANALYTICS_TOKEN_BUDGET = int(
+    os.getenv("COPILOT_ANALYTICS_TOKEN_BUDGET", "1500")
+)
+COPILOT_ANALYTICS_WINDOW_MONTHS = int(
+    os.getenv("COPILOT_ANALYTICS_WINDOW_MONTHS", "12")
+)
+
+# Inbound media downloads: parallel downloads (and pooled connections) per
+# worker process, size limit and connect/read timeouts in seconds
+COPILOT_MEDIA_DOWNLOAD_WORKERS = int(os.getenv("COPILOT_MEDIA_DOWNLOAD_WORKERS", "4"))
+COPILOT_MEDIA_MAX_BYTES = int(
+    os.getenv("COPILOT_MEDIA_MAX_BYTES", str(16 * 1024 * 1024))
+)
+COPILOT_MEDIA_CONNECT_TIMEOUT = float(os.getenv("COPILOT_MEDIA_CONNECT_TIMEOUT", "5"))
+COPILOT_MEDIA_READ_TIMEOUT = float(os.getenv("COPILOT_MEDIA_READ_TIMEOUT", "30"))
+
+# Decode images and transcribe voice notes in the background as soon as the
+# media is downloaded, on a pool of this many threads per worker process
+COPILOT_EAGER_MEDIA_DECODING = os.getenv("COPILOT_EAGER_MEDIA_DECODING", "1") == "1"
+COPILOT_MEDIA_DECODE_WORKERS = int(os.getenv("COPILOT_MEDIA_DECODE_WORKERS", "4"))
+
+# Per-process cache of User lookups by WhatsApp number (entries, seconds)
+COPILOT_USER_CACHE_SIZE = int(os.getenv("COPILOT_USER_CACHE_SIZE", "10000"))
+COPILOT_USER_CACHE_TTL = float(os.getenv("COPILOT_USER_CACHE_TTL", "300"))
+
+# Conversational context sent with follow-up sensitive prompts: the last
+# COPILOT_CHAT_CONTEXT_TURNS messages plus a rolling summary of older ones,
+# within COPILOT_CHAT_CONTEXT_TOKEN_BUDGET tokens
+COPILOT_CHAT_CONTEXT_TURNS = int(os.getenv("COPILOT_CHAT_CONTEXT_TURNS", "6"))
+COPILOT_CHAT_CONTEXT_TOKEN_BUDGET = int(
+    os.getenv("COPILOT_CHAT_CONTEXT_TOKEN_BUDGET", "400")
+)
+COPILOT_CHAT_CONTEXT_SUMMARY_SHARE = float(
+    os.getenv("COPILOT_CHAT_CONTEXT_SUMMARY_SHARE", "0.4")
+)
+COPILOT_CHAT_CONTEXT_SUMMARIZE = os.getenv("COPILOT_CHAT_CONTEXT_SUMMARIZE", "1") == "1"
+COPILOT_CHAT_CONTEXT_CACHE_ALIAS = os.getenv(
+    "COPILOT_CHAT_CONTEXT_CACHE_ALIAS", "default"
+)
+COPILOT_CHAT_CONTEXT_TTL = int(
+    os.getenv("COPILOT_CHAT_CONTEXT_TTL", str(7 * 24 * 3600))
+)
+
+# Idempotent message processing keyed on MessageSid: seconds a reply is kept
+# for retries, seconds an unfinished execution holds its claim, and seconds a
+# duplicate waits for the first execution before its job is retried
+COPILOT_IDEMPOTENCY_CACHE_ALIAS = "idempotency"
+COPILOT_IDEMPOTENCY_TTL = int(os.getenv("COPILOT_IDEMPOTENCY_TTL", str(24 * 3600)))
+COPILOT_IDEMPOTENCY_LEASE = int(os.getenv("COPILOT_IDEMPOTENCY_LEASE", "300"))
+COPILOT_IDEMPOTENCY_WAIT = float(os.getenv("COPILOT_IDEMPOTENCY_WAIT", "30"))
+
+# Burst coalescing: messages of a sender within COPILOT_DEBOUNCE_WINDOW
+# seconds of each other are processed as one (0 disables), delaying the
+# first one by at most COPILOT_DEBOUNCE_MAX_WINDOW seconds. Every message waits
+# out the window, so it is kept well under COPILOT_INLINE_REPLY_DEADLINE
+COPILOT_DEBOUNCE_WINDOW = float(os.getenv("COPILOT_DEBOUNCE_WINDOW", "0.75"))
+COPILOT_DEBOUNCE_MAX_WINDOW = float(os.getenv("COPILOT_DEBOUNCE_MAX_WINDOW", "5"))
+
+# Fuzzy description search of updates/deletes: most candidates taken from the
+# n-gram index and the least similarity (0-1) a description needs to match
+COPILOT_FUZZY_CANDIDATES = int(os.getenv("COPILOT_FUZZY_CANDIDATES", "50"))
+COPILOT_FUZZY_MIN_SIMILARITY = float(os.getenv("COPILOT_FUZZY_MIN_SIMILARITY", "0.6"))
+
+# Token-bucket limits of message processing, per sender and overall. The
+# buckets live in the COPILOT_RATE_LIMIT_CACHE_ALIAS cache: only a backend
+# shared by every run_workers process (database, Redis, Memcached) makes the
+# global limit global and keeps the buckets across restarts. With the default
+# LocMemCache each process has its own buckets, so the effective global limit
+# is multiplied by the number of worker processes and a restart resets them.
+COPILOT_RATE_LIMIT_CACHE_ALIAS = "idempotency"
+COPILOT_SENDER_RATE_PER_MINUTE = float(
+    os.getenv("COPILOT_SENDER_RATE_PER_MINUTE", "10")
+)
+COPILOT_SENDER_BURST = float(os.getenv("COPILOT_SENDER_BURST", "5"))
+COPILOT_GLOBAL_RATE_PER_MINUTE = float(
+    os.getenv("COPILOT_GLOBAL_RATE_PER_MINUTE", "300")
+)
+COPILOT_GLOBAL_BURST = float(os.getenv("COPILOT_GLOBAL_BURST", "50"))
+
+# Gemini call scheduler (per process): concurrent requests (hedged and
+# timed-out ones included, until they finish), priority lane of each
+# GeminiService method ("default" for the others), and per lane the queue
+# length and seconds waited after which calls are shed
+COPILOT_GEMINI_CONCURRENCY = int(os.getenv("COPILOT_GEMINI_CONCURRENCY", "8"))
+COPILOT_GEMINI_LANES = {
+    "default": "interactive",
+    "answer_analytical_query": "analytics",
+    "summarize_conversation": "background",
+}
+COPILOT_GEMINI_MAX_QUEUE = {
+    "interactive": 200,
+    "analytics": 20,
+    "background": 5,
+}
+COPILOT_GEMINI_MAX_WAIT = {
+    "interactive": 60,
+    "analytics": 20,
+    "background": 5,
+}
+
+# Deadline, retries, hedging and circuit breaker of Gemini calls per
+# GeminiService method, over "default" (see copilot.services.call_policy.CallPolicy)
+COPILOT_GEMINI_CALL_POLICIES = {
+    "default": {
+        "timeout": 20,
+        "retries": 2,
+        "backoff": 0.5,
+        "backoff_max": 8,
+        "hedge_after": None,
+        "breaker_threshold": 0.5,
+        "breaker_min_calls": 10,
+        "breaker_window": 60,
+        "breaker_cooldown": 30,
+    },
+    "identify_intent": {"timeout": 15, "hedge_after": "p95"},
+    "classify_and_extract": {"timeout": 15, "hedge_after": "p95"},
+    "answer_analytical_query": {"timeout": 45, "retries": 1},
+    "summarize_conversation": {"retries": 0},
+}
+# Local parse confidence accepted while Gemini's circuit is open
+COPILOT_DEGRADED_PARSER_THRESHOLD = float(
+    os.getenv("COPILOT_DEGRADED_PARSER_THRESHOLD", "0.5")
+)
+
+# Dotted paths of callables building the Gemini and Twilio REST clients
+# instead of the real ones, e.g. the fakes of the load test (manage.py loadtest):
+# copilot.loadtest.fake_gemini.create_client and
+# copilot.loadtest.fake_twilio.create_client
+COPILOT_GEMINI_CLIENT_FACTORY = os.getenv("COPILOT_GEMINI_CLIENT_FACTORY") or None
+COPILOT_TWILIO_CLIENT_FACTORY = os.getenv("COPILOT_TWILIO_CLIENT_FACTORY") or None
+
+# Behaviour of the fake clients (see copilot.loadtest): Gemini latency
+# distribution ("constant:0.5", "uniform:0.2,1", "lognormal:<median>,<sigma>"),
+# error rate and a JSON file of recorded responses, the file
+# copilot.loadtest.fake_gemini.create_recording_client records real responses
+# to, and the fake Twilio server
+COPILOT_LOADTEST = {
+    "gemini_latency": os.getenv("COPILOT_LOADTEST_GEMINI_LATENCY", "lognormal:0.8,0.4"),
+    "gemini_error_rate": float(os.getenv("COPILOT_LOADTEST_GEMINI_ERROR_RATE", "0")),
+    "gemini_responses": os.getenv("COPILOT_LOADTEST_GEMINI_RESPONSES") or None,
+    "gemini_record": os.getenv("COPILOT_LOADTEST_GEMINI_RECORD") or None,
+    "twilio_url": os.getenv("COPILOT_LOADTEST_TWILIO_URL", "http://127.0.0.1:8765"),
+}
+
+# Logging: the copilot loggers write to stderr at COPILOT_LOG_LEVEL
+# (DEBUG includes message bodies, answers and extracted details)
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "plain": {
+            "format": "%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s",
+        },
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "plain"},
+    },
+    "loggers": {
+        "copilot": {
+            "handlers": ["console"],
+            "level": os.getenv("COPILOT_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
+# Metrics (/metrics) and opt-in profiling of messages slower than
+# COPILOT_PROFILE_SLOW_SECONDS: a share of them (COPILOT_PROFILE_SAMPLE_RATE)
+# runs under cProfile and/or tracemalloc ("cprofile", "tracemalloc" or
+# "cprofile,tracemalloc") and slow ones are written to COPILOT_PROFILE_DIR
+COPILOT_WORKER_METRICS_PORT = (
+    int(os.getenv("COPILOT_WORKER_METRICS_PORT"))
+    if os.getenv("COPILOT_WORKER_METRICS_PORT")
+    else None
+)
+COPILOT_PROFILE_SLOW_SECONDS = (
+    float(os.getenv("COPILOT_PROFILE_SLOW_SECONDS"))
+    if os.getenv("COPILOT_PROFILE_SLOW_SECONDS")
+    else None
+)
+COPILOT_PROFILE_SAMPLE_RATE = float(os.getenv("COPILOT_PROFILE_SAMPLE_RATE", "1"))
+COPILOT_PROFILE_MODE = os.getenv("COPILOT_PROFILE_MODE", "cprofile")
+COPILOT_PROFILE_DIR = os.getenv(
+    "COPILOT_PROFILE_DIR", os.path.join(BASE_DIR, "profiles")
+)